@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# bencode_bench.py -- measuring the speed of the bencoding module
+
+""" Benchmarks each encode and decode path of the bencode module against
+generated corpora, reporting operations per second, MB/s, and the peak
+memory allocated, where the resource module and fork() are available to
+measure it. Memory is measured as growth in resident size, so it is
+only as fine as a page, and only approximate. Nothing is read from disk
+or the network, so it can be run anywhere:
+
+	python benchmarks/bencode_bench.py [--min-time 1.0] [corpus ...]
+"""
+
+import argparse
+import os
+import sys
+from hashlib import sha1
+from timeit import default_timer
+
+# Run from anywhere, benchmarking the modules next to this directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+	os.pardir))
+
+import bencode
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+def random_string(length, seed):
+	""" Returns a repeatable string of length pseudo-random bytes. """
+
+	temp = []
+	block = sha1(seed).digest()
+	for i in range(0, length, len(block)):
+		temp.append(block)
+		block = sha1(block).digest()
+
+	return "".join(temp)[:length]
+
+def single_file_torrent():
+	""" A torrent of a single 10 GB file, in 512 KB pieces. """
+
+	pieces = 20480
+
+	return {"announce" : "http://tracker.example.com:6969/announce",
+			"created by" : "pytorrent",
+			"creation date" : 1300000000,
+			"info" : {"length" : pieces * 524288,
+					  "name" : "dataset.tar",
+					  "piece length" : 524288,
+					  "pieces" : random_string(pieces * 20, "single")}}
+
+def multi_file_torrent():
+	""" A torrent of 10,000 files in 100 directories. """
+
+	files = [{"length" : 100000 + n,
+			  "path" : ["dir%03d" % (n % 100), "file%05d.dat" % n]} \
+		for n in range(10000)]
+	total = sum(f["length"] for f in files)
+	pieces = (total + 262143) // 262144
+
+	return {"announce" : "http://tracker.example.com:6969/announce",
+			"announce-list" : [["http://tracker%d.example.com/announce" % n] \
+				for n in range(20)],
+			"info" : {"files" : files,
+					  "name" : "dataset",
+					  "piece length" : 262144,
+					  "pieces" : random_string(pieces * 20, "multi")}}
+
+def compact_response():
+	""" A tracker response with 5,000 peers in the compact format. """
+
+	return {"complete" : 2500,
+			"incomplete" : 2500,
+			"interval" : 1800,
+			"peers" : random_string(5000 * 6, "compact")}
+
+def expanded_response():
+	""" A tracker response with 5,000 peers in the expanded format. """
+
+	peers = [{"ip" : "10.%d.%d.%d" % (n >> 16, (n >> 8) & 255, n & 255),
+			  "peer id" : random_string(20, str(n)),
+			  "port" : 6881 + n % 100} for n in range(5000)]
+
+	return {"complete" : 2500,
+			"incomplete" : 2500,
+			"interval" : 1800,
+			"peers" : peers}
+
+def nested_dicts():
+	""" 100 dicts, each nested 100 deep. """
+
+	temp = []
+	for n in range(100):
+		d = {"leaf" : n}
+		for depth in range(100):
+			d = {"depth" : depth, "child" : d}
+		temp.append(d)
+
+	return temp
+
+# Each corpus, in the order they are run
+corpora = [ ("single-file", single_file_torrent) ,
+			("multi-file" , multi_file_torrent)  ,
+			("compact"    , compact_response)    ,
+			("expanded"   , expanded_response)   ,
+			("nested"     , nested_dicts)        ]
+
+class NullWriter():
+	""" A file-like object that throws away everything written to it. """
+
+	def write(self, data):
+		""" Discard data. """
+
+		pass
+
+def parse_chunks(data, size = 16384):
+	""" Feed data through the incremental parser, a chunk at a time. """
+
+	parser = bencode.BencodeParser()
+	for i in range(0, len(data), size):
+		parser.feed(data[i:i + size])
+	parser.close()
+
+def walk_lazy(value):
+	""" Lazily decode value, and access every item of it. """
+
+	stack = [bencode.decode_lazy(value)]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, bencode.LazyDict):
+			stack.extend(item.values())
+		elif isinstance(item, bencode.LazyList):
+			stack.extend(item)
+
+def codec_paths(value, data):
+	""" Returns the name of each codec path, and a function running it on
+	the given value, or its encoded data. """
+
+	return [("encode"      , lambda: bencode.encode(value))                ,
+			("encode_to"   , lambda: bencode.encode_to(value, NullWriter())) ,
+			("decode"      , lambda: bencode.decode(data))                 ,
+			("decode_lazy" , lambda: bencode.decode_lazy(data))            ,
+			("lazy+access" , lambda: walk_lazy(data))                      ,
+			("parser"      , lambda: parse_chunks(data))                   ]
+
+def measure(function, min_time):
+	""" Run function until at least min_time seconds have passed, and
+	return the number of runs, and the time taken. """
+
+	runs = 0
+	start = default_timer()
+	elapsed = 0.0
+	while elapsed < min_time:
+		function()
+		runs += 1
+		elapsed = default_timer() - start
+
+	return runs, elapsed
+
+def max_rss():
+	""" Returns the peak resident size of this process so far, in bytes. """
+
+	size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return size if sys.platform == "darwin" else size * 1024
+
+def peak_allocation(function):
+	""" Return the peak memory allocated running function once, in bytes,
+	or None if it can't be measured. """
+
+	if resource is None or not hasattr(os, "fork"):
+		return None
+
+	# A forked child's peak resident size starts from our current size,
+	# not our peak, so its growth is the most function had allocated at
+	# once, whatever earlier runs allocated here.
+	read_end, write_end = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		try:
+			os.close(read_end)
+			before = max_rss()
+			function()
+			os.write(write_end, str(max_rss() - before))
+		finally:
+			os._exit(0)
+
+	os.close(write_end)
+	output = os.read(read_end, 64)
+	os.close(read_end)
+	os.waitpid(pid, 0)
+
+	return int(output) if output else None
+
+def run(names, min_time, out = sys.stdout):
+	""" Benchmark every codec path against the named corpora, writing a
+	table of results to out. """
+
+	out.write("%-12s %-12s %10s %10s %12s\n" % \
+		("corpus", "path", "ops/sec", "MB/s", "peak KB"))
+
+	for name, make in corpora:
+		if names and name not in names:
+			continue
+
+		value = make()
+		data = bencode.encode(value)
+		size = len(data)
+
+		for path, function in codec_paths(value, data):
+			# Before the timed runs, which leave freed memory behind that
+			# later runs reuse without growing.
+			peak = peak_allocation(function)
+			runs, elapsed = measure(function, min_time)
+
+			out.write("%-12s %-12s %10.1f %10.1f %12s\n" % (name, path, \
+				runs / elapsed, size * runs / elapsed / 1e6, \
+				"n/a" if peak is None else "%d" % (peak // 1024)))
+
+def main():
+	""" Parse the command line, and run the benchmarks. """
+
+	parser = argparse.ArgumentParser(description = "Benchmark the bencode codec.")
+	parser.add_argument("--min-time", type = float, default = 1.0, \
+		help = "seconds to run each path for")
+	parser.add_argument("corpora", nargs = "*", \
+		help = "corpora to run, out of: " + \
+			", ".join(name for name, make in corpora))
+	args = parser.parse_args()
+
+	run(args.corpora, args.min_time)
+
+if __name__ == "__main__":
+	main()
@@ -7,13 +7,17 @@
 
 """ This module deals with the encoding and decoding of bencoded data.
 decode() and encode() are the major functions available, to decode
-and encode data. """
+and encode data. encode_to() writes the encoded data straight to a
+file-like object. decode_from() decodes a single expression starting at
+a given index, returning the value and the index after it.
+decode_lazy() only decodes lists and dicts as they are accessed, and
+can give the raw bencoded data of any of their items. """
 
 # Note: Bencoding specification:
 # http://www.bittorrent.org/beps/bep_0003.html
 
 import types
-from util import collapse
+from util import collapse, to_string
 
 def stringlength(string, index = 0):
 	""" Given a bencoded expression, starting with a string, returns
@@ -155,20 +159,7 @@ def decode_int(data):
 
 	check_ben_type(data, int)
 
-	# Find the end constant of the integer. It may not exist, which would lead
-	# to an error being raised.
-	try:
-		end = data.index("e")
-	except ValueError:
-		raise BencodeError("Decode", "Cannot find end of integer expression", data)
-
-	t = data[1:end]	# Remove the substring we want.
-
-	# Check for leading zeros, which are not allowed.
-	if len(t) > 1 and t[0] == "0":
-		raise BencodeError("Decode", "Malformed expression, leading zeros", data)
-
-	return int(t)	# Return an integer.
+	return decode_from(data)[0]
 
 def encode_str(data):
 	""" Given a string, returns a bencoded string of that string. """
@@ -183,84 +174,157 @@ def decode_str(data):
 
 	check_ben_type(data, str)
 
-	# We want everything past the first colon.
-	try:
-		colon = data.find(":")
-	except ValueError:
-		raise BencodeError("Decode", "Badly formed expression", data)
-	# Up to the end of the data.
-	strlength = stringlength(data)
-
-	# The subsection of the data we want.
-	return data[colon + 1:strlength]
+	return decode_from(data)[0]
 
 def encode_list(data):
 	""" Given a list, returns a bencoded list. """
 
 	check_type(data, list)
 
-	# Special case of an empty list.
-	if data == []:
-		return "le"
-
-	# Encode each item in the list.
-	temp = [encode(item) for item in data]
-	# Add list annotation, and collapse the list.
-	return "l" + collapse(temp) + "e"
+	return encode(data)
 
 def decode_list(data):
 	""" Given a bencoded list, return the unencoded list. """
 
 	check_ben_type(data, list)
 
-	# Special case of an empty list.
-	if data == "le":
-		return []
-
-	# Remove list annotation, and inflate the l.
-	temp = inflate(data[1:-1])
-	# Decode each item in the list.
-	return [decode(item) for item in temp]
+	return decode(data)
 
 def encode_dict(data):
 	""" Given a dictionary, return the bencoded dictionary. """
 
 	check_type(data, dict)
 
-	# Special case of an empty dictionary.
-	if data == {}:
-		return "de"
-
-	# Encode each key and value for each key in the dictionary.
-	temp = [encode_str(key) + encode(data[key]) for key in sorted(data.keys())]
-	# Add dict annotation, and collapse the dictionary.
-	return "d" + collapse(temp) + "e"
+	return encode(data)
 
 def decode_dict(data):
 	""" Given a bencoded dictionary, return the dictionary. """
 
 	check_ben_type(data, dict)
 
-	# Special case of an empty dictionary.
-	if data == "de":
-		return {}
-
-	# Remove dictionary annotation
-	data = data[1:-1]
-
-	temp = {}
-	terms = inflate(data)
-
-	# For every key value pair in the terms list, decode the key,
-	# and add it to the dictionary, with its decoded value
-	count = 0
-	while count != len(terms):
-		temp[decode_str(terms[count])] = decode(terms[count + 1])
-		count += 2
+	return decode(data)
+
+# The single pass decoder. Rather than slicing the expression up and
+# decoding each slice, we keep an index into the original data, and each
+# reader returns the value it decoded, along with the index just past it.
+# This means every byte of the input is only looked at once. Lists and
+# dicts are kept on an explicit stack rather than by recursing, so
+# neither long nor deeply nested data can exhaust the Python stack, and
+# the limits below bound the work done on untrusted data.
+
+def read_int(data, index, max_int_digits = None):
+	""" Given data, and the index of an integer's start constant,
+	returns the integer, and the index after its end constant. If
+	max_int_digits is given, integers with more digits raise an error,
+	before they are converted. """
+
+	end = data.find("e", index)
+	if end == -1:
+		raise BencodeError("Decode", "Cannot find end of integer expression", \
+			data[index:index + 32])
+
+	t = data[index + 1:end]	# The digits, without the constants.
+	if max_int_digits is not None and len(t.lstrip("-")) > max_int_digits:
+		raise BencodeError("Decode", "Integer longer than maximum", len(t))
+
+	# Check for leading zeros, and negative zero, which are not allowed.
+	if t[:1] == "-":
+		digits = t[1:]
+		if digits[:1] == "0":
+			raise BencodeError("Decode", "Malformed expression, negative zero", t)
+	else:
+		digits = t
+	if not digits.isdigit():
+		raise BencodeError("Decode", "Malformed integer", t)
+	if len(digits) > 1 and digits[0] == "0":
+		raise BencodeError("Decode", "Malformed expression, leading zeros", t)
+
+	return int(t), end + 1
+
+def read_str(data, index, max_string = None):
+	""" Given data, and the index of a string's length prefix, returns
+	the string, and the index after it. If max_string is given, longer
+	strings raise an error. """
+
+	colon = data.find(":", index)
+	if colon == -1:
+		raise BencodeError("Decode", "Cannot find end of string length", \
+			data[index:index + 32])
+
+	length = data[index:colon]
+	if not length.isdigit():
+		raise BencodeError("Decode", "Malformed string length", length)
+
+	if max_string is not None and int(length) > max_string:
+		raise BencodeError("Decode", "String longer than maximum", length)
+
+	start = colon + 1
+	end = start + int(length)
+	if end > len(data):
+		raise BencodeError("Decode", "String longer than data", length)
+
+	return data[start:end], end
+
+# The streaming encoder. Each writer is given the data, and a write
+# function, and passes its output to write a chunk at a time. Nothing
+# builds encoded children to be joined together later, so the output is
+# only ever held once, in whatever write puts it in.
+
+def write_int(data, write):
+	""" Writes a bencoded integer. """
+
+	write("i%de" % data)
+
+def write_str(data, write):
+	""" Writes a bencoded string, bytearray or memoryview. """
+
+	write("%d:" % len(data))
+	write(data)
+
+def write_list(data, write):
+	""" Writes a bencoded list, and each of its items. """
+
+	write("l")
+	for item in data:
+		write_value(item, write)
+	write("e")
+
+def write_dict(data, write):
+	""" Writes a bencoded dictionary, with its keys in sorted order. """
+
+	write("d")
+	for key in sorted(data.keys()):
+		check_type(key, str)
+		write_str(key, write)
+		write_value(data[key], write)
+	write("e")
+
+def write_raw(data, write):
+	""" Writes a lazily decoded list or dictionary, exactly as it is in
+	the data it was decoded from. """
+
+	write(data.raw())
+
+def write_value(data, write):
+	""" Dispatches data to the appropriate write function. """
+
+	# The class, rather than the type, of old style instances, such as
+	# the lazy proxies.
+	try:
+		writer = write_functions[data.__class__]
+	except (KeyError, AttributeError):
+		raise BencodeError("Encode", "Unknown data type", data)
 
-	return temp
+	writer(data, write)
 
 # Dictionaries of the data type, and the function to use
+write_functions = { int        : write_int  ,
+					str        : write_str  ,
+					bytearray  : write_str  ,
+					memoryview : write_str  ,
+					list       : write_list ,
+					dict       : write_dict }
+
 encode_functions = { int  : encode_int  ,
 					 str  : encode_str  ,
 					 list : encode_list ,
@@ -271,18 +335,590 @@ decode_functions = { int  : decode_int  ,
 					 list : decode_list ,
 					 dict : decode_dict }
 
+def encode_to(data, writer):
+	""" Encodes data, writing the output to writer as it goes. writer
+	can be a file-like object, or a bytearray to be extended. """
+
+	if isinstance(writer, bytearray):
+		write_value(data, writer.extend)
+	else:
+		write_value(data, writer.write)
+
 def encode(data):
-	""" Dispatches data to appropriate encode function. """
+	""" Returns the bencoded string of data. The parts written are joined
+	once at the end, so the output is only copied the once. To have it in
+	a bytearray, or a file, use encode_to(). """
+
+	parts = []
+	write_value(data, parts.append)
 
+	# join() won't take bytearrays or memoryviews, so if there are any,
+	# they are turned into strings first.
 	try:
-		return encode_functions[type(data)](data)
-	except KeyError:
-		raise BencodeError("Encode", "Unknown data type", data)
+		return "".join(parts)
+	except TypeError:
+		return "".join(to_string(part) for part in parts)
+
+def decode_from(data, index = 0, max_depth = None, max_string = None, \
+	max_int_digits = None):
+	""" Decodes the expression starting at index in data. Returns a tuple
+	of the decoded value, and the index just past the end of it.
+	max_depth limits how deeply lists and dicts may be nested,
+	max_string limits the length of any string, and max_int_digits the
+	number of digits in any integer. """
+
+	if type(data) != str:
+		data = to_string(data)
+
+	stack = []	# The containers we are inside, innermost last.
+	keys = []	# The key awaiting a value, for each container.
+
+	while True:
+		char = data[index:index + 1]
+
+		# Dictionary keys must always be strings.
+		if stack and keys[-1] is None and type(stack[-1]) == dict and \
+			char != "e" and not char.isdigit():
+			raise BencodeError("Decode", "Dictionary key is not a string", \
+				data[index:index + 32])
+
+		if char == "i":
+			value, index = read_int(data, index, max_int_digits)
+
+		elif char.isdigit():
+			value, index = read_str(data, index, max_string)
+
+		elif char == "l" or char == "d":
+			if max_depth is not None and len(stack) >= max_depth:
+				raise BencodeError("Decode", "Nested deeper than maximum", index)
+			stack.append([] if char == "l" else {})
+			keys.append(None)
+			index += 1
+			continue
+
+		elif char == "e" and stack:
+			if keys[-1] is not None:
+				raise BencodeError("Decode", "Dictionary key has no value", \
+					keys[-1])
+			keys.pop()
+			value = stack.pop()
+			index += 1
+
+		elif char == "":
+			raise BencodeError("Decode", "Unexpected end of data", index)
+
+		else:
+			raise BencodeError("Decode", "Unknown data type", \
+				data[index:index + 32])
+
+		# Put the value in the innermost container, or we're done.
+		if not stack:
+			return value, index
+
+		container = stack[-1]
+		if type(container) == list:
+			container.append(value)
+		elif keys[-1] is None:
+			keys[-1] = value
+		else:
+			container[keys[-1]] = value
+			keys[-1] = None
+
+def decode(data, max_depth = None, max_length = None, max_string = None, \
+	max_int_digits = None):
+	""" Decodes a complete bencoded expression, given as a string,
+	bytearray or memoryview. max_length limits the length of the data,
+	see decode_from() for the other limits. """
+
+	if max_length is not None and len(data) > max_length:
+		raise BencodeError("Decode", "Data longer than maximum", len(data))
+
+	data = to_string(data)
+	value, end = decode_from(data, 0, max_depth, max_string, max_int_digits)
+
+	# Anything left over means the expression was malformed.
+	if end != len(data):
+		raise BencodeError("Decode", "Trailing data after expression", \
+			data[end:end + 32])
+
+	return value
+
+# The most digits in a string length, when no maximum string is given.
+MAX_LENGTH_DIGITS = 20
+
+class BencodeParser():
+	""" An incremental decoder. Data is given to feed() as it arrives,
+	and each top level value is returned as soon as it is complete. """
+
+	# Only an unfinished integer, or string length, is ever carried over
+	# between calls to feed(), and only the new data is searched for its
+	# end, so a long one isn't searched again from the start each time.
+	# The body of a string is collected a chunk at a time, and containers
+	# are built as their items arrive, so each byte fed in is only looked
+	# at a bounded number of times.
+
+	def __init__(self, max_depth = None, max_length = None, \
+		max_string = None, max_int_digits = None):
+		""" Start with nothing parsed. max_depth limits how deeply lists
+		and dicts may be nested, max_length limits the total length of
+		data fed in, max_string the length of any string, and
+		max_int_digits the number of digits in any integer. """
+
+		self.max_depth = max_depth
+		self.max_length = max_length
+		self.max_string = max_string
+		self.max_int_digits = max_int_digits
+		if max_string is not None:
+			self.max_length_digits = len(str(max_string))
+		else:
+			self.max_length_digits = MAX_LENGTH_DIGITS
+		self.length = 0		# The total length of data fed in.
+
+		self.pending = []	# The parts of an incomplete integer or string
+		self.pending_length = 0	# length, and their total length.
+		self.stack = []		# The containers we are inside, innermost last.
+		self.keys = []		# The key awaiting a value, for each container.
+		self.string_left = 0	# Bytes still to come of the current string.
+		self.string_parts = None	# The parts of the current string so far.
+		self.values = []	# Completed top level values.
+
+	def feed(self, chunk):
+		""" Parse chunk, returning a list of any top level values
+		completed by it. """
+
+		chunk = to_string(chunk)
+		self.length += len(chunk)
+		if self.max_length is not None and self.length > self.max_length:
+			raise BencodeError("Decode", "Data longer than maximum", self.length)
+
+		# Until its end arrives, an unfinished integer or string length is
+		# only added to.
+		if self.pending:
+			end = "e" if self.pending[0][0] == "i" else ":"
+			if chunk.find(end) == -1:
+				self.carry(chunk)
+				return []
+			data = "".join(self.pending) + chunk
+			self.pending = []
+			self.pending_length = 0
+		else:
+			data = chunk
+		index = 0
+
+		while index < len(data):
+			# We're part way through the body of a string.
+			if self.string_parts is not None:
+				part = data[index:index + self.string_left]
+				self.string_parts.append(part)
+				self.string_left -= len(part)
+				index += len(part)
+
+				if self.string_left == 0:
+					value = "".join(self.string_parts)
+					self.string_parts = None
+					self.add(value)
+				continue
+
+			char = data[index]
+
+			# Dictionary keys must always be strings.
+			if self.stack and type(self.stack[-1]) == dict and \
+				self.keys[-1] is None and char != "e" and not char.isdigit():
+				raise BencodeError("Decode", "Dictionary key is not a string", \
+					data[index:index + 32])
+
+			if char == "i":
+				if data.find("e", index) == -1:
+					self.carry(data[index:])
+					break
+				value, index = read_int(data, index, self.max_int_digits)
+				self.add(value)
+
+			elif char.isdigit():
+				colon = data.find(":", index)
+				if colon == -1:
+					self.carry(data[index:])
+					break
+				length = data[index:colon]
+				if len(length) > self.max_length_digits:
+					raise BencodeError("Decode", "String length too long", \
+						length[:32])
+				if not length.isdigit():
+					raise BencodeError("Decode", "Malformed string length", length)
+				if self.max_string is not None and int(length) > self.max_string:
+					raise BencodeError("Decode", "String longer than maximum", length)
+				index = colon + 1
+
+				self.string_left = int(length)
+				self.string_parts = []
+				if self.string_left == 0:
+					self.string_parts = None
+					self.add("")
+
+			elif char == "l" or char == "d":
+				if self.max_depth is not None and \
+					len(self.stack) >= self.max_depth:
+					raise BencodeError("Decode", "Nested deeper than maximum", index)
+				self.stack.append([] if char == "l" else {})
+				self.keys.append(None)
+				index += 1
+
+			elif char == "e":
+				if not self.stack:
+					raise BencodeError("Decode", "Unexpected end constant", index)
+				if self.keys[-1] is not None:
+					raise BencodeError("Decode", "Dictionary key has no value", \
+						self.keys[-1])
+				self.keys.pop()
+				value = self.stack.pop()
+				index += 1
+				self.add(value)
+
+			else:
+				raise BencodeError("Decode", "Unknown data type", \
+					data[index:index + 32])
+
+		values = self.values
+		self.values = []
+		return values
+
+	def carry(self, data):
+		""" Carry over data, the start of an integer or string length,
+		to the next call to feed(), unless it is longer already than we
+		would accept. """
+
+		self.pending.append(data)
+		self.pending_length += len(data)
+
+		if self.pending[0][0] == "i":
+			# The digits, the "i", and a sign.
+			if self.max_int_digits is not None and \
+				self.pending_length > self.max_int_digits + 2:
+				raise BencodeError("Decode", "Integer longer than maximum", \
+					self.pending_length)
+		elif self.pending_length > self.max_length_digits:
+			raise BencodeError("Decode", "String length too long", \
+				self.pending_length)
+
+	def add(self, value):
+		""" Add a completed value to the innermost container, or to the
+		completed values if we are not inside one. """
+
+		if not self.stack:
+			self.values.append(value)
+			return
+
+		container = self.stack[-1]
+		if type(container) == list:
+			container.append(value)
+		elif self.keys[-1] is None:
+			self.keys[-1] = value
+		else:
+			container[self.keys[-1]] = value
+			self.keys[-1] = None
+
+	def close(self):
+		""" Check that the data fed in didn't stop part way through a
+		value. """
+
+		if self.pending or self.stack or self.string_parts is not None:
+			raise BencodeError("Decode", "Unexpected end of data", \
+				"".join(self.pending))
+
+def decode_stream(stream, chunk_size = 16384, max_depth = None, \
+	max_length = None, max_string = None, max_int_digits = None):
+	""" Decodes a single bencoded expression read from a file-like object,
+	decoding as each chunk is read. See BencodeParser for the limits. """
+
+	parser = BencodeParser(max_depth, max_length, max_string, \
+		max_int_digits)
+	values = []
+
+	chunk = stream.read(chunk_size)
+	while chunk:
+		values.extend(parser.feed(chunk))
+		chunk = stream.read(chunk_size)
+	parser.close()
+
+	if len(values) != 1:
+		raise BencodeError("Decode", "Expected a single expression", \
+			len(values))
+
+	return values[0]
+
+# Lazy decoding. decode_lazy() returns proxies for lists and dicts, which
+# only note where each of their items lie in the original data. An item
+# is decoded the first time it is accessed, and the raw bencoded data of
+# any item can be had without decoding it at all. Where the items of
+# every list and dict lie is found in one pass over the data, and handed
+# down to each proxy as it is made, so no part of the data is scanned
+# more than once, however deeply it is nested.
+
+def scan(data, index):
+	""" Given data, and the index of an expression, returns the index just
+	past the end of it, and a dict of the start index of each list and
+	dict in it to the start and end index of each of its items, without
+	decoding anything. The keys and values of dicts are both items. """
+
+	items = {}
+	stack = []	# The start of each list and dict we are inside.
+
+	while True:
+		char = data[index:index + 1]
+		start = index
+
+		if char == "i":
+			end = data.find("e", index)
+			if end == -1:
+				raise BencodeError("Decode", "Cannot find end of integer expression", \
+					data[index:index + 32])
+			index = end + 1
+
+		elif char.isdigit():
+			colon = data.find(":", index)
+			length = data[index:colon]
+			if colon == -1 or not length.isdigit():
+				raise BencodeError("Decode", "Malformed string length", \
+					data[index:index + 32])
+			index = colon + 1 + int(length)
+			if index > len(data):
+				raise BencodeError("Decode", "String longer than data", length)
+
+		elif char == "l" or char == "d":
+			items[index] = []
+			stack.append(index)
+			index += 1
+			continue
+
+		elif char == "e" and stack:
+			start = stack.pop()
+			index += 1
+
+		elif char == "":
+			raise BencodeError("Decode", "Unexpected end of data", index)
+
+		else:
+			raise BencodeError("Decode", "Unknown data type", \
+				data[index:index + 32])
+
+		# A whole expression lies between start and index.
+		if not stack:
+			return index, items
+		items[stack[-1]].append((start, index))
+
+def lazy_value(data, start, end, items):
+	""" Returns the value between start and end in data, as a proxy if it
+	is a list or dict, whose items are found in items, as from scan(). """
+
+	char = data[start:start + 1]
+
+	if char == "l":
+		return LazyList(data, start, end, items)
+	elif char == "d":
+		return LazyDict(data, start, end, items)
+	return decode_from(data, start)[0]
+
+def decode_lazy_from(data, index = 0):
+	""" Lazily decodes the expression starting at index in data. Lists and
+	dicts are returned as proxies, everything else is decoded. Returns a
+	tuple of the value, and the index just past the end of it. """
+
+	if type(data) != str:
+		data = to_string(data)
+
+	char = data[index:index + 1]
+	if char != "l" and char != "d":
+		return decode_from(data, index)
+
+	end, items = scan(data, index)
+	return lazy_value(data, index, end, items), end
+
+def decode_lazy(data):
+	""" Lazily decodes a complete bencoded expression, given as a string,
+	bytearray or memoryview. """
+
+	data = to_string(data)
+	value, end = decode_lazy_from(data)
+
+	if end != len(data):
+		raise BencodeError("Decode", "Trailing data after expression", \
+			data[end:end + 32])
+
+	return value
+
+class LazyList():
+	""" A list, decoding each of its items on first access. """
+
+	def __init__(self, data, start, end, items):
+		""" Take the start and end index of the list in data, and the
+		spans of the items of it and the lists and dicts inside it. """
 
-def decode(data):
-	""" Dispatches data to appropriate decode function. """
+		self.data = data
+		self.start = start
+		self.end = end
+		self.nested = items
+		self.spans = items.pop(start)
+		self.cache = {}
 
-	try:
-		return decode_functions[ben_type(data)](data)
-	except KeyError:
-		raise BencodeError("Decode", "Unknown data type", data)
+	def __getitem__(self, n):
+		""" Return the nth item, decoding it if needed, or a list of the
+		items in a slice. """
+
+		if isinstance(n, slice):
+			return [self[i] for i in range(*n.indices(len(self.spans)))]
+
+		if n < 0:
+			n += len(self.spans)
+		if not 0 <= n < len(self.spans):
+			raise IndexError("List index out of range", n)
+		if n not in self.cache:
+			self.cache[n] = lazy_value(self.data, self.spans[n][0], \
+				self.spans[n][1], self.nested)
+		return self.cache[n]
+
+	def __len__(self):
+		""" Return the number of items. """
+
+		return len(self.spans)
+
+	def __iter__(self):
+		""" Iterate over the items, decoding them as we go. """
+
+		for n in range(len(self.spans)):
+			yield self[n]
+
+	def __eq__(self, other):
+		""" Compare the items with those of another list. """
+
+		return list(self) == other
+
+	def __ne__(self, other):
+		""" Compare the items with those of another list. """
+
+		return not self == other
+
+	def __repr__(self):
+		""" Represent the list, decoding all of it. """
+
+		return repr(list(self))
+
+	def span(self, n):
+		""" Return the start and end index of the nth item in the data. """
+
+		return self.spans[n]
+
+	def raw(self, n = None):
+		""" Return the bencoded nth item, or the whole list if n is not
+		given, exactly as it is in the data. """
+
+		start, end = (self.start, self.end) if n is None else self.spans[n]
+		return self.data[start:end]
+
+class LazyDict():
+	""" A dictionary, decoding each of its values on first access. """
+
+	def __init__(self, data, start, end, items):
+		""" Decode the keys, given the start and end index of the dict in
+		data, and the spans of the items of it and the lists and dicts
+		inside it. """
+
+		self.data = data
+		self.start = start
+		self.end = end
+		self.nested = items
+		self.spans = {}
+		self.order = []
+		self.cache = {}
+
+		spans = items.pop(start)
+		if len(spans) % 2:
+			raise BencodeError("Decode", "Dictionary key without a value", \
+				data[spans[-1][0]:spans[-1][0] + 32])
+
+		for n in range(0, len(spans), 2):
+			# Keys must always be strings.
+			key_start = spans[n][0]
+			if not data[key_start:key_start + 1].isdigit():
+				raise BencodeError("Decode", "Dictionary key is not a string", \
+					data[key_start:key_start + 32])
+			key = read_str(data, key_start)[0]
+			self.spans[key] = spans[n + 1]
+			self.order.append(key)
+
+	def __getitem__(self, key):
+		""" Return the value of key, decoding it if needed. """
+
+		if key not in self.cache:
+			self.cache[key] = lazy_value(self.data, self.spans[key][0], \
+				self.spans[key][1], self.nested)
+		return self.cache[key]
+
+	def __contains__(self, key):
+		""" Return true if the dict contains the key. """
+
+		return key in self.spans
+
+	def __len__(self):
+		""" Return the number of keys. """
+
+		return len(self.order)
+
+	def __iter__(self):
+		""" Iterate over the keys, in the order they are in the data. """
+
+		return iter(self.order)
+
+	def __eq__(self, other):
+		""" Compare the items with those of another dict. """
+
+		return dict(self.items()) == other
+
+	def __ne__(self, other):
+		""" Compare the items with those of another dict. """
+
+		return not self == other
+
+	def __repr__(self):
+		""" Represent the dict, decoding all of it. """
+
+		return repr(dict(self.items()))
+
+	has_key = __contains__
+
+	def get(self, key, default = None):
+		""" Return the value of key, or default if it isn't present. """
+
+		if key in self.spans:
+			return self[key]
+		return default
+
+	def keys(self):
+		""" Return a list of keys. """
+
+		return list(self.order)
+
+	def values(self):
+		""" Return a list of values, decoding them all. """
+
+		return [self[key] for key in self.order]
+
+	def items(self):
+		""" Return a list of tuples of the keys and values. """
+
+		return [(key, self[key]) for key in self.order]
+
+	def span(self, key):
+		""" Return the start and end index of key's value in the data. """
+
+		return self.spans[key]
+
+	def raw(self, key = None):
+		""" Return the bencoded value of key, or the whole dict if key is
+		not given, exactly as it is in the data. """
+
+		start, end = (self.start, self.end) if key is None else self.spans[key]
+		return self.data[start:end]
+
+# Lazy lists and dicts are encoded as they are, without decoding them.
+write_functions[LazyList] = write_raw
+write_functions[LazyDict] = write_raw
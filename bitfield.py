@@ -0,0 +1,156 @@
+# bitfield.py
+# Sets of pieces
+
+""" A compact set of pieces, one bit a piece, as in the bitfield message.
+The high bit of the first byte is piece 0. A torrent of 100,000 pieces
+needs 12,500 bytes per bitfield, where a set of piece indices would need
+megabytes. """
+
+# Note: Bitfield message specification:
+# http://www.bittorrent.org/beps/bep_0003.html#peer-messages
+
+from binascii import hexlify, unhexlify
+
+# The number of bits set in each byte.
+POPCOUNT = bytes(bytearray(bin(n).count("1") for n in range(256)))
+
+class Bitfield():
+	""" A set of pieces of a torrent with count pieces, backed by a
+	bytearray. Pieces are got and set by index, as with a list of
+	booleans, and iterating over it yields the index of each piece in
+	it. """
+
+	def __init__(self, count, data = None):
+		""" Make an empty bitfield for count pieces, or one holding data,
+		such as the payload of a bitfield message. Raises a ValueError if
+		data is the wrong length for count pieces. Spare bits at the end
+		are cleared. """
+
+		self.count = count
+		length = (count + 7) // 8
+
+		if data is None:
+			self.data = bytearray(length)
+			return
+
+		if len(data) != length:
+			raise ValueError("Bitfield the wrong length", len(data))
+
+		self.data = bytearray(data)
+		if count % 8:
+			self.data[-1] &= (0xff << (8 - count % 8)) & 0xff
+
+	def __len__(self):
+		""" Returns the number of pieces, set or not. """
+
+		return self.count
+
+	def __getitem__(self, index):
+		""" Returns true if piece index is set. """
+
+		if not 0 <= index < self.count:
+			raise IndexError("Piece index out of range", index)
+
+		return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+	def __setitem__(self, index, value):
+		""" Set, or clear, piece index. """
+
+		if not 0 <= index < self.count:
+			raise IndexError("Piece index out of range", index)
+
+		if value:
+			self.data[index >> 3] |= 0x80 >> (index & 7)
+		else:
+			self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+	def __iter__(self):
+		""" Yields the index of each piece set, skipping empty bytes. """
+
+		for i, byte in enumerate(self.data):
+			if byte:
+				for n in range(i * 8, i * 8 + 8):
+					if byte & (0x80 >> (n & 7)):
+						yield n
+
+	def popcount(self):
+		""" Returns the number of pieces set. """
+
+		return sum(bytearray(self.data.translate(POPCOUNT)))
+
+	def any(self):
+		""" Returns true if any piece is set. """
+
+		return any(self.data)
+
+	def to_int(self):
+		""" Returns the bitfield as one big number, piece 0 highest. """
+
+		return int(hexlify(self.data), 16) if self.data else 0
+
+	def other_int(self, other):
+		""" Returns another bitfield, of as many pieces, as a number. """
+
+		if other.count != self.count:
+			raise ValueError("Bitfields of different lengths", other.count)
+
+		return other.to_int()
+
+	def from_int(self, n):
+		""" Returns a bitfield of as many pieces as this one, holding the
+		number n, as from to_int(). """
+
+		length = len(self.data)
+		return Bitfield(self.count, unhexlify("%0*x" % (length * 2, n)) \
+			if length else "")
+
+	# The set operations work on whole bitfields at once, as numbers, so
+	# the work is done in C, rather than a byte at a time in Python.
+
+	def __and__(self, other):
+		""" Returns the pieces set in both bitfields. """
+
+		return self.from_int(self.to_int() & self.other_int(other))
+
+	def __or__(self, other):
+		""" Returns the pieces set in either bitfield. """
+
+		return self.from_int(self.to_int() | self.other_int(other))
+
+	def __sub__(self, other):
+		""" Returns the pieces set in this bitfield, but not the other. """
+
+		return self.from_int(self.to_int() & ~self.other_int(other))
+
+	def __ior__(self, other):
+		""" Set the pieces set in the other bitfield. """
+
+		self.data[:] = (self | other).data
+		return self
+
+	def copy(self):
+		""" Returns a copy of the bitfield. """
+
+		return Bitfield(self.count, self.data)
+
+	def __str__(self):
+		""" Returns the bitfield as sent in a bitfield message. """
+
+		return str(self.data)
+
+	def __eq__(self, other):
+		""" Compare with another bitfield, or the bytes of one. """
+
+		if isinstance(other, Bitfield):
+			return self.count == other.count and self.data == other.data
+		return self.data == other
+
+	def __ne__(self, other):
+		""" Compare with another bitfield, or the bytes of one. """
+
+		return not self == other
+
+	def __repr__(self):
+		""" Shows the number of pieces, and which are set. """
+
+		return "Bitfield(%d, %r)" % (self.count, str(self.data))
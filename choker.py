@@ -0,0 +1,152 @@
+# choker.py
+# Choosing which peers to upload to
+
+""" Choosing which peers to upload to. Every CHOKE_INTERVAL seconds, the
+interested peers are ranked by how fast they have been sending to us,
+or, once we are seeding, by how fast we have been sending to them, and
+the fastest few are unchoked. So our upload goes to the peers which
+give us the most back. One more peer, chosen at random every
+OPTIMISTIC_INTERVAL seconds, is unchoked whatever its rate, so that we
+find peers better than those we have, and new peers get started. """
+
+from heapq import nlargest
+from random import choice
+from time import time
+
+UPLOAD_SLOTS = 4		# Peers unchoked at once, the optimistic one included.
+CHOKE_INTERVAL = 10.0		# Seconds between choking rounds.
+OPTIMISTIC_INTERVAL = 30.0	# Seconds between optimistic unchokes.
+
+class Rates():
+	""" How fast a peer has been sending to us, and we to it. """
+
+	def __init__(self):
+		""" Start with nothing sent either way. """
+
+		self.downloaded = 0	# Bytes this round.
+		self.uploaded = 0
+		self.download_rate = 0.0	# Bytes a second.
+		self.upload_rate = 0.0
+
+	def sample(self, elapsed):
+		""" Take the rates of the round just finished, elapsed seconds
+		long, averaged with those before it. """
+
+		download = self.downloaded / elapsed
+		upload = self.uploaded / elapsed
+		self.download_rate = (self.download_rate + download) / 2
+		self.upload_rate = (self.upload_rate + upload) / 2
+		self.downloaded = self.uploaded = 0
+
+class Choker():
+	""" Chokes and unchokes peers, tit-for-tat. The Torrent tells it of
+	peers coming and going, becoming interested, and the blocks sent
+	each way, and calls tick() regularly. """
+
+	def __init__(self, slots = UPLOAD_SLOTS, interval = CHOKE_INTERVAL, \
+		optimistic_interval = OPTIMISTIC_INTERVAL):
+		""" Take the number of peers to unchoke at once, and how often to
+		choose them, and the optimistic unchoke. """
+
+		self.slots = slots
+		self.interval = interval
+		self.optimistic_interval = optimistic_interval
+
+		self.peers = {}		# Connection to its rates.
+		self.unchoked = set()
+		self.optimistic = None	# The peer unchoked whatever its rate.
+
+		self.next_round = None
+		self.next_optimistic = None
+		self.round_start = None
+
+	def add_peer(self, connection):
+		""" Start measuring a peer. It stays choked until it is chosen. """
+
+		self.peers[connection] = Rates()
+
+	def remove_peer(self, connection):
+		""" Stop measuring a peer which has gone, freeing its slot. """
+
+		del self.peers[connection]
+		self.unchoked.discard(connection)
+		if connection is self.optimistic:
+			self.optimistic = None
+
+	def downloaded(self, connection, length):
+		""" Count a block of length bytes a peer has sent us. """
+
+		self.peers[connection].downloaded += length
+
+	def uploaded(self, connection, length):
+		""" Count a block of length bytes we have sent a peer. """
+
+		self.peers[connection].uploaded += length
+
+	def interested(self, connection):
+		""" A peer wants to download from us. If a slot is free, it is
+		unchoked at once, rather than waiting for the next round. """
+
+		if connection.am_choking and len(self.unchoked) < self.slots:
+			self.unchoked.add(connection)
+			connection.send_unchoke()
+
+	def not_interested(self, connection):
+		""" A peer no longer wants to download from us, so choke it, and
+		free its slot for another. Returns true if it was unchoked. """
+
+		self.unchoked.discard(connection)
+		if connection is self.optimistic:
+			self.optimistic = None
+
+		if not connection.am_choking:
+			connection.send_choke()
+			return True
+		return False
+
+	def tick(self, seeding = False, now = None):
+		""" Run a choking round, if one is due. Returns the peers choked,
+		whose outstanding requests are dropped. """
+
+		if now is None:
+			now = time()
+
+		if self.next_round is not None and now < self.next_round:
+			return []
+		self.next_round = now + self.interval
+
+		if self.round_start is not None and now > self.round_start:
+			for rates in self.peers.values():
+				rates.sample(now - self.round_start)
+		self.round_start = now
+
+		if seeding:
+			key = lambda connection: self.peers[connection].upload_rate
+		else:
+			key = lambda connection: self.peers[connection].download_rate
+
+		# The fastest interested peers, besides the optimistic one.
+		interested = [connection for connection in self.peers \
+			if connection.peer_interested]
+		unchoke = set(nlargest(self.slots - 1, [connection for connection \
+			in interested if connection is not self.optimistic], key = key))
+
+		if self.optimistic is None or now >= self.next_optimistic or \
+			not self.optimistic.peer_interested:
+			others = [connection for connection in interested \
+				if connection not in unchoke]
+			self.optimistic = choice(others) if others else None
+			self.next_optimistic = now + self.optimistic_interval
+		if self.optimistic is not None:
+			unchoke.add(self.optimistic)
+
+		choked = []
+		for connection in self.peers:
+			if connection in unchoke and connection.am_choking:
+				connection.send_unchoke()
+			elif connection not in unchoke and not connection.am_choking:
+				connection.send_choke()
+				choked.append(connection)
+		self.unchoked = unchoke
+
+		return choked
@@ -0,0 +1,166 @@
+# dialer.py
+# Connecting to peers
+
+""" Connecting to the peers a tracker gives us, many at a time. Dials
+are non-blocking, so a dead peer only holds up its own slot, until it
+times out. Peers which fail are tried again later, waiting longer each
+time, and banned if they keep failing. """
+
+from collections import deque
+from time import time
+
+from peer import PeerConnection
+
+MAX_DIALS = 32		# Dials in flight at once.
+MAX_PEERS = 50		# Peers connected, or being dialled, at once.
+CONNECT_TIMEOUT = 10	# Seconds to connect, and get a handshake.
+RETRY_DELAY = 30	# Seconds before the first retry, doubling each time.
+MAX_RETRY_DELAY = 1800
+MAX_FAILURES = 5	# Failures in a row before a peer is banned.
+
+class Dialer():
+	""" Dials peers, keeping at most max_dials in flight, and at most
+	max_peers dialled or connected. Acts as the handler of the
+	connections it makes, passing on handshakes and messages, and the
+	closing of connected peers, to its own handler. """
+
+	def __init__(self, info_hash, peer_id, handler = None, map = None, \
+		max_dials = MAX_DIALS, max_peers = MAX_PEERS, \
+		connect_timeout = CONNECT_TIMEOUT, retry_delay = RETRY_DELAY, \
+		max_failures = MAX_FAILURES, make_limits = None):
+		""" Take the info hash and peer id to handshake with, the handler
+		to pass connected peers on to, and the map of connections for
+		peer.loop() to drive. If make_limits is given, it is called for
+		the ratelimit.Limits of each connection, as it is made. """
+
+		self.info_hash = info_hash
+		self.peer_id = peer_id
+		self.handler = handler
+		self.map = map
+		self.make_limits = make_limits
+
+		self.max_dials = max_dials
+		self.max_peers = max_peers
+		self.connect_timeout = connect_timeout
+		self.retry_delay = retry_delay
+		self.max_failures = max_failures
+
+		self.known = set()	# Every address given to us, and not banned.
+		self.waiting = deque()	# Addresses waiting to be dialled.
+		self.dialing = {}	# Address to connection, and when dialled.
+		self.connected = {}	# Address to handshaken connection.
+		self.failures = {}	# Address to failures in a row.
+		self.retry_at = {}	# Address to when it can be dialled again.
+		self.banned = set()
+
+	def add_peers(self, peers):
+		""" Add a list of IPs and ports, as from get_peers(), to be
+		dialled. Peers we already know of, or have banned, are ignored. """
+
+		for address in peers:
+			if address not in self.known and address not in self.banned:
+				self.known.add(address)
+				self.waiting.append(address)
+
+	def ban(self, address):
+		""" Never dial address again, and drop it if it is connected. """
+
+		self.banned.add(address)
+		self.known.discard(address)
+		self.retry_at.pop(address, None)
+
+		if address in self.dialing:
+			self.dialing[address][0].close()
+		elif address in self.connected:
+			self.connected[address].close()
+
+	def tick(self, now = None):
+		""" Time out slow dials, and start as many new ones as we can.
+		Call this regularly, between runs of peer.loop(). """
+
+		if now is None:
+			now = time()
+
+		expired = [connection for connection, started \
+			in self.dialing.values() if now - started >= self.connect_timeout]
+		for connection in expired:
+			connection.close()
+
+		# Peers are tried again once they have waited long enough.
+		ready = [address for address, when in self.retry_at.items() \
+			if when <= now]
+		for address in ready:
+			del self.retry_at[address]
+			self.waiting.append(address)
+
+		while self.waiting and len(self.dialing) < self.max_dials and \
+			len(self.dialing) + len(self.connected) < self.max_peers:
+			address = self.waiting.popleft()
+			if address not in self.banned:
+				self.dial(address, now)
+
+	def dial(self, address, now):
+		""" Start connecting to address. """
+
+		# The connection can fail, and be closed, before it is made.
+		self.dialing[address] = (None, now)
+		limits = self.make_limits() if self.make_limits else None
+		connection = PeerConnection(self.info_hash, self.peer_id, \
+			address = address, handler = self, map = self.map, \
+			limits = limits)
+
+		if address in self.dialing:
+			self.dialing[address] = (connection, now)
+
+	def failed(self, address):
+		""" Put off dialling address again, longer each time it fails,
+		and ban it once it has failed too many times. """
+
+		failures = self.failures.get(address, 0) + 1
+		self.failures[address] = failures
+
+		if failures >= self.max_failures:
+			self.ban(address)
+		elif address not in self.banned:
+			delay = self.retry_delay * 2 ** (failures - 1)
+			self.retry_at[address] = time() + min(delay, MAX_RETRY_DELAY)
+
+	def close(self):
+		""" Drop every peer, dialled or connected. """
+
+		for connection, started in list(self.dialing.values()):
+			if connection is not None:
+				connection.close()
+		for connection in list(self.connected.values()):
+			connection.close()
+
+	def handle_peer_handshake(self, connection):
+		""" A dial has succeeded. """
+
+		del self.dialing[connection.address]
+		self.connected[connection.address] = connection
+		self.failures.pop(connection.address, None)
+
+		if self.handler:
+			self.handler.handle_peer_handshake(connection)
+
+	def handle_peer_message(self, connection, message_id, fields):
+		""" Pass messages on to the handler. """
+
+		if self.handler:
+			self.handler.handle_peer_message(connection, message_id, fields)
+
+	def handle_peer_close(self, connection):
+		""" A dial has failed, or a connected peer has gone. """
+
+		address = connection.address
+
+		if connection.handshaken:
+			del self.connected[address]
+			if address not in self.banned:
+				self.retry_at[address] = time() + self.retry_delay
+			if self.handler:
+				self.handler.handle_peer_close(connection)
+		else:
+			self.dialing.pop(address, None)
+			self.failed(address)
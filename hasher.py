@@ -0,0 +1,554 @@
+# hasher.py
+# Hashing the pieces of torrent data
+
+from bisect import bisect_right
+from hashlib import md5, sha1
+from mmap import mmap, ACCESS_READ
+import os
+from Queue import Queue
+from threading import Thread
+
+from simpledb import Database
+from util import read_chunks, read_into
+
+def hash_pieces(stream, piece_length, workers = 1, md5_hash = None):
+	""" Given a file-like object, returns a list of the SHA-1 digest of
+	each piece read from it, and the total length read. If md5_hash is
+	given, it is updated with all of the data as well. With more than
+	one worker, pieces are hashed in parallel. """
+
+	free = make_buffers(piece_length, workers)
+	return hash_views(read_pieces(stream, piece_length, free), workers, \
+		md5_hash, free)
+
+def hash_pieces_at(reader, indices, piece_length, length, workers = 1):
+	""" The same as hash_pieces(), but only hashing the pieces with the
+	given indices, from a reader which can seek, of length bytes. """
+
+	free = make_buffers(piece_length, workers)
+	return hash_views(read_pieces_at(reader, indices, piece_length, length, \
+		free), workers, None, free)
+
+def make_buffers(piece_length, workers = 1):
+	""" Returns a queue of free piece buffers, for workers threads. """
+
+	# Two buffers a worker, so each can have its next piece waiting.
+	free = Queue()
+	for i in range(max(workers, 1) * 2):
+		free.put(bytearray(piece_length))
+
+	return free
+
+def hash_file(path, piece_length, workers = 1, md5_hash = None, \
+	use_mmap = False):
+	""" The same as hash_pieces(), given the path of a file. If use_mmap
+	is true, and the file can be mapped into memory, views of the mapped
+	file are hashed, rather than reading it a piece at a time. """
+
+	with open(path, "rb") as file:
+		mapped = None
+
+		# Only regular, non-empty, files can be mapped.
+		if use_mmap and os.path.isfile(path) and os.path.getsize(path):
+			try:
+				mapped = mmap(file.fileno(), 0, access = ACCESS_READ)
+			except (EnvironmentError, ValueError):
+				mapped = None	# Fall back to reading it.
+
+		if mapped is None:
+			return hash_pieces(file, piece_length, workers, md5_hash)
+
+		try:
+			return hash_views(map_pieces(mapped, piece_length), workers, \
+				md5_hash)
+		finally:
+			mapped.close()
+
+def hash_mapped_files(paths, lengths, piece_length, workers = 1, \
+	indices = None, md5_hashes = None):
+	""" The same as hash_pieces(), or hash_pieces_at() if indices is
+	given, for the files at paths, of the given lengths, hashed as one
+	stream of views of memory maps of them, as from map_files(). """
+
+	free = make_buffers(piece_length, workers)
+	return hash_views(map_files(paths, lengths, piece_length, free, indices, \
+		md5_hashes), workers, None, free)
+
+class HashCache():
+	""" A persistent cache of piece hashes, so that unchanged files don't
+	need hashing again each time a torrent is made of them. Each file has
+	one record, under its absolute path, holding the identity of the file
+	it was made for, that is its size, modification time and inode, the
+	hash of each piece lying within the file, by the piece's offset in
+	the file and the piece length, and the md5 hash of the file, once
+	known. A file's record is replaced when its identity changes, so
+	hashes of old versions of it don't pile up. Pieces which cross from
+	one file into the next are always hashed again. """
+
+	def __init__(self, dbname = None):
+		""" Open the cache database given by dbname, or keep the cache in
+		memory if it isn't given. """
+
+		self.db = Database(dbname)
+
+	def file_key(self, path):
+		""" Return the absolute path of the file at path, which its record
+		is kept under, and the identity of the file. """
+
+		st = os.stat(path)
+		return os.path.abspath(path), (st.st_size, st.st_mtime, st.st_ino)
+
+	def record(self, path):
+		""" Return the key and the record of the file at path. If the file
+		has changed since its record was made, the record is replaced with
+		an empty one. """
+
+		key, identity = self.file_key(path)
+		record = self.db.setdefault(key, None)
+
+		if record is None or record["identity"] != identity:
+			record = {"identity" : identity, "pieces" : {}, "md5" : None}
+			self.db[key] = record
+
+		return key, record
+
+	def hash_files(self, paths, piece_length, workers = 1, md5sum = False):
+		""" The same as hash_pieces(), given a list of paths of files to
+		hash as one stream, except that only pieces not in the cache are
+		read and hashed. Returns the piece digests, and a list of the
+		length of each file. If md5sum is true, files whose md5 hash isn't
+		in the cache are read whole, and their md5 hash found in the same
+		pass, ready for md5(). """
+
+		records = [self.record(path) for path in paths]
+		lengths = [record["identity"][0] for key, record in records]
+		length = sum(lengths)
+		count = (length + piece_length - 1) // piece_length
+
+		# Find the file, and the offset in it, of each piece lying within
+		# a single file, and the pieces each file is in.
+		piece_keys = [None] * count
+		spans = []
+		offset = 0
+		for i, file_length in enumerate(lengths):
+			spans.append(range(offset // piece_length, (offset + file_length \
+				+ piece_length - 1) // piece_length) if file_length else [])
+			for n in range((offset + piece_length - 1) // piece_length, count):
+				end = min((n + 1) * piece_length, length)
+				if end > offset + file_length:
+					break
+				piece_keys[n] = (i, n * piece_length - offset)
+			offset += file_length
+
+		digests = [None] * count
+		for n, piece_key in enumerate(piece_keys):
+			if piece_key:
+				i, offset = piece_key
+				digests[n] = records[i][1]["pieces"].get((offset, piece_length))
+
+		# Read files without an md5 hash whole, so it can be found.
+		md5_hashes = None
+		unhashed = [i for i, (key, record) in enumerate(records) \
+			if md5sum and record["md5"] is None]
+		if unhashed:
+			md5_hashes = [md5() for path in paths]
+			for i in unhashed:
+				for n in spans[i]:
+					digests[n] = None
+		missing = [n for n in range(count) if digests[n] is None]
+
+		# Hash whatever isn't in the cache, and add it.
+		reader = MultiFileReader(paths, md5_hashes, lengths)
+		try:
+			hashed, read = hash_pieces_at(reader, missing, piece_length, \
+				length, workers)
+		finally:
+			reader.close()
+
+		changed = set(unhashed)
+		for n, digest in zip(missing, hashed):
+			digests[n] = digest
+			if piece_keys[n]:
+				i, offset = piece_keys[n]
+				records[i][1]["pieces"][(offset, piece_length)] = digest
+				changed.add(i)
+
+		for i in unhashed:
+			records[i][1]["md5"] = md5_hashes[i].hexdigest()
+		for i in changed:
+			key, record = records[i]
+			self.db[key] = record
+
+		return digests, lengths
+
+	def md5(self, path):
+		""" Return the md5 hex digest of the file at path, reading it only
+		if it isn't in the cache. """
+
+		key, record = self.record(path)
+
+		if record["md5"] is None:
+			md5_hash = md5()
+			with open(path, "rb") as file:
+				for chunk in read_chunks(file, 524288):
+					md5_hash.update(chunk)
+			record["md5"] = md5_hash.hexdigest()
+			self.db[key] = record
+
+		return record["md5"]
+
+class MultiFileReader():
+	""" A file-like object, reading a list of files one after the other,
+	as though they were one file. Used to hash multi-file torrents, where
+	pieces cross from one file into the next. """
+
+	def __init__(self, paths, md5_hashes = None, expected = None):
+		""" Take the paths of the files, and optionally an md5 hash to
+		update with each one. If the expected length of each file is
+		given, longer files are cut short, and missing or short files
+		are read as zeros, so that pieces always line up. """
+
+		self.paths = paths
+		self.md5_hashes = md5_hashes
+		self.expected = expected
+		self.index = 0		# The index of the file being read.
+		self.file = None
+		self.missing = False	# Whether the current file can't be opened.
+		self.lengths = [0] * len(paths)	# The length read of each file.
+
+	def readinto(self, view):
+		""" Read into view from the current file, moving on to the next
+		file at the end of each one. Returns the number of bytes read,
+		which is zero once every file has been read. """
+
+		while self.index < len(self.paths):
+			if self.expected is None:
+				want = view
+			else:
+				want = view[:self.expected[self.index] - self.lengths[self.index]]
+
+			if self.file is None and not self.missing and len(want):
+				try:
+					self.file = open(self.paths[self.index], "rb")
+				except EnvironmentError:
+					if self.expected is None:
+						raise
+					self.missing = True
+
+			read = self.file.readinto(want) if self.file is not None else 0
+
+			# Pad out missing or short files, when we know their length.
+			if not read and len(want) and self.expected is not None:
+				read = len(want)
+				want[:] = bytearray(read)
+
+			if read:
+				self.lengths[self.index] += read
+				if self.md5_hashes is not None:
+					self.md5_hashes[self.index].update(view[:read])
+				return read
+
+			self.close()
+			self.missing = False
+			self.index += 1
+
+		return 0
+
+	def seek(self, offset):
+		""" Move to offset in the files, as though they were one file.
+		Only possible if the expected length of each file was given. """
+
+		self.close()
+		self.missing = False
+
+		# Find the file the offset is in, and the offset within it.
+		self.index = 0
+		while self.index < len(self.paths) and \
+			offset >= self.expected[self.index]:
+			offset -= self.expected[self.index]
+			self.index += 1
+
+		self.lengths = self.expected[:self.index] + \
+			[0] * (len(self.paths) - self.index)
+		if self.index == len(self.paths) or offset == 0:
+			return
+
+		try:
+			self.file = open(self.paths[self.index], "rb")
+			self.file.seek(offset)
+		except EnvironmentError:
+			self.close()
+			self.missing = True
+		self.lengths[self.index] = offset
+
+	def close(self):
+		""" Close the current file. """
+
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+def read_pieces(stream, piece_length, free):
+	""" Yields a view of each piece read from stream, and the buffer it
+	was read into, taking buffers from the free queue. The buffer must
+	be put back on the queue once the piece is finished with. """
+
+	while True:
+		buf = free.get()
+		size = read_into(stream, memoryview(buf))
+		if size == 0:
+			return
+
+		yield memoryview(buf)[:size], buf
+		if size < piece_length:
+			return
+
+def read_pieces_at(reader, indices, piece_length, length, free):
+	""" The same as read_pieces(), but only reading the pieces with the
+	given indices, from a reader which can seek, of length bytes. """
+
+	position = None		# Where the reader is, after the last piece.
+	for n in indices:
+		buf = free.get()
+		size = min(piece_length, length - n * piece_length)
+
+		# Runs of pieces next to each other are read straight through.
+		if position != n * piece_length:
+			reader.seek(n * piece_length)
+		size = read_into(reader, memoryview(buf)[:size])
+		position = n * piece_length + size
+
+		yield memoryview(buf)[:size], buf
+
+def map_pieces(mapped, piece_length):
+	""" Yields a view of each piece of a memory mapped file, without
+	copying. There's no buffer to give back, so it is always None. """
+
+	for start in range(0, len(mapped), piece_length):
+		yield map_view(mapped, start, piece_length), None
+
+def open_mapped(path):
+	""" Returns a read only memory map of the file at path, or the file
+	itself if it can't be mapped, or None if it can't be opened. """
+
+	try:
+		file = open(path, "rb")
+	except EnvironmentError:
+		return None
+
+	# Only regular, non-empty, files can be mapped.
+	if os.path.isfile(path) and os.path.getsize(path):
+		try:
+			mapped = mmap(file.fileno(), 0, access = ACCESS_READ)
+			file.close()
+			return mapped
+		except (EnvironmentError, ValueError):
+			pass	# Fall back to reading it.
+
+	return file
+
+def read_mapped(source, offset, size):
+	""" Returns up to size bytes at offset in a source from open_mapped(),
+	which are fewer past its end, and none if it is None. """
+
+	if source is None:
+		return ""
+	elif isinstance(source, mmap):
+		return source[offset:offset + size]
+
+	source.seek(offset)
+	return source.read(size)
+
+def map_files(paths, lengths, piece_length, free, indices = None, \
+	md5_hashes = None):
+	""" The same as read_pieces(), for the files at paths, of the given
+	lengths, as one stream. Pieces lying within one file are views of a
+	memory map of it, without copying, holding a free buffer only to
+	bound how many are in use at once. Pieces crossing from one file into
+	the next are copied into their buffer, as are files which can't be
+	mapped, and missing or short files are read as zeros. If indices is
+	given, only those pieces are yielded, in order. If md5_hashes are
+	given, each is updated with the data of its file. """
+
+	starts = []
+	total = 0
+	for length in lengths:
+		starts.append(total)
+		total += length
+
+	if indices is None:
+		indices = range((total + piece_length - 1) // piece_length)
+
+	sources = {}	# The index of each file in use to its map, or itself.
+	for n in indices:
+		buf = free.get()
+		start = n * piece_length
+		size = min(piece_length, total - start)
+
+		# The index of each file in the piece, and the offset and length
+		# of its part of the piece.
+		parts = []
+		i = bisect_right(starts, start) - 1
+		position = start
+		while position < start + size:
+			part = min(starts[i] + lengths[i], start + size) - position
+			parts.append((i, position - starts[i], part))
+			position += part
+			i += 1
+
+		# Forget the files we have finished with. Maps stay open until
+		# the views of them still being hashed are gone too.
+		for i in list(sources):
+			if i < parts[0][0]:
+				source = sources.pop(i)
+				if source is not None and not isinstance(source, mmap):
+					source.close()
+		for i, offset, part in parts:
+			if i not in sources:
+				sources[i] = open_mapped(paths[i])
+
+		i, offset, part = parts[0]
+		source = sources[i]
+		if len(parts) == 1 and isinstance(source, mmap) and \
+			offset + part <= len(source):
+			view = map_view(source, offset, part)
+			if md5_hashes is not None:
+				md5_hashes[i].update(view)
+			yield view, buf
+			continue
+
+		position = 0
+		for i, offset, part in parts:
+			data = read_mapped(sources[i], offset, part)
+			buf[position:position + len(data)] = data
+			buf[position + len(data):position + part] = bytearray(part - len(data))
+			if md5_hashes is not None:
+				md5_hashes[i].update(memoryview(buf)[position:position + part])
+			position += part
+
+		yield memoryview(buf)[:size], buf
+
+	for source in sources.values():
+		if source is not None and not isinstance(source, mmap):
+			source.close()
+
+def map_view(mapped, start, size):
+	""" Returns a view of size bytes at start in a memory mapped file. """
+
+	try:
+		return memoryview(mapped)[start:start + size]
+	except TypeError:	# Python 2 mmaps only have the old buffer interface.
+		return buffer(mapped, start, size)
+
+def hash_views(pieces, workers = 1, md5_hash = None, free = None):
+	""" Given an iterable of pieces, and the buffers they are held in,
+	returns a list of the SHA-1 digest of each, and their total length.
+	Buffers are put back on the free queue once hashed. With one worker,
+	pieces read into buffers are read ahead, on another thread. """
+
+	if workers > 1:
+		return hash_views_parallel(pieces, workers, md5_hash, free)
+
+	if free is not None:
+		pieces = read_ahead(pieces)
+
+	digests = []
+	length = 0
+	for piece, buf in pieces:
+		if md5_hash is not None:
+			md5_hash.update(piece)
+		digests.append(sha1(piece).digest())
+		length += len(piece)
+
+		if buf is not None:
+			free.put(buf)
+
+	return digests, length
+
+def read_worker(pieces, ready):
+	""" Put each of pieces on ready, then None, or the error raised. """
+
+	try:
+		for piece in pieces:
+			ready.put((piece, None))
+	except Exception as e:
+		ready.put((None, e))
+	else:
+		ready.put(None)
+
+def read_ahead(pieces):
+	""" Yields the same as pieces, read on another thread, so the next
+	piece is read while this one is hashed. How far ahead it reads is
+	bounded by the free buffers the pieces are read into. """
+
+	ready = Queue()
+	thread = Thread(target = read_worker, args = (pieces, ready))
+	thread.daemon = True	# Don't wait on it if we stop early.
+	thread.start()
+
+	while True:
+		task = ready.get()
+		if task is None:
+			break
+
+		piece, error = task
+		if error is not None:
+			raise error
+		yield piece
+
+	thread.join()
+
+# Parallel hashing. Pieces are read, or mapped, in order, and each one is
+# handed to a worker thread to hash. hashlib lets go of the GIL while it
+# hashes, so threads are enough to keep every core busy, without copying
+# pieces between processes. Workers put each digest in its place in the
+# list, and give the buffer back to be read into again, so memory is
+# bounded by the number of buffers, however big the data is.
+
+def hash_worker(tasks, free, digests, errors):
+	""" Hash pieces from tasks, until told to stop with None. """
+
+	while True:
+		task = tasks.get()
+		if task is None:
+			return
+
+		index, piece, buf = task
+		try:
+			digests[index] = sha1(piece).digest()
+		except Exception as e:
+			errors.append(e)
+
+		if buf is not None:
+			free.put(buf)
+
+def hash_views_parallel(pieces, workers, md5_hash = None, free = None):
+	""" The same as hash_views(), hashing pieces on workers threads. """
+
+	tasks = Queue()
+	digests = []
+	errors = []
+
+	threads = [Thread(target = hash_worker, \
+		args = (tasks, free, digests, errors)) for i in range(workers)]
+	for thread in threads:
+		thread.start()
+
+	length = 0
+	try:
+		for piece, buf in pieces:
+			if md5_hash is not None:
+				md5_hash.update(piece)
+			digests.append(None)
+			tasks.put((len(digests) - 1, piece, buf))
+			length += len(piece)
+	finally:
+		for thread in threads:
+			tasks.put(None)
+		for thread in threads:
+			thread.join()
+
+	if errors:
+		raise errors[0]
+
+	return digests, length
@@ -0,0 +1,376 @@
+# peer.py
+# The peer wire protocol
+
+""" Connections to peers, speaking the peer wire protocol. Each
+PeerConnection is an asynchat channel, so any number of them can be
+driven from one thread by loop(). Messages are framed by their length
+prefix, and passed, decoded, to a handler. """
+
+# Note: Peer wire protocol specification:
+# http://www.bittorrent.org/beps/bep_0003.html#peer-protocol
+
+import asynchat
+import asyncore
+from logging import exception, warning
+import socket
+import sys
+from struct import error as StructError, pack, unpack
+
+PROTOCOL_ID = "BitTorrent protocol"
+HANDSHAKE_LENGTH = 49 + len(PROTOCOL_ID)
+
+# Message ids
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+
+# The largest message we accept, a piece message of a 128 KiB block, the
+# largest any client asks for, with its header. Blocks are usually 16 KiB.
+MAX_MESSAGE_LENGTH = 131072 + 13
+
+class PeerError(Exception):
+	""" Raised if a peer breaks the protocol. """
+
+	def __init__(self, value, data):
+		""" Takes information of the error. """
+
+		self.value = value
+		self.data = data
+
+	def __str__(self):
+		""" Pretty-prints the information. """
+
+		return repr(self.value + " : " + str(self.data))
+
+def generate_handshake(info_hash, peer_id):
+	""" Returns a handshake. """
+
+	protocol_id = PROTOCOL_ID
+	len_id = chr(len(protocol_id))
+	reserved = "\x00" * 8
+
+	return len_id + protocol_id + reserved + info_hash + peer_id
+
+def decode_handshake(handshake):
+	""" Given a handshake, returns the info hash and peer id in it. """
+
+	if len(handshake) != HANDSHAKE_LENGTH or \
+		handshake[:20] != chr(len(PROTOCOL_ID)) + PROTOCOL_ID:
+		raise PeerError("Malformed handshake", handshake)
+
+	return handshake[28:48], handshake[48:68]
+
+def make_message(message_id, payload = ""):
+	""" Returns a length prefixed message, given its id and payload. """
+
+	return pack(">IB", len(payload) + 1, message_id) + payload
+
+def make_keep_alive():
+	""" Returns a keep alive message. """
+
+	return pack(">I", 0)
+
+def make_have(index):
+	""" Returns a have message, for the piece index. """
+
+	return make_message(HAVE, pack(">I", index))
+
+def make_bitfield(bitfield):
+	""" Returns a bitfield message, given the bitfield. """
+
+	return make_message(BITFIELD, str(bitfield))
+
+def make_request(index, begin, length):
+	""" Returns a request message, for length bytes of piece index,
+	starting at begin. """
+
+	return make_message(REQUEST, pack(">III", index, begin, length))
+
+def make_piece(index, begin, block):
+	""" Returns a piece message, holding a block of piece index,
+	starting at begin. """
+
+	return make_message(PIECE, pack(">II", index, begin) + block)
+
+def make_cancel(index, begin, length):
+	""" Returns a cancel message, for a block that was requested. """
+
+	return make_message(CANCEL, pack(">III", index, begin, length))
+
+def decode_message(message):
+	""" Given a message, without its length prefix, returns its id, and a
+	tuple of its fields. """
+
+	message_id = ord(message[0])
+	payload = message[1:]
+
+	try:
+		if message_id in (CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED):
+			fields = ()
+		elif message_id == HAVE:
+			fields = unpack(">I", payload)
+		elif message_id == BITFIELD:
+			fields = (payload,)
+		elif message_id in (REQUEST, CANCEL):
+			fields = unpack(">III", payload)
+		elif message_id == PIECE:
+			fields = unpack(">II", payload[:8]) + (payload[8:],)
+		elif message_id == PORT:
+			fields = unpack(">H", payload)
+		else:
+			raise PeerError("Unknown message id", message_id)
+	except StructError:
+		raise PeerError("Malformed message", message[:32])
+
+	return message_id, fields
+
+class PeerConnection(asynchat.async_chat):
+	""" A connection to a peer. The handshake is sent as soon as we are
+	connected, then each message is read by its length prefix. If given,
+	the handler's handle_peer_handshake(), handle_peer_message() and
+	handle_peer_close() methods are called as things happen. If its
+	limits are set, to a ratelimit.Limits, reads and writes are kept
+	within them. """
+
+	ac_in_buffer_size = 65536
+
+	def __init__(self, info_hash, peer_id, address = None, sock = None, \
+		handler = None, map = None, limits = None):
+		""" Connect to the peer at address, or take the socket of a peer
+		which has connected to us. If limits is given, even the handshake
+		is kept within it. """
+
+		asynchat.async_chat.__init__(self, sock = sock, map = map)
+
+		self.info_hash = info_hash
+		self.peer_id = peer_id
+		self.handler = handler
+		self.address = address
+
+		self.remote_peer_id = None
+		self.incoming = []
+		self.handshaken = False
+		self.closed = False
+
+		# The choked and interested state, from each side.
+		self.am_choking = True
+		self.am_interested = False
+		self.peer_choking = True
+		self.peer_interested = False
+
+		self.limits = limits	# No limit on our rate, unless set.
+
+		# The first thing we read is the handshake.
+		self.set_terminator(HANDSHAKE_LENGTH)
+		self.reading = "handshake"
+
+		if sock is None:
+			self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+			try:
+				self.connect(address)
+			except socket.error:
+				self.close()	# Failed at once, rather than in the loop.
+		else:
+			self.address = sock.getpeername()
+			self.push(generate_handshake(self.info_hash, self.peer_id))
+
+	def readable(self):
+		""" Don't read while we are over our download limit. """
+
+		if self.limits is not None and not self.limits.download.ready():
+			return False
+		return asynchat.async_chat.readable(self)
+
+	def writable(self):
+		""" Don't write while we are over our upload limit. """
+
+		if self.connected and self.limits is not None and \
+			not self.limits.upload.ready():
+			return False
+		return asynchat.async_chat.writable(self)
+
+	def recv(self, buffer_size):
+		""" Read no more than our download limit allows. """
+
+		if self.limits is None:
+			return asynchat.async_chat.recv(self, buffer_size)
+
+		# Another connection may have used the tokens since we polled.
+		buffer_size = int(min(buffer_size, self.limits.download.allowance()))
+		if buffer_size < 1:
+			return ""
+
+		data = asynchat.async_chat.recv(self, buffer_size)
+		self.limits.download.consume(len(data))
+		return data
+
+	def send(self, data):
+		""" Write no more than our upload limit allows, returning the
+		number of bytes written. """
+
+		if self.limits is None:
+			return asynchat.async_chat.send(self, data)
+
+		length = int(min(len(data), self.limits.upload.allowance()))
+		if length < 1:
+			return 0
+
+		sent = asynchat.async_chat.send(self, data[:length])
+		self.limits.upload.consume(sent)
+		return sent
+
+	def handle_connect(self):
+		""" Send our handshake once we have connected. """
+
+		self.push(generate_handshake(self.info_hash, self.peer_id))
+
+	def collect_incoming_data(self, data):
+		""" Collect data, until we have a whole handshake, length prefix,
+		or message. """
+
+		self.incoming.append(data)
+
+	def found_terminator(self):
+		""" Handle a whole handshake, length prefix, or message. """
+
+		data = "".join(self.incoming)
+		self.incoming = []
+
+		if self.reading == "handshake":
+			info_hash, self.remote_peer_id = decode_handshake(data)
+			if info_hash != self.info_hash:
+				raise PeerError("Handshake for the wrong torrent", info_hash)
+
+			self.handshaken = True
+			self.expect_length()
+			if self.handler:
+				self.handler.handle_peer_handshake(self)
+
+		elif self.reading == "length":
+			length = unpack(">I", data)[0]
+			if length > MAX_MESSAGE_LENGTH:
+				raise PeerError("Message longer than maximum", length)
+			if length == 0:
+				self.expect_length()
+				return	# A keep alive, wait for the next length.
+
+			self.set_terminator(length)
+			self.reading = "message"
+
+		else:
+			self.expect_length()
+			self.handle_message(*decode_message(data))
+
+	def expect_length(self):
+		""" Wait for the length prefix of the next message. """
+
+		self.set_terminator(4)
+		self.reading = "length"
+
+	def handle_message(self, message_id, fields):
+		""" Keep track of the choked and interested state, then pass the
+		message on to the handler. """
+
+		if message_id == CHOKE:
+			self.peer_choking = True
+		elif message_id == UNCHOKE:
+			self.peer_choking = False
+		elif message_id == INTERESTED:
+			self.peer_interested = True
+		elif message_id == NOT_INTERESTED:
+			self.peer_interested = False
+
+		if self.handler:
+			self.handler.handle_peer_message(self, message_id, fields)
+
+	def handle_error(self):
+		""" Log the error, with its traceback, and drop the peer, on any
+		error. Errors of the peer's making, breaking the protocol or the
+		connection, are only warnings. """
+
+		if isinstance(sys.exc_info()[1], (PeerError, socket.error)):
+			warning("Dropping peer %s", self.address, exc_info = True)
+		else:
+			exception("Dropping peer %s", self.address)
+		self.close()
+
+	def handle_close(self):
+		""" Close the connection, and tell the handler. """
+
+		self.close()
+
+	def close(self):
+		""" Close the connection, telling the handler the first time. """
+
+		if not self.closed:
+			self.closed = True
+			asynchat.async_chat.close(self)
+			if self.handler:
+				self.handler.handle_peer_close(self)
+
+	def send_choke(self):
+		""" Choke the peer. """
+
+		self.am_choking = True
+		self.push(make_message(CHOKE))
+
+	def send_unchoke(self):
+		""" Unchoke the peer. """
+
+		self.am_choking = False
+		self.push(make_message(UNCHOKE))
+
+	def send_interested(self):
+		""" Tell the peer we are interested. """
+
+		self.am_interested = True
+		self.push(make_message(INTERESTED))
+
+	def send_not_interested(self):
+		""" Tell the peer we are not interested. """
+
+		self.am_interested = False
+		self.push(make_message(NOT_INTERESTED))
+
+	def send_have(self, index):
+		""" Tell the peer we have piece index. """
+
+		self.push(make_have(index))
+
+	def send_bitfield(self, bitfield):
+		""" Send the peer the bitfield of pieces we have. """
+
+		self.push(make_bitfield(bitfield))
+
+	def send_request(self, index, begin, length):
+		""" Request a block from the peer. """
+
+		self.push(make_request(index, begin, length))
+
+	def send_piece(self, index, begin, block):
+		""" Send the peer a block. """
+
+		self.push(make_piece(index, begin, block))
+
+	def send_cancel(self, index, begin, length):
+		""" Cancel a request sent to the peer. """
+
+		self.push(make_cancel(index, begin, length))
+
+	def send_keep_alive(self):
+		""" Send a keep alive. """
+
+		self.push(make_keep_alive())
+
+def loop(map = None, timeout = 1.0, count = None):
+	""" Drive the peer connections in map, or the default map, using poll
+	rather than select, so there is no limit on how many there are. """
+
+	asyncore.loop(timeout = timeout, use_poll = True, map = map, count = count)
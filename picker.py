@@ -0,0 +1,222 @@
+# picker.py
+# Choosing which pieces to download
+
+""" Choosing which piece to download next. The availability of each
+piece, that is how many peers have it, is counted in one array. Pieces
+we want are kept in buckets by their priority and availability, so that
+a peer having a piece moves it from one bucket to the next in constant
+time, and the rarest pieces a peer has are found without sorting. """
+
+from array import array
+from random import randrange
+
+from bitfield import Bitfield
+
+# Piece priorities. Pieces of a higher priority are always picked first,
+# and pieces with priority SKIP are never picked.
+SKIP = 0
+NORMAL = 1
+HIGH = 2
+MAX_PRIORITY = 7
+
+class PiecePicker():
+	""" Picks pieces to download from peers, rarest first, or in order
+	if sequential is true. Each peer's bitfield, as returned by
+	peer_bitfield(), is kept by the caller, and given back to
+	peer_have() and peer_lost(). """
+
+	def __init__(self, count, have = None, sequential = False):
+		""" Take the number of pieces in the torrent, and optionally a
+		Bitfield of the pieces we already have. """
+
+		self.count = count
+		self.sequential = sequential
+
+		self.availability = array("L", [0]) * count
+		self.priorities = bytearray([NORMAL]) * count
+		self.have = Bitfield(count)
+
+		# Priority to a list, by availability, of lists of wanted pieces,
+		# and the position of each wanted piece in its list.
+		self.buckets = {NORMAL : [list(range(count))]}
+		self.positions = array("L", range(count))
+
+		# No piece before the cursor is wanted, for sequential picking.
+		self.cursor = 0
+
+		if have is not None:
+			for n in have:
+				self.got_piece(n)
+
+	def wanted(self, index):
+		""" Returns true if we want piece index. """
+
+		return self.priorities[index] != SKIP and not self.have[index]
+
+	def count_wanted(self):
+		""" Returns the number of pieces we want. """
+
+		return sum(len(bucket) for buckets in self.buckets.values() \
+			for bucket in buckets)
+
+	def bucket(self, index):
+		""" Returns the bucket piece index belongs in. """
+
+		buckets = self.buckets.setdefault(self.priorities[index], [])
+		while len(buckets) <= self.availability[index]:
+			buckets.append([])
+
+		return buckets[self.availability[index]]
+
+	def add(self, index):
+		""" Add piece index to its bucket. """
+
+		bucket = self.bucket(index)
+		self.positions[index] = len(bucket)
+		bucket.append(index)
+
+	def remove(self, index):
+		""" Remove piece index from its bucket, moving the last piece in
+		the bucket into its place. """
+
+		bucket = self.bucket(index)
+		last = bucket.pop()
+		if last != index:
+			position = self.positions[index]
+			bucket[position] = last
+			self.positions[last] = position
+
+	def new_bitfield(self):
+		""" Returns an empty bitfield, for a peer which has no pieces. """
+
+		return Bitfield(self.count)
+
+	def peer_bitfield(self, bitfield):
+		""" Count the pieces in a peer's bitfield, as sent in a bitfield
+		message, and return it as a Bitfield for the caller to keep. A
+		bitfield of the wrong length raises a ValueError. """
+
+		pieces = Bitfield(self.count, bitfield)
+		for n in pieces:
+			self.increment(n)
+
+		return pieces
+
+	def peer_have(self, bitfield, index):
+		""" Count a piece a peer has told us it has, adding it to the
+		peer's bitfield. Pieces already in the bitfield aren't counted
+		again. """
+
+		if not bitfield[index]:
+			bitfield[index] = True
+			self.increment(index)
+
+	def peer_lost(self, bitfield):
+		""" Stop counting the pieces of a peer which has gone. """
+
+		for n in bitfield:
+			self.decrement(n)
+
+	def increment(self, index):
+		""" One more peer has piece index. """
+
+		if self.wanted(index):
+			self.remove(index)
+			self.availability[index] += 1
+			self.add(index)
+		else:
+			self.availability[index] += 1
+
+	def decrement(self, index):
+		""" One less peer has piece index. """
+
+		if self.wanted(index):
+			self.remove(index)
+			self.availability[index] -= 1
+			self.add(index)
+		else:
+			self.availability[index] -= 1
+
+	def set_priority(self, index, priority):
+		""" Set the priority of piece index, from SKIP to MAX_PRIORITY. """
+
+		if not SKIP <= priority <= MAX_PRIORITY:
+			raise ValueError("Priority out of range", priority)
+
+		if self.wanted(index):
+			self.remove(index)
+		self.priorities[index] = priority
+		if self.wanted(index):
+			self.add(index)
+
+		if priority != SKIP:
+			self.cursor = min(self.cursor, index)
+
+	def got_piece(self, index):
+		""" We have piece index, so stop picking it. """
+
+		if self.wanted(index):
+			self.remove(index)
+		self.have[index] = True
+
+	def lost_piece(self, index):
+		""" We no longer have piece index, so start picking it again. """
+
+		if self.have[index]:
+			self.have[index] = False
+			if self.wanted(index):
+				self.add(index)
+			self.cursor = min(self.cursor, index)
+
+	def pick(self, bitfield, skip = ()):
+		""" Returns the index of the piece to download next from a peer
+		with bitfield, as counted by peer_bitfield(), or None if it has
+		nothing we want. Pieces in skip, such as those already being
+		downloaded, are passed over. """
+
+		if self.sequential:
+			return self.pick_sequential(bitfield, skip)
+
+		for priority in sorted(self.buckets, reverse = True):
+			# Rarest first. The peer has been counted, so its pieces are
+			# never in the first bucket, of pieces nobody has.
+			for bucket in self.buckets[priority][1:]:
+				if not bucket:
+					continue
+
+				# Choose between equally rare pieces at random, by looking
+				# through the bucket from a random place.
+				start = randrange(len(bucket))
+				for i in xrange(start - len(bucket), start):
+					n = bucket[i]
+					if bitfield[n] and n not in skip:
+						return n
+
+		return None
+
+	def pick_sequential(self, bitfield, skip = ()):
+		""" Returns the first piece we want which the peer has, of the
+		highest priority, or None. The pieces are looked through once,
+		moving the cursor past those at the start we don't want. """
+
+		priorities = [priority for priority, buckets in self.buckets.items() \
+			if any(buckets)]
+		if not priorities:
+			return None
+		top = max(priorities)
+
+		# The first piece of the highest priority the peer has so far.
+		best = None
+		for n in xrange(self.cursor, self.count):
+			if not self.wanted(n):
+				if n == self.cursor:
+					self.cursor += 1
+				continue
+
+			if bitfield[n] and n not in skip:
+				if self.priorities[n] == top:
+					return n
+				if best is None or self.priorities[n] > self.priorities[best]:
+					best = n
+
+		return best
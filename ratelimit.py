@@ -0,0 +1,97 @@
+# ratelimit.py
+# Limiting the rate of uploads and downloads
+
+""" Limiting how fast we upload and download, with token buckets. Each
+peer connection has a bucket for each direction, whose parent is its
+torrent's bucket, whose parent in turn may be a bucket shared by every
+torrent, so that a transfer is limited by every level at once.
+
+Buckets are refilled from the clock when they are checked, rather than
+by timers. A connection whose buckets are empty says it isn't readable,
+or writable, so the peer loop doesn't poll it until they have refilled,
+and the loop's timeout bounds how long that takes to notice. """
+
+from time import time
+
+BURST_TIME = 1.0	# Seconds of transfer a bucket holds, when full.
+MIN_TRANSFER = 4096	# Bytes a bucket must hold before we read or write.
+
+class TokenBucket():
+	""" A bucket of bytes we may transfer, refilled at rate bytes a
+	second, within those of its parent, if it has one. A rate of None
+	is no limit. The time is read from clock, in seconds. """
+
+	def __init__(self, rate = None, parent = None, clock = time):
+		""" Start full. """
+
+		self.parent = parent
+		self.clock = clock
+		self.last = clock()
+		self.tokens = 0
+		self.set_rate(rate)
+		self.tokens = self.capacity
+
+	def set_rate(self, rate):
+		""" Change the rate, or remove the limit if rate is None. """
+
+		self.rate = rate
+		if rate is None:
+			self.capacity = 0
+		else:
+			self.capacity = max(rate * BURST_TIME, MIN_TRANSFER)
+		self.tokens = min(self.tokens, self.capacity)
+
+	def refill(self, now):
+		""" Add the tokens earned since the bucket was last refilled. """
+
+		if self.rate is not None and now > self.last:
+			self.tokens = min(self.capacity, \
+				self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def allowance(self, now = None):
+		""" Returns the number of bytes we may transfer now. """
+
+		if now is None:
+			now = self.clock()
+
+		self.refill(now)
+		allowance = self.tokens if self.rate is not None else float("inf")
+		if self.parent is not None:
+			allowance = min(allowance, self.parent.allowance(now))
+		return allowance
+
+	def ready(self, now = None):
+		""" Returns true if every bucket up to the top has enough tokens
+		to be worth a read or write. """
+
+		if now is None:
+			now = self.clock()
+
+		self.refill(now)
+		if self.rate is not None and self.tokens < MIN_TRANSFER:
+			return False
+		return self.parent is None or self.parent.ready(now)
+
+	def consume(self, count):
+		""" Take count bytes from this bucket, and those above it. """
+
+		if self.rate is not None:
+			self.tokens -= count
+		if self.parent is not None:
+			self.parent.consume(count)
+
+class Limits():
+	""" A download bucket and an upload bucket, limiting a peer, a
+	torrent, or every torrent. """
+
+	def __init__(self, download = None, upload = None, parent = None, \
+		clock = time):
+		""" Take the download and upload rates, in bytes a second, or None
+		for no limit, the Limits above these, if any, and the clock for
+		the buckets. """
+
+		self.download = TokenBucket(download, \
+			parent.download if parent is not None else None, clock)
+		self.upload = TokenBucket(upload, \
+			parent.upload if parent is not None else None, clock)
@@ -0,0 +1,327 @@
+# scheduler.py
+# Requesting blocks from peers
+
+""" Requesting the blocks of pieces from peers. Each peer has a pipeline
+of requests, kept deep enough to cover the bandwidth-delay product of
+its connection, so that it never sits idle waiting for our next request.
+Requests which time out, or which a peer drops by choking us, are
+requested again, from whichever peer can next take them.
+
+Once every block we want has been requested, the last few pieces would
+only come as fast as the slowest peers holding them. So in this endgame,
+blocks are requested again from every peer with room for them, and once
+a block arrives, it is cancelled with the other peers. """
+
+from math import ceil
+from time import time
+
+BLOCK_LENGTH = 16384
+
+# Pipeline depth, in requests. Each peer's pipeline covers the data it
+# sends us in one round trip, plus QUEUE_TIME seconds more, so that it
+# has requests in hand while ours are on their way.
+MIN_DEPTH = 2
+MAX_DEPTH = 250
+QUEUE_TIME = 1.0
+
+# Requests time out after four round trips, within these bounds.
+MIN_TIMEOUT = 5.0
+MAX_TIMEOUT = 60.0
+
+# Seconds over which each sample of a peer's rate is measured.
+RATE_PERIOD = 1.0
+
+class Piece():
+	""" A piece being downloaded. """
+
+	def __init__(self, index, length):
+		""" Take the index and length of the piece. """
+
+		self.index = index
+		self.length = length
+		self.data = bytearray(length)
+
+		count = (length + BLOCK_LENGTH - 1) // BLOCK_LENGTH
+		self.unrequested = list(range(count - 1, -1, -1))	# Popped in order.
+		self.have = bytearray(count)
+		self.received = 0
+
+	def block(self, n):
+		""" Returns the offset and length of block n. """
+
+		begin = n * BLOCK_LENGTH
+		return begin, min(BLOCK_LENGTH, self.length - begin)
+
+class Pipeline():
+	""" The requests outstanding to a peer, and how many to keep. """
+
+	def __init__(self):
+		""" Start with the shallowest pipeline, until we know better. """
+
+		self.requests = {}	# (index, begin, length) to when it was sent.
+		self.depth = MIN_DEPTH
+
+		self.rtt = None		# The smoothed round trip time.
+		self.min_rtt = None	# The least round trip, without queueing.
+		self.rate = 0.0		# Bytes a second.
+		self.received = 0	# Bytes since the rate was last sampled.
+		self.rate_start = None
+
+	def timeout(self):
+		""" Returns how long to wait for a request. """
+
+		if self.rtt is None:
+			return MAX_TIMEOUT
+
+		return min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.rtt * 4))
+
+	def update(self, length, sent, now):
+		""" Take the measurements of a block of length bytes, requested
+		at sent and received at now, and set the depth from them. """
+
+		rtt = now - sent
+		if self.rtt is None:
+			self.rtt = self.min_rtt = rtt
+		else:
+			self.rtt = self.rtt * 0.875 + rtt * 0.125
+			self.min_rtt = min(self.min_rtt, rtt)
+
+		if self.rate_start is None:
+			self.rate_start = sent
+		self.received += length
+		if now - self.rate_start >= RATE_PERIOD:
+			sample = self.received / (now - self.rate_start)
+			self.rate = (self.rate + sample) / 2 if self.rate else sample
+			self.received = 0
+			self.rate_start = now
+
+		# Until the rate is known, deepen the pipeline a block at a time.
+		if self.rate:
+			depth = int(ceil(self.rate * (self.min_rtt + QUEUE_TIME) / \
+				BLOCK_LENGTH))
+		else:
+			depth = self.depth + 1
+		self.depth = min(MAX_DEPTH, max(MIN_DEPTH, depth))
+
+class RequestScheduler():
+	""" Requests blocks from peers, of the pieces the picker picks. The
+	Torrent tells it of peers coming and going, choking us, and sending
+	us blocks, and asks it to fill each peer's pipeline. """
+
+	def __init__(self, picker, piece_length, length):
+		""" Take the piece picker, the piece length, and the total length
+		of the torrent. """
+
+		self.picker = picker
+		self.piece_length = piece_length
+		self.length = length
+
+		self.pieces = {}	# Index to each piece being downloaded.
+		self.finishing = set()	# Pieces downloaded, but not yet written.
+		self.peers = {}		# Connection to its pipeline.
+		self.endgame = False
+
+		# What the endgame costs us.
+		self.stats = {}
+		self.stats["duplicate requests"] = 0
+		self.stats["cancels"] = 0
+		self.stats["duplicate blocks"] = 0
+		self.stats["duplicate bytes"] = 0
+
+	def piece_size(self, index):
+		""" Returns the length of piece index, the last being short. """
+
+		return min(self.piece_length, self.length - index * self.piece_length)
+
+	def add_peer(self, connection):
+		""" Start a pipeline for a peer. """
+
+		self.peers[connection] = Pipeline()
+
+	def remove_peer(self, connection):
+		""" A peer has gone, so its requests need making again. """
+
+		pipeline = self.peers.pop(connection, None)
+		if pipeline is not None:
+			self.drop(pipeline)
+
+	def choked(self, connection):
+		""" A peer has choked us, dropping our requests. """
+
+		self.drop(self.peers[connection])
+
+	def drop(self, pipeline):
+		""" Put each of a pipeline's requests back to be made again. """
+
+		for index, begin, length in pipeline.requests:
+			self.unrequest(index, begin)
+		pipeline.requests.clear()
+
+	def unrequest(self, index, begin):
+		""" Put a block back to be requested again, unless we have it. """
+
+		piece = self.pieces.get(index)
+		n = begin // BLOCK_LENGTH
+		if piece is not None and not piece.have[n] and \
+			n not in piece.unrequested:
+			piece.unrequested.append(n)
+
+	def next_piece(self, pieces):
+		""" Returns a piece with blocks to request from a peer having
+		pieces, or None. Pieces already started are finished first. """
+
+		for piece in self.pieces.values():
+			if piece.unrequested and pieces[piece.index]:
+				return piece
+
+		index = self.picker.pick(pieces, \
+			skip = self.finishing.union(self.pieces))
+		if index is None:
+			return None
+
+		piece = self.pieces[index] = Piece(index, self.piece_size(index))
+		return piece
+
+	def fill(self, connection, pieces, now = None):
+		""" Send requests to a peer having pieces, until its pipeline is
+		full. Returns the number of requests sent. """
+
+		if now is None:
+			now = time()
+
+		pipeline = self.peers[connection]
+		if connection.peer_choking:
+			return 0
+
+		sent = 0
+		while len(pipeline.requests) < pipeline.depth:
+			piece = self.next_piece(pieces)
+			if piece is None:
+				break
+
+			begin, length = piece.block(piece.unrequested.pop())
+			pipeline.requests[(piece.index, begin, length)] = now
+			connection.send_request(piece.index, begin, length)
+			sent += 1
+
+		if len(pipeline.requests) < pipeline.depth and self.in_endgame():
+			sent += self.fill_endgame(connection, pieces, now)
+
+		return sent
+
+	def in_endgame(self):
+		""" Returns true once every block we want has been requested. """
+
+		self.endgame = bool(self.pieces) and \
+			not any(piece.unrequested for piece in self.pieces.values()) and \
+			self.picker.count_wanted() == \
+			len(self.pieces) + len(self.finishing)
+
+		return self.endgame
+
+	def fill_endgame(self, connection, pieces, now):
+		""" Fill a peer's pipeline with blocks already requested from
+		other peers. Returns the number of requests sent. """
+
+		pipeline = self.peers[connection]
+
+		sent = 0
+		for piece in self.pieces.values():
+			if not pieces[piece.index]:
+				continue
+
+			for n in range(len(piece.have)):
+				if len(pipeline.requests) >= pipeline.depth:
+					return sent
+
+				request = (piece.index,) + piece.block(n)
+				if piece.have[n] or request in pipeline.requests:
+					continue
+
+				pipeline.requests[request] = now
+				connection.send_request(*request)
+				self.stats["duplicate requests"] += 1
+				sent += 1
+
+		return sent
+
+	def cancel_others(self, connection, request):
+		""" Cancel a request with every peer but the one which sent it. """
+
+		for other, pipeline in self.peers.items():
+			if other is not connection and request in pipeline.requests:
+				del pipeline.requests[request]
+				other.send_cancel(*request)
+				self.stats["cancels"] += 1
+
+	def block_received(self, connection, index, begin, block, now = None):
+		""" Take a block sent by a peer. Returns the index and data of the
+		piece, if this was its last block, or None. Blocks we didn't ask
+		for, or already have, are ignored. A piece returned isn't picked
+		again until piece_finished() is called, once it has been checked
+		and written. """
+
+		if now is None:
+			now = time()
+
+		request = (index, begin, len(block))
+		pipeline = self.peers.get(connection)
+		sent = None
+		if pipeline is not None:
+			sent = pipeline.requests.pop(request, None)
+
+		piece = self.pieces.get(index)
+		n = begin // BLOCK_LENGTH
+		if piece is not None and (begin % BLOCK_LENGTH or \
+			n >= len(piece.have) or len(block) != piece.block(n)[1]):
+			return None
+		if piece is None or piece.have[n]:
+			# Another peer beat this one to it, perhaps crossing a cancel.
+			self.stats["duplicate blocks"] += 1
+			self.stats["duplicate bytes"] += len(block)
+			return None
+
+		if sent is not None:
+			pipeline.update(len(block), sent, now)
+		elif n in piece.unrequested:
+			piece.unrequested.remove(n)	# Late, but still of use.
+
+		if self.endgame:
+			self.cancel_others(connection, request)
+
+		piece.data[begin:begin + len(block)] = block
+		piece.have[n] = 1
+		piece.received += 1
+
+		if piece.received < len(piece.have):
+			return None
+
+		del self.pieces[index]
+		self.finishing.add(index)
+		return index, piece.data
+
+	def piece_finished(self, index):
+		""" A piece returned by block_received() has been dealt with. If
+		it was bad, the picker still wants it, so it is picked again. """
+
+		self.finishing.discard(index)
+
+	def tick(self, now = None):
+		""" Cancel requests which have timed out, to be requested again.
+		A peer which times out has its pipeline halved. """
+
+		if now is None:
+			now = time()
+
+		for connection, pipeline in self.peers.items():
+			timeout = pipeline.timeout()
+			expired = [request for request, sent in pipeline.requests.items() \
+				if now - sent >= timeout]
+			if not expired:
+				continue
+
+			for request in expired:
+				del pipeline.requests[request]
+				self.unrequest(request[0], request[1])
+				connection.send_cancel(*request)
+			pipeline.depth = max(MIN_DEPTH, pipeline.depth // 2)
@@ -100,7 +100,12 @@ class Database():
 			return default
 		return loads(value)
 
+	def sync(self):
+		""" Write any changes out to disk. """
+
+		self.data.sync()
+
 	def __del__(self):
 		""" Sync the database. """
 
-		self.data.sync()
\ No newline at end of file
+		self.sync()
\ No newline at end of file
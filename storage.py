@@ -0,0 +1,456 @@
+# storage.py
+# Reading and writing torrent data
+
+""" Reading and writing the pieces of a torrent, in its files. All disk
+work is done on a small, fixed pool of threads, and the results handed
+back to the network loop, so that it never waits on open(), read() or
+write(). Pieces are checked against their hash from memory, before they
+are written, and written whole. Pieces read to upload are kept in a
+cache, reading a few pieces ahead on each miss.
+
+Files are kept open in a pool, rather than opened for each read or
+write, and read and written at an offset with os.pread() and
+os.pwrite(), so that disk threads never need to seek, or wait on each
+other. Where those aren't available, each file has a lock held while
+it is seeked and read or written. """
+
+from collections import OrderedDict
+import errno
+from hashlib import sha1
+import os
+from Queue import Empty, Queue
+from threading import Lock, Thread
+
+from util import to_string
+
+DISK_THREADS = 4	# Threads doing disk work.
+CACHE_PIECES = 32	# Pieces kept in the read cache.
+READ_AHEAD = 4		# Pieces read at once, when a piece isn't cached.
+MAX_OPEN_FILES = 64	# Files kept open, unless more are in use at once.
+
+# How files are allocated when a torrent starts. Sparse files take no
+# space until they are written, full files take all of it at once.
+SPARSE = "sparse"
+FULL = "full"
+
+class DiskPool():
+	""" A fixed number of threads running disk jobs. Each job's callback
+	is called with its result, and any error, by run_callbacks(), on the
+	thread which calls it, rather than on the disk thread. """
+
+	def __init__(self, workers = DISK_THREADS):
+		""" Start workers threads. """
+
+		self.jobs = Queue()
+		self.done = Queue()
+
+		self.threads = [Thread(target = self.work) for i in range(workers)]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def submit(self, function, args, callback):
+		""" Run function with args on a disk thread, then callback with
+		its result, and any error raised. """
+
+		self.jobs.put((function, args, callback))
+
+	def work(self):
+		""" Run jobs until told to stop with None. """
+
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+
+			function, args, callback = job
+			try:
+				self.done.put((callback, function(*args), None))
+			except Exception as e:
+				self.done.put((callback, None, e))
+
+	def run_callbacks(self):
+		""" Call back for every job which has finished. Returns the
+		number of callbacks made. """
+
+		count = 0
+		while True:
+			try:
+				callback, result, error = self.done.get_nowait()
+			except Empty:
+				return count
+
+			callback(result, error)
+			count += 1
+
+	def close(self):
+		""" Finish every job, stop the threads, and call back for the
+		jobs which finished. """
+
+		for thread in self.threads:
+			self.jobs.put(None)
+		for thread in self.threads:
+			thread.join()
+
+		self.run_callbacks()
+
+class OpenFile():
+	""" A file open for reading, or reading and writing, at offsets. """
+
+	def __init__(self, path, writable = False):
+		""" Open the file at path. Files opened for writing are made if
+		they are missing, along with the directories they are in. """
+
+		self.path = path
+		self.writable = writable
+		self.users = 0		# Threads using the file.
+		self.retired = False	# Whether to close it once it is unused.
+		self.lock = Lock()	# Held while seeking, without os.pread().
+
+		flags = getattr(os, "O_BINARY", 0)
+		if writable:
+			flags |= os.O_RDWR | os.O_CREAT
+		else:
+			flags |= os.O_RDONLY
+
+		try:
+			self.fd = os.open(path, flags, 0o666)
+		except EnvironmentError as e:
+			directory = os.path.dirname(path)
+			if not writable or e.errno != errno.ENOENT or not directory:
+				raise
+
+			try:
+				os.makedirs(directory)
+			except EnvironmentError:	# Made by another thread.
+				if not os.path.isdir(directory):
+					raise
+			self.fd = os.open(path, flags, 0o666)
+
+	def read_into(self, view, offset):
+		""" Fill view from offset in the file, returning the number of
+		bytes read, which is only short at the end of the file. """
+
+		size = 0
+		while size < len(view):
+			if hasattr(os, "pread"):
+				data = os.pread(self.fd, len(view) - size, offset + size)
+			else:
+				with self.lock:
+					os.lseek(self.fd, offset + size, os.SEEK_SET)
+					data = os.read(self.fd, len(view) - size)
+
+			if not data:
+				break
+			view[size:size + len(data)] = data
+			size += len(data)
+
+		return size
+
+	def write(self, view, offset):
+		""" Write all of view at offset in the file. """
+
+		while len(view):
+			if hasattr(os, "pwrite"):
+				written = os.pwrite(self.fd, view, offset)
+			else:
+				with self.lock:
+					os.lseek(self.fd, offset, os.SEEK_SET)
+					written = os.write(self.fd, view)
+
+			view = view[written:]
+			offset += written
+
+	def close(self):
+		""" Close the file. """
+
+		os.close(self.fd)
+
+class FilePool():
+	""" A pool of open files, shared by the disk threads. Once more than
+	max_open files are open, the least recently used are closed, but
+	never while a thread is using them. """
+
+	def __init__(self, max_open = MAX_OPEN_FILES):
+		""" Start with no files open. """
+
+		self.max_open = max_open
+		self.files = OrderedDict()	# Path to open file, oldest first.
+		self.lock = Lock()
+
+	def acquire(self, path, writable = False):
+		""" Returns the open file at path, opening it if need be. It must
+		be given back with release() once finished with. """
+
+		with self.lock:
+			file = self.files.get(path)
+			if file is not None and (file.writable or not writable):
+				return self.use(path, file)
+
+		# Open the file without the lock, so the other threads aren't held
+		# up by a slow open. A file open for reading is opened again for
+		# writing.
+		opened = OpenFile(path, writable)
+
+		with self.lock:
+			file = self.files.get(path)
+			if file is not None and (file.writable or not writable):
+				opened.close()		# Another thread opened it first.
+				return self.use(path, file)
+
+			if file is not None:
+				self.retire(self.files.pop(path))
+			return self.use(path, opened)
+
+	def use(self, path, file):
+		""" Mark the open file at path as in use, and the most recently
+		used, and return it. Called with the lock held. """
+
+		self.files.pop(path, None)
+		self.files[path] = file
+		file.users += 1
+
+		# Close the least recently used files nobody is using.
+		for oldest in list(self.files):
+			if len(self.files) <= self.max_open:
+				break
+			if not self.files[oldest].users:
+				self.files.pop(oldest).close()
+
+		return file
+
+	def release(self, file):
+		""" Give back a file from acquire(). """
+
+		with self.lock:
+			file.users -= 1
+			if file.retired and not file.users:
+				file.close()
+
+	def retire(self, file):
+		""" Close a file once nobody is using it. """
+
+		file.retired = True
+		if not file.users:
+			file.close()
+
+	def close(self):
+		""" Close every file, once nobody is using it. """
+
+		with self.lock:
+			for file in self.files.values():
+				self.retire(file)
+			self.files.clear()
+
+class Storage():
+	""" The data of a torrent, in one file or several, as returned by
+	torrent_files(), read and written a piece at a time. """
+
+	def __init__(self, files, piece_length, have = None, pool = None, \
+		cache_pieces = CACHE_PIECES, read_ahead = READ_AHEAD, \
+		max_open = MAX_OPEN_FILES):
+		""" Take the path and length of each file, and the piece length.
+		If given, have is the bitfield of the pieces we have, which are
+		the only pieces read ahead. At most max_open files are kept open,
+		unless more are in use at once. """
+
+		self.files = files
+		self.piece_length = piece_length
+		self.length = sum(length for path, length in files)
+		self.count = (self.length + piece_length - 1) // piece_length
+		self.have = have
+
+		self.pool = pool if pool is not None else DiskPool()
+		self.open_files = FilePool(max_open)
+		self.cache_pieces = cache_pieces
+		self.read_ahead = read_ahead
+
+		self.cache = OrderedDict()	# Piece index to data, oldest first.
+		self.loading = set()		# Pieces being read into the cache.
+		self.waiting = {}		# Piece index to reads waiting on it.
+
+	def piece_size(self, index):
+		""" Returns the length of piece index, the last being short. """
+
+		return min(self.piece_length, self.length - index * self.piece_length)
+
+	def spans(self, offset, length):
+		""" Yields the path, offset in the file, and length of each part
+		of the length bytes at offset in the torrent. """
+
+		for path, file_length in self.files:
+			if offset >= file_length:
+				offset -= file_length
+				continue
+
+			size = min(length, file_length - offset)
+			if size:
+				yield path, offset, size
+
+			length -= size
+			offset = 0
+			if not length:
+				return
+
+	def read(self, offset, length):
+		""" Returns length bytes at offset, read from the files. """
+
+		data = bytearray(length)
+		view = memoryview(data)
+
+		position = 0
+		for path, file_offset, size in self.spans(offset, length):
+			file = self.open_files.acquire(path)
+			try:
+				if file.read_into(view[position:position + size], \
+					file_offset) != size:
+					raise IOError("File shorter than expected", path)
+			finally:
+				self.open_files.release(file)
+			position += size
+
+		return data
+
+	def write(self, offset, data):
+		""" Write data at offset, to the files. Missing files, and the
+		directories they are in, are made. """
+
+		view = memoryview(data)
+
+		position = 0
+		for path, file_offset, size in self.spans(offset, len(data)):
+			file = self.open_files.acquire(path, writable = True)
+			try:
+				file.write(view[position:position + size], file_offset)
+			finally:
+				self.open_files.release(file)
+			position += size
+
+	def allocate(self, mode = SPARSE):
+		""" Make each file its full length, either as a sparse file, or
+		taking all its space on the disk, if mode is FULL. Data already
+		in the files is kept. """
+
+		for path, length in self.files:
+			file = self.open_files.acquire(path, writable = True)
+			try:
+				size = os.fstat(file.fd).st_size
+				if size >= length:
+					continue
+
+				if mode != FULL:
+					os.ftruncate(file.fd, length)
+					continue
+
+				try:
+					os.posix_fallocate(file.fd, size, length - size)
+				except (AttributeError, EnvironmentError):
+					# Not available here, so write the zeros ourselves.
+					zeros = memoryview(bytearray(1048576))
+					while size < length:
+						chunk = zeros[:min(len(zeros), length - size)]
+						file.write(chunk, size)
+						size += len(chunk)
+			finally:
+				self.open_files.release(file)
+
+	def preallocate(self, mode, callback):
+		""" Allocate the files, as allocate(), on a disk thread. """
+
+		self.pool.submit(self.allocate, (mode,), callback)
+
+	def write_piece(self, index, data, digest, callback):
+		""" Check the data of piece index against its SHA-1 digest, and
+		write it if it is good, on a disk thread. Calls back with whether
+		it was good, and any error writing it. """
+
+		def written(good, error):
+			if good and not error:
+				self.cache_piece(index, data)
+			callback(good, error)
+
+		self.pool.submit(self.check_piece, (index, data, digest), written)
+
+	def check_piece(self, index, data, digest):
+		""" Write piece index, if data matches digest. Returns whether
+		it did. """
+
+		if sha1(data).digest() != digest:
+			return False
+
+		self.write(index * self.piece_length, data)
+		return True
+
+	def read_block(self, index, begin, length, callback):
+		""" Read length bytes of piece index, starting at begin, and call
+		back with them, and any error. Cached pieces are called back at
+		once; otherwise the piece, and the few we have after it, are
+		read into the cache on a disk thread. """
+
+		if index in self.cache:
+			data = self.cache.pop(index)
+			self.cache[index] = data
+			callback(to_string(memoryview(data)[begin:begin + length]), None)
+			return
+
+		self.waiting.setdefault(index, []).append((begin, length, callback))
+		if index in self.loading:
+			return
+
+		# Read ahead, up to a piece we don't have, or already have cached.
+		count = 1
+		while count < self.read_ahead and index + count < self.count:
+			n = index + count
+			if n in self.cache or n in self.loading or \
+				(self.have is not None and not self.have[n]):
+				break
+			count += 1
+
+		pieces = range(index, index + count)
+		self.loading.update(pieces)
+
+		def read(data, error):
+			self.pieces_read(pieces, data, error)
+
+		self.pool.submit(self.read, (index * self.piece_length, \
+			sum(self.piece_size(n) for n in pieces)), read)
+
+	def pieces_read(self, pieces, data, error):
+		""" Cache the pieces read, and call back each read waiting on
+		them. """
+
+		offset = 0
+		for n in pieces:
+			self.loading.discard(n)
+			size = self.piece_size(n)
+			if not error:
+				piece = data[offset:offset + size]
+				self.cache_piece(n, piece)
+			offset += size
+
+			for begin, length, callback in self.waiting.pop(n, []):
+				if error:
+					callback(None, error)
+				else:
+					callback(to_string(memoryview(piece)[begin:begin + length]), \
+						None)
+
+	def cache_piece(self, index, data):
+		""" Add a piece to the cache, dropping the least recently used
+		pieces to make room. """
+
+		self.cache.pop(index, None)
+		self.cache[index] = data
+		while len(self.cache) > self.cache_pieces:
+			self.cache.popitem(last = False)
+
+	def run_callbacks(self):
+		""" Call back for disk work which has finished. """
+
+		return self.pool.run_callbacks()
+
+	def close(self):
+		""" Finish all disk work, and close the files. """
+
+		self.pool.close()
+		self.open_files.close()
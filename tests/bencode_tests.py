@@ -3,6 +3,7 @@
 
 import unittest
 import bencode
+from StringIO import StringIO
 
 class Walk(unittest.TestCase):
 	""" Check the function walk() works correctly. """
@@ -462,3 +463,341 @@ class Decode(unittest.TestCase):
 
 		self.n = bencode.decode("d3:key5:valuee")
 		self.assertEqual(self.n, {"key":"value"})
+
+class Decode_From(unittest.TestCase):
+	""" Check the decode_from() function works correctly. """
+
+	def test_returns_end(self):
+		""" Test that the index after the expression is returned. """
+
+		self.n = bencode.decode_from("li1eei1e")
+		self.assertEqual(self.n, ([1], 5))
+
+	def test_offset(self):
+		""" Test that decoding starts at the given index. """
+
+		self.n = bencode.decode_from("i1e4:test", 3)
+		self.assertEqual(self.n, ("test", 9))
+
+	def test_nested(self):
+		""" Test that nested expressions are decoded in one pass. """
+
+		self.n = bencode.decode_from("d3:keyl1:ad1:xi0eeee")
+		self.assertEqual(self.n, ({"key":["a", {"x":0}]}, 20))
+
+	def test_exception_on_negative_zero(self):
+		""" Test that an exception is raised on negative zero. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_from, "i-0e")
+
+	def test_exception_on_short_string(self):
+		""" Test that an exception is raised when a string runs past the
+		end of the data. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_from, "5:ab")
+
+	def test_exception_on_unterminated_list(self):
+		""" Test that an exception is raised on an unterminated list. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_from, "li1e")
+
+	def test_exception_on_integer_key(self):
+		""" Test that an exception is raised on a non-string dict key. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_from, "di1ei1ee")
+
+class Decode_Trailing(unittest.TestCase):
+	""" Check that decode() rejects data after the expression. """
+
+	def test_exception_on_trailing_data(self):
+		""" Test that an exception is raised on trailing data. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode, "i1ei2e")
+
+class Encode_To(unittest.TestCase):
+	""" Check the encode_to() function writes the same output as encode(). """
+
+	def test_bytearray(self):
+		""" Test that a bytearray is extended with the encoding. """
+
+		self.buf = bytearray()
+		bencode.encode_to({"key":[1, "a"]}, self.buf)
+		self.assertEqual(str(self.buf), "d3:keyli1e1:aee")
+
+	def test_file(self):
+		""" Test that a file-like object is written to. """
+
+		self.file = StringIO()
+		bencode.encode_to({"key":[1, "a"]}, self.file)
+		self.assertEqual(self.file.getvalue(), "d3:keyli1e1:aee")
+
+	def test_exception_on_unknown_type(self):
+		""" Test that an exception is raised on an unknown type. """
+
+		self.assertRaises(bencode.BencodeError, bencode.encode_to, \
+			[1.5], bytearray())
+
+class Bencode_Parser(unittest.TestCase):
+	""" Check the BencodeParser class decodes data fed to it in pieces. """
+
+	def setUp(self):
+		""" Make a parser. """
+
+		self.parser = bencode.BencodeParser()
+
+	def test_whole(self):
+		""" Test that a whole expression is decoded. """
+
+		self.n = self.parser.feed("d3:keyli1e1:aee")
+		self.assertEqual(self.n, [{"key":[1, "a"]}])
+
+	def test_byte_at_a_time(self):
+		""" Test that an expression fed a byte at a time is decoded once
+		it is complete, and not before. """
+
+		self.exp = "d3:keyli12e5:valueee"
+		self.n = []
+		for char in self.exp[:-1]:
+			self.n.extend(self.parser.feed(char))
+		self.assertEqual(self.n, [])
+		self.n = self.parser.feed(self.exp[-1])
+		self.assertEqual(self.n, [{"key":[12, "value"]}])
+
+	def test_multiple_values(self):
+		""" Test that several top level values are all returned. """
+
+		self.n = self.parser.feed("i1e0:le")
+		self.assertEqual(self.n, [1, "", []])
+
+	def test_exception_on_close_mid_value(self):
+		""" Test that an exception is raised when closed part way through
+		a value. """
+
+		self.parser.feed("l4:te")
+		self.assertRaises(bencode.BencodeError, self.parser.close)
+
+	def test_exception_on_integer_key(self):
+		""" Test that an exception is raised on a non-string dict key. """
+
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "di1e")
+
+	def tearDown(self):
+		""" Remove the parser. """
+
+		self.parser = None
+
+class Decode_Stream(unittest.TestCase):
+	""" Check the decode_stream() function works correctly. """
+
+	def test_small_chunks(self):
+		""" Test that a stream read in small chunks is decoded. """
+
+		self.n = bencode.decode_stream(StringIO("d3:keyl1:ai1eee"), 2)
+		self.assertEqual(self.n, {"key":["a", 1]})
+
+	def test_exception_on_empty(self):
+		""" Test that an exception is raised on an empty stream. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_stream, \
+			StringIO(""))
+
+class Decode_Lazy(unittest.TestCase):
+	""" Check the decode_lazy() function, and its proxies, work correctly. """
+
+	def setUp(self):
+		""" Lazily decode a little torrent-like dict. """
+
+		self.exp = "d8:announce3:url4:infod6:lengthi10e4:name4:testee"
+		self.n = bencode.decode_lazy(self.exp)
+
+	def test_equal(self):
+		""" Test that the lazy value is equal to the decoded value. """
+
+		self.assertEqual(self.n, bencode.decode(self.exp))
+
+	def test_item(self):
+		""" Test that an item is decoded on access. """
+
+		self.assertEqual(self.n["info"]["length"], 10)
+
+	def test_raw(self):
+		""" Test that the raw data of an item is its original data. """
+
+		self.assertEqual(self.n.raw("info"), "d6:lengthi10e4:name4:teste")
+
+	def test_raw_whole(self):
+		""" Test that the raw data of the whole dict is the expression. """
+
+		self.assertEqual(self.n.raw(), self.exp)
+
+	def test_span(self):
+		""" Test that the span of an item is correct. """
+
+		self.assertEqual(self.n.span("announce"), (11, 16))
+
+	def test_list(self):
+		""" Test that lists are decoded lazily too. """
+
+		self.n = bencode.decode_lazy("l1:ali1eee")
+		self.assertEqual(len(self.n), 2)
+		self.assertEqual(self.n.raw(1), "li1ee")
+		self.assertEqual(self.n, ["a", [1]])
+
+	def test_list_slice(self):
+		""" Test that a lazy list can be sliced, and indexed from the end,
+		as a list can. """
+
+		self.n = bencode.decode_lazy("l1:a1:b1:ce")
+		self.assertEqual(self.n[1:], ["b", "c"])
+		self.assertEqual(self.n[::-2], ["c", "a"])
+		self.assertEqual(self.n[-1], "c")
+		self.assertRaises(IndexError, self.n.__getitem__, -4)
+		self.assertRaises(IndexError, self.n.__getitem__, 3)
+
+	def test_encode(self):
+		""" Test that lazy values, and those inside them, are encoded as
+		they are in the data. """
+
+		self.assertEqual(bencode.encode(self.n), self.exp)
+		self.assertEqual(bencode.encode(self.n["info"]), \
+			"d6:lengthi10e4:name4:teste")
+		self.assertEqual(bencode.encode({"a" : bencode.decode_lazy( \
+			"l1:ai1ee")}), "d1:al1:ai1eee")
+
+	def test_exception_on_unterminated_dict(self):
+		""" Test that an exception is raised on an unterminated dict. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_lazy, "d1:ai1e")
+
+	def test_exception_on_key_without_value(self):
+		""" Test that an exception is raised on a key with no value. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode_lazy, "d1:ae")
+
+	def test_nested(self):
+		""" Test that deeply nested items are decoded, and keep their raw
+		data. """
+
+		self.exp = "l" * 100 + "i1e" + "e" * 100
+		self.n = bencode.decode_lazy(self.exp)
+		for i in range(99):
+			self.n = self.n[0]
+		self.assertEqual(self.n.raw(), "li1ee")
+		self.assertEqual(self.n, [1])
+
+	def tearDown(self):
+		""" Remove the decoded value. """
+
+		self.n = None
+
+class Buffers(unittest.TestCase):
+	""" Check that bytearrays and memoryviews can be encoded and decoded. """
+
+	def test_decode_bytearray(self):
+		""" Test that a bytearray is decoded. """
+
+		self.n = bencode.decode(bytearray("d3:key5:valuee"))
+		self.assertEqual(self.n, {"key":"value"})
+
+	def test_decode_memoryview(self):
+		""" Test that a memoryview is decoded. """
+
+		self.n = bencode.decode(memoryview("li1e4:teste"))
+		self.assertEqual(self.n, [1, "test"])
+
+	def test_encode_buffers(self):
+		""" Test that bytearrays and memoryviews are encoded as strings. """
+
+		self.n = bencode.encode([bytearray("ab"), memoryview("cde")])
+		self.assertEqual(self.n, "l2:ab3:cdee")
+		self.assertEqual(type(self.n), str)
+
+class Limits(unittest.TestCase):
+	""" Check that the decoding limits are respected. """
+
+	def test_long_flat_list(self):
+		""" Test that a list longer than the recursion limit decodes. """
+
+		self.n = bencode.decode("l" + "i1e" * 10000 + "e")
+		self.assertEqual(len(self.n), 10000)
+
+	def test_deep_nesting(self):
+		""" Test that nesting deeper than the recursion limit decodes. """
+
+		self.n = bencode.decode("l" * 10000 + "e" * 10000)
+		self.depth = 1
+		while self.n:
+			self.n = self.n[0]
+			self.depth += 1
+		self.assertEqual(self.depth, 10000)
+
+	def test_max_depth(self):
+		""" Test that an exception is raised past the maximum depth. """
+
+		self.assertEqual(bencode.decode("llee", max_depth = 2), [[]])
+		self.assertRaises(bencode.BencodeError, bencode.decode, \
+			"llleee", max_depth = 2)
+
+	def test_max_length(self):
+		""" Test that an exception is raised on data that is too long. """
+
+		self.assertRaises(bencode.BencodeError, bencode.decode, \
+			"4:test", max_length = 5)
+
+	def test_max_string(self):
+		""" Test that an exception is raised on a string that is too long. """
+
+		self.assertEqual(bencode.decode("4:test", max_string = 4), "test")
+		self.assertRaises(bencode.BencodeError, bencode.decode, \
+			"5:tests", max_string = 4)
+
+	def test_max_int_digits(self):
+		""" Test that an exception is raised on an integer with too many
+		digits. """
+
+		self.assertEqual(bencode.decode("i-999e", max_int_digits = 3), -999)
+		self.assertRaises(bencode.BencodeError, bencode.decode, \
+			"i1000e", max_int_digits = 3)
+
+	def test_parser_int_digits(self):
+		""" Test that the incremental parser doesn't collect an integer
+		with too many digits, even before its end arrives. """
+
+		self.parser = bencode.BencodeParser(max_int_digits = 3)
+		self.assertEqual(self.parser.feed("i12"), [])
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "345")
+
+	def test_parser_length_digits(self):
+		""" Test that the incremental parser doesn't collect a string length
+		with more digits than the maximum string, or than MAX_LENGTH_DIGITS
+		with no maximum, even before its end arrives. """
+
+		self.parser = bencode.BencodeParser(max_string = 100)
+		self.assertEqual(self.parser.feed("12"), [])
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "34")
+		self.parser = bencode.BencodeParser(max_string = 100)
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "0100:")
+
+		self.parser = bencode.BencodeParser()
+		for i in range(bencode.MAX_LENGTH_DIGITS):
+			self.assertEqual(self.parser.feed("1"), [])
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "1")
+
+	def test_parser_long_integer(self):
+		""" Test that an integer with no limit on its digits is collected
+		over many feeds. """
+
+		self.parser = bencode.BencodeParser()
+		self.assertEqual(self.parser.feed("i-"), [])
+		for i in range(5000):
+			self.assertEqual(self.parser.feed("12"), [])
+		self.assertEqual(self.parser.feed("e2:ab"), [-int("12" * 5000), "ab"])
+		self.parser.close()
+
+	def test_parser_limits(self):
+		""" Test that the incremental parser respects the limits. """
+
+		self.parser = bencode.BencodeParser(max_depth = 1, max_length = 8, \
+			max_string = 2)
+		self.assertEqual(self.parser.feed("l2:abe"), [["ab"]])
+		self.assertRaises(bencode.BencodeError, self.parser.feed, "ll")
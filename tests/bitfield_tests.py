@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# bitfield_tests.py -- testing sets of pieces
+
+import unittest
+import bitfield
+
+class Bitfield(unittest.TestCase):
+	""" Test that a Bitfield works correctly. """
+
+	def setUp(self):
+		""" Make a bitfield of twenty pieces, with a few set. """
+
+		self.n = bitfield.Bitfield(20)
+		for index in (0, 7, 8, 19):
+			self.n[index] = True
+
+	def test_bits(self):
+		""" Test that pieces are kept as in the bitfield message. """
+
+		self.assertEqual(self.n, "\x81\x80\x10")
+		self.assertEqual(str(self.n), "\x81\x80\x10")
+
+	def test_get_set(self):
+		""" Test that pieces are set and cleared. """
+
+		self.assertTrue(self.n[7])
+		self.assertFalse(self.n[6])
+		self.n[7] = False
+		self.assertFalse(self.n[7])
+
+	def test_out_of_range(self):
+		""" Test that an error is raised on pieces past the end. """
+
+		self.assertRaises(IndexError, self.n.__getitem__, 20)
+		self.assertRaises(IndexError, self.n.__setitem__, -1, True)
+
+	def test_iterate(self):
+		""" Test that the set pieces are found. """
+
+		self.assertEqual(list(self.n), [0, 7, 8, 19])
+		self.assertEqual(list(bitfield.Bitfield(0)), [])
+
+	def test_spare_bits(self):
+		""" Test that spare bits past the last piece are cleared. """
+
+		self.n = bitfield.Bitfield(10, "\xff\xff")
+		self.assertEqual(list(self.n), range(10))
+		self.assertEqual(self.n, "\xff\xc0")
+
+	def test_wrong_length(self):
+		""" Test that data of the wrong length is refused. """
+
+		self.assertRaises(ValueError, bitfield.Bitfield, 20, "\xff\xff")
+
+	def test_popcount(self):
+		""" Test that the set pieces are counted. """
+
+		self.assertEqual(self.n.popcount(), 4)
+		self.assertTrue(self.n.any())
+		self.assertFalse(bitfield.Bitfield(20).any())
+
+	def test_set_operations(self):
+		""" Test that bitfields are combined correctly. """
+
+		self.p = bitfield.Bitfield(20, "\xff\x00\x00")
+		self.assertEqual(list(self.n & self.p), [0, 7])
+		self.assertEqual(list(self.n - self.p), [8, 19])
+		self.assertEqual((self.n | self.p).popcount(), 10)
+
+		self.p |= self.n
+		self.assertEqual(self.p, "\xff\x80\x10")
+
+	def test_different_lengths(self):
+		""" Test that bitfields of different lengths can't be combined. """
+
+		self.assertRaises(ValueError, self.n.__and__, bitfield.Bitfield(21))
+		self.assertRaises(ValueError, self.n.__or__, bitfield.Bitfield(21))
+		self.assertRaises(ValueError, self.n.__sub__, bitfield.Bitfield(19))
+
+	def test_copy(self):
+		""" Test that a copy is separate from the original. """
+
+		self.p = self.n.copy()
+		self.p[1] = True
+		self.assertEqual(self.n, "\x81\x80\x10")
+		self.assertNotEqual(self.p, self.n)
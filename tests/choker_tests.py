@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# choker_tests.py -- testing choosing peers to upload to
+
+import unittest
+import choker
+
+class Connection():
+	""" A connection which records whether we are choking it. """
+
+	def __init__(self, interested = True):
+		""" Start choked, and interested unless told otherwise. """
+
+		self.am_choking = True
+		self.peer_interested = interested
+
+	def send_choke(self):
+		""" Record the choke. """
+
+		self.am_choking = True
+
+	def send_unchoke(self):
+		""" Record the unchoke. """
+
+		self.am_choking = False
+
+class Choker(unittest.TestCase):
+	""" Test that the Choker unchokes the right peers. """
+
+	def setUp(self):
+		""" Make a choker of three slots, and six peers, each sending us
+		faster than the last. """
+
+		self.c = choker.Choker(slots = 3)
+		self.c.tick(now = 0)
+		self.n = [Connection() for i in range(6)]
+		for connection in self.n:
+			self.c.add_peer(connection)
+
+		for i, connection in enumerate(self.n):
+			self.c.downloaded(connection, i * 1000)
+			self.c.uploaded(connection, (5 - i) * 1000)
+
+	def unchoked(self):
+		""" Returns the indices of the unchoked peers. """
+
+		return set(i for i, connection in enumerate(self.n) \
+			if not connection.am_choking)
+
+	def test_fastest(self):
+		""" Test that the fastest peers, and one more, are unchoked. """
+
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.p = self.unchoked()
+		self.assertEqual(len(self.p), 3)
+		self.assertTrue(set([4, 5]) <= self.p)
+
+	def test_seeding(self):
+		""" Test that peers are ranked by upload rate when seeding. """
+
+		self.c.tick(seeding = True, now = choker.CHOKE_INTERVAL)
+		self.assertTrue(set([0, 1]) <= self.unchoked())
+
+	def test_uninterested(self):
+		""" Test that peers which aren't interested stay choked. """
+
+		self.n[5].peer_interested = False
+		self.n[4].peer_interested = False
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.assertTrue(set([2, 3]) <= self.unchoked())
+		self.assertFalse(set([4, 5]) & self.unchoked())
+
+	def test_choked_returned(self):
+		""" Test that the peers choked by a round are returned. """
+
+		for connection in self.n[:3]:
+			connection.send_unchoke()
+		self.n[0].peer_interested = False
+		self.p = self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.assertTrue(self.n[0] in self.p)
+		self.assertEqual(set(self.p), set(connection for connection \
+			in self.n if connection.am_choking and connection in self.n[:3]))
+
+	def test_not_due(self):
+		""" Test that nothing changes between rounds. """
+
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.p = self.unchoked()
+		self.n[5].peer_interested = False
+		self.assertEqual(self.c.tick(now = choker.CHOKE_INTERVAL + 1), [])
+		self.assertEqual(self.unchoked(), self.p)
+
+	def test_optimistic(self):
+		""" Test that the optimistic unchoke is kept between rotations,
+		and is moved around the slower peers. """
+
+		self.p = set()
+		for i in range(1, 300):
+			optimistic = self.c.optimistic
+			self.c.tick(now = i * choker.CHOKE_INTERVAL)
+			if (i - 1) % 3:
+				self.assertTrue(self.c.optimistic is optimistic)
+			self.p.add(self.n.index(self.c.optimistic))
+		self.assertEqual(self.p, set([0, 1, 2, 3]))
+
+	def test_interested(self):
+		""" Test that an interested peer is unchoked at once, while a
+		slot is free. """
+
+		self.c.interested(self.n[0])
+		self.assertFalse(self.n[0].am_choking)
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.c.interested(self.n[0])
+		self.assertEqual(len(self.unchoked()), 3)
+
+	def test_peer_lost(self):
+		""" Test that a peer which has gone frees its slot. """
+
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.c.remove_peer(self.c.optimistic)
+		self.assertEqual(self.c.optimistic, None)
+		self.assertEqual(len(self.c.unchoked), 2)
+
+	def test_not_interested(self):
+		""" Test that a peer which stops being interested is choked at
+		once, freeing its slot. """
+
+		self.c.tick(now = choker.CHOKE_INTERVAL)
+		self.p = self.c.optimistic
+		self.p.peer_interested = False
+		self.assertTrue(self.c.not_interested(self.p))
+		self.assertTrue(self.p.am_choking)
+		self.assertEqual(self.c.optimistic, None)
+		self.assertEqual(len(self.c.unchoked), 2)
+		self.assertFalse(self.c.not_interested(self.p))
+
+		self.c.interested(self.n[0])
+		self.assertEqual(len(self.c.unchoked), 3)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# dialer_tests.py -- testing connecting to peers
+
+import unittest
+import dialer
+import peer
+import ratelimit
+import socket
+
+def listener():
+	""" Returns a listening socket, which never accepts, and its address. """
+
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind(("127.0.0.1", 0))
+	sock.listen(5)
+	return sock, sock.getsockname()
+
+def closed_address():
+	""" Returns an address with nothing listening on it. """
+
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind(("127.0.0.1", 0))
+	address = sock.getsockname()
+	sock.close()
+	return address
+
+class Dialer(unittest.TestCase):
+	""" Test that the Dialer dials, times out, and backs off correctly. """
+
+	def setUp(self):
+		""" Make a dialer, and some listeners to dial. """
+
+		self.map = {}
+		self.d = dialer.Dialer("i" * 20, "a" * 20, map = self.map, \
+			max_dials = 2, connect_timeout = 5, retry_delay = 30, \
+			max_failures = 2)
+		self.listeners = [listener() for i in range(3)]
+
+	def test_known_peers_ignored(self):
+		""" Test that peers are only added once. """
+
+		self.p = [self.listeners[0][1]]
+		self.d.add_peers(self.p)
+		self.d.add_peers(self.p)
+		self.assertEqual(len(self.d.waiting), 1)
+
+	def test_max_dials(self):
+		""" Test that no more than max_dials are in flight. """
+
+		self.d.add_peers([address for sock, address in self.listeners])
+		self.d.tick()
+		self.assertEqual(len(self.d.dialing), 2)
+		self.assertEqual(len(self.d.waiting), 1)
+
+	def test_timeout(self):
+		""" Test that a dial which gets no handshake times out, and is put
+		off until later. """
+
+		self.n = self.listeners[0][1]
+		self.d.add_peers([self.n])
+		self.d.tick()
+		peer.loop(self.map, timeout = 0.1, count = 2)
+		self.d.tick(self.d.dialing[self.n][1] + 5)
+
+		self.assertEqual(self.d.dialing, {})
+		self.assertEqual(self.d.failures[self.n], 1)
+		self.assertTrue(self.n in self.d.retry_at)
+
+	def test_refused_then_banned(self):
+		""" Test that a refused peer is retried, and banned once it has
+		failed max_failures times. """
+
+		self.n = closed_address()
+		self.d.add_peers([self.n])
+		for i in range(2):
+			self.d.tick(self.d.retry_at.get(self.n, 0))
+			peer.loop(self.map, timeout = 0.1, count = 5)
+
+		self.assertEqual(self.d.dialing, {})
+		self.assertTrue(self.n in self.d.banned)
+		self.d.add_peers([self.n])
+		self.assertEqual(len(self.d.waiting), 0)
+
+	def test_handshake(self):
+		""" Test that a peer which handshakes is connected. """
+
+		self.n = self.listeners[0][1]
+		self.d.add_peers([self.n])
+		self.d.tick()
+		sock = self.listeners[0][0].accept()[0]
+		self.p = peer.PeerConnection("i" * 20, "b" * 20, sock = sock, \
+			map = self.map)
+		peer.loop(self.map, timeout = 0.1, count = 5)
+
+		self.assertEqual(self.d.dialing, {})
+		self.assertEqual(self.d.connected[self.n].remote_peer_id, "b" * 20)
+		self.p.close()
+
+	def test_limits(self):
+		""" Test that a connection is limited from when it is dialled. """
+
+		self.d.make_limits = lambda: ratelimit.Limits(upload = 20000)
+		self.n = self.listeners[0][1]
+		self.d.add_peers([self.n])
+		self.d.tick()
+		self.assertEqual(self.d.dialing[self.n][0].limits.upload.rate, 20000)
+
+	def tearDown(self):
+		""" Drop every peer, and close the listeners. """
+
+		self.d.close()
+		for sock, address in self.listeners:
+			sock.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# hasher_tests.py -- testing the hasher module
+
+import unittest
+import hasher
+import hashlib
+import os
+from io import BytesIO
+
+class Broken():
+	""" A stream which can't be read. """
+
+	def readinto(self, view):
+		""" Fail to read. """
+
+		raise IOError("Can't read.")
+
+class Hash_Pieces(unittest.TestCase):
+	""" Test that hash_pieces() works correctly. """
+
+	def setUp(self):
+		""" Make some data a little longer than a whole number of pieces. """
+
+		self.data = "".join(chr(n % 251) for n in range(100000))
+		self.n = 16384
+		self.digests = [hashlib.sha1(self.data[i:i + self.n]).digest() \
+			for i in range(0, len(self.data), self.n)]
+
+	def test_serial(self):
+		""" Test that the pieces are hashed correctly on one thread. """
+
+		self.p = hasher.hash_pieces(BytesIO(self.data), self.n)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+
+	def test_parallel(self):
+		""" Test that the pieces are hashed in order on several threads. """
+
+		self.p = hasher.hash_pieces(BytesIO(self.data), self.n, workers = 4)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+
+	def test_md5(self):
+		""" Test that the md5 hash covers all of the data. """
+
+		self.md5 = hashlib.md5()
+		hasher.hash_pieces(BytesIO(self.data), self.n, workers = 3, \
+			md5_hash = self.md5)
+		self.assertEqual(self.md5.hexdigest(), \
+			hashlib.md5(self.data).hexdigest())
+
+	def test_empty(self):
+		""" Test that empty data has no pieces. """
+
+		self.p = hasher.hash_pieces(BytesIO(""), self.n, workers = 2)
+		self.assertEqual(self.p, ([], 0))
+
+	def test_read_error(self):
+		""" Test that an error reading ahead is raised to the caller. """
+
+		self.assertRaises(IOError, hasher.hash_pieces, Broken(), self.n)
+
+	def tearDown(self):
+		""" Remove the data. """
+
+		self.data = None
+
+class Hash_File(unittest.TestCase):
+	""" Test that hash_file() works correctly, with and without mmap. """
+
+	def setUp(self):
+		""" Write a file a little longer than a whole number of pieces. """
+
+		self.filename = "test.bin"
+		self.data = "".join(chr(n % 251) for n in range(100000))
+		with open(self.filename, "wb") as self.file:
+			self.file.write(self.data)
+		self.n = 16384
+		self.digests = [hashlib.sha1(self.data[i:i + self.n]).digest() \
+			for i in range(0, len(self.data), self.n)]
+
+	def test_read(self):
+		""" Test that a file read in pieces is hashed correctly. """
+
+		self.p = hasher.hash_file(self.filename, self.n)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+
+	def test_mmap(self):
+		""" Test that a mapped file is hashed correctly. """
+
+		self.p = hasher.hash_file(self.filename, self.n, use_mmap = True)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+
+	def test_mmap_parallel(self):
+		""" Test that a mapped file is hashed correctly on several threads. """
+
+		self.p = hasher.hash_file(self.filename, self.n, workers = 4, \
+			use_mmap = True)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+
+	def test_mmap_empty(self):
+		""" Test that an empty file falls back to being read. """
+
+		with open(self.filename, "wb") as self.file:
+			pass
+		self.p = hasher.hash_file(self.filename, self.n, use_mmap = True)
+		self.assertEqual(self.p, ([], 0))
+
+	def tearDown(self):
+		""" Remove the file. """
+
+		os.remove(self.filename)
+		self.data = None
+
+class Seek_Counter(BytesIO):
+	""" A stream which counts how often it is moved. """
+
+	seeks = 0
+
+	def seek(self, offset):
+		""" Count the seek. """
+
+		self.seeks += 1
+		return BytesIO.seek(self, offset)
+
+class Hash_Pieces_At(unittest.TestCase):
+	""" Test that hash_pieces_at() only hashes the pieces asked for. """
+
+	def test_runs(self):
+		""" Test that runs of pieces are read without seeking. """
+
+		self.data = "".join(chr(n % 251) for n in range(100000))
+		self.n = 16384
+		self.p = Seek_Counter(self.data)
+		self.assertEqual(hasher.hash_pieces_at(self.p, [0, 1, 2, 5, 6], \
+			self.n, len(self.data))[0], [hashlib.sha1(self.data[i * self.n: \
+			(i + 1) * self.n]).digest() for i in [0, 1, 2, 5, 6]])
+		self.assertEqual(self.p.seeks, 2)
+
+class Hash_Mapped_Files(unittest.TestCase):
+	""" Test that hash_mapped_files() hashes pieces across files. """
+
+	def setUp(self):
+		""" Write three files, one of them empty, whose pieces span them. """
+
+		self.filenames = ["test_a.bin", "test_b.bin", "test_c.bin"]
+		self.lengths = [40000, 0, 30000]
+		self.data = "".join(chr(n % 251) for n in range(70000))
+		with open(self.filenames[0], "wb") as self.file:
+			self.file.write(self.data[:40000])
+		with open(self.filenames[1], "wb") as self.file:
+			pass
+		with open(self.filenames[2], "wb") as self.file:
+			self.file.write(self.data[40000:])
+		self.n = 16384
+		self.digests = [hashlib.sha1(self.data[i:i + self.n]).digest() \
+			for i in range(0, len(self.data), self.n)]
+
+	def test_files(self):
+		""" Test that the pieces, and the md5 of each file, are correct. """
+
+		self.md5 = [hashlib.md5() for path in self.filenames]
+		self.p = hasher.hash_mapped_files(self.filenames, self.lengths, \
+			self.n, workers = 2, md5_hashes = self.md5)
+		self.assertEqual(self.p, (self.digests, len(self.data)))
+		self.assertEqual(self.md5[1].hexdigest(), hashlib.md5().hexdigest())
+		self.assertEqual(self.md5[2].hexdigest(), \
+			hashlib.md5(self.data[40000:]).hexdigest())
+
+	def test_indices(self):
+		""" Test that only the pieces asked for are hashed. """
+
+		self.p = hasher.hash_mapped_files(self.filenames, self.lengths, \
+			self.n, indices = [1, 4])
+		self.assertEqual(self.p[0], [self.digests[1], self.digests[4]])
+
+	def test_missing(self):
+		""" Test that a missing file is hashed as zeros. """
+
+		os.remove(self.filenames[0])
+		self.data = "\x00" * 40000 + self.data[40000:]
+		self.p = hasher.hash_mapped_files(self.filenames, self.lengths, self.n)
+		self.assertEqual(self.p[0], [hashlib.sha1(self.data[i:i + self.n]) \
+			.digest() for i in range(0, len(self.data), self.n)])
+
+	def tearDown(self):
+		""" Remove the files. """
+
+		for path in self.filenames:
+			if os.path.exists(path):
+				os.remove(path)
+		self.data = None
+
+class Hash_Cache(unittest.TestCase):
+	""" Test that the HashCache class works correctly. """
+
+	def setUp(self):
+		""" Write a file a little longer than a whole number of pieces,
+		and make an in memory cache. """
+
+		self.filename = "test.bin"
+		self.data = "".join(chr(n % 251) for n in range(100000))
+		with open(self.filename, "wb") as self.file:
+			self.file.write(self.data)
+		self.n = 16384
+		self.digests = [hashlib.sha1(self.data[i:i + self.n]).digest() \
+			for i in range(0, len(self.data), self.n)]
+		self.cache = hasher.HashCache()
+
+	def test_hash_files(self):
+		""" Test that the pieces are hashed correctly, and cached. """
+
+		self.p = self.cache.hash_files([self.filename], self.n)
+		self.assertEqual(self.p, (self.digests, [len(self.data)]))
+		self.key, self.record = self.cache.record(self.filename)
+		self.assertEqual(len(self.record["pieces"]), len(self.digests))
+
+	def test_reuse(self):
+		""" Test that cached hashes are used, rather than hashing again. """
+
+		self.cache.hash_files([self.filename], self.n)
+		self.key, self.record = self.cache.record(self.filename)
+		self.record["pieces"][(0, self.n)] = "x" * 20
+		self.cache.db[self.key] = self.record
+		self.p = self.cache.hash_files([self.filename], self.n)
+		self.assertEqual(self.p[0], ["x" * 20] + self.digests[1:])
+
+	def test_changed(self):
+		""" Test that a changed file is hashed again. """
+
+		self.cache.hash_files([self.filename], self.n)
+		with open(self.filename, "ab") as self.file:
+			self.file.write("more")
+		self.data += "more"
+		self.p = self.cache.hash_files([self.filename], self.n)
+		self.assertEqual(self.p[0][-1], \
+			hashlib.sha1(self.data[6 * self.n:]).digest())
+
+	def test_pruned(self):
+		""" Test that the hashes of an old version of a file are dropped. """
+
+		self.cache.hash_files([self.filename], self.n, md5sum = True)
+		with open(self.filename, "ab") as self.file:
+			self.file.write("more")
+		self.cache.hash_files([self.filename], 2 * self.n)
+		self.assertEqual(len(self.cache.db.keys()), 1)
+		self.key, self.record = self.cache.record(self.filename)
+		self.assertEqual(set(n for offset, n in self.record["pieces"]), \
+			set([2 * self.n]))
+		self.assertEqual(self.record["md5"], None)
+
+	def test_md5(self):
+		""" Test that the md5 hash of a file is correct. """
+
+		self.assertEqual(self.cache.md5(self.filename), \
+			hashlib.md5(self.data).hexdigest())
+
+	def test_md5_same_pass(self):
+		""" Test that the md5 hash of each file is found while hashing its
+		pieces, even those cached already. """
+
+		self.filenames = [self.filename, "test2.bin"]
+		with open(self.filenames[1], "wb") as self.file:
+			self.file.write(self.data[:50000])
+		self.cache.hash_files(self.filenames, self.n)
+		self.p = self.cache.hash_files(self.filenames, self.n, md5sum = True)
+		os.remove(self.filenames[1])
+
+		self.data += self.data[:50000]
+		self.assertEqual(self.p[0], [hashlib.sha1(self.data[i:i + self.n]) \
+			.digest() for i in range(0, len(self.data), self.n)])
+		self.assertEqual(self.cache.record(self.filename)[1]["md5"], \
+			hashlib.md5(self.data[:100000]).hexdigest())
+
+	def tearDown(self):
+		""" Remove the file, and the cache. """
+
+		os.remove(self.filename)
+		self.cache = None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# peer_tests.py -- testing the peer wire protocol
+
+import unittest
+import logging
+import peer
+import ratelimit
+import socket
+
+class Decode_Handshake(unittest.TestCase):
+	""" Test that decode_handshake() works correctly. """
+
+	def test_handshake(self):
+		""" Test that the info hash and peer id are returned. """
+
+		self.h = peer.generate_handshake("i" * 20, "p" * 20)
+		self.assertEqual(peer.decode_handshake(self.h), ("i" * 20, "p" * 20))
+
+	def test_error_on_bad_protocol(self):
+		""" Test that an error is raised on a different protocol. """
+
+		self.h = "\x13" + "x" * 19 + "\x00" * 8 + "i" * 20 + "p" * 20
+		self.assertRaises(peer.PeerError, peer.decode_handshake, self.h)
+
+class Messages(unittest.TestCase):
+	""" Test that messages are made and decoded correctly. """
+
+	def test_interested(self):
+		""" Test that an interested message is made correctly. """
+
+		self.assertEqual(peer.make_message(peer.INTERESTED), \
+			"\x00\x00\x00\x01\x02")
+
+	def test_keep_alive(self):
+		""" Test that a keep alive is made correctly. """
+
+		self.assertEqual(peer.make_keep_alive(), "\x00\x00\x00\x00")
+
+	def test_have(self):
+		""" Test that a have message round trips. """
+
+		self.m = peer.make_have(7)
+		self.assertEqual(peer.decode_message(self.m[4:]), (peer.HAVE, (7,)))
+
+	def test_request(self):
+		""" Test that a request message round trips. """
+
+		self.m = peer.make_request(1, 16384, 16384)
+		self.assertEqual(peer.decode_message(self.m[4:]), \
+			(peer.REQUEST, (1, 16384, 16384)))
+
+	def test_piece(self):
+		""" Test that a piece message round trips. """
+
+		self.m = peer.make_piece(1, 0, "block")
+		self.assertEqual(peer.decode_message(self.m[4:]), \
+			(peer.PIECE, (1, 0, "block")))
+
+	def test_bitfield(self):
+		""" Test that a bitfield message round trips. """
+
+		self.m = peer.make_bitfield(bytearray("\xf0"))
+		self.assertEqual(peer.decode_message(self.m[4:]), \
+			(peer.BITFIELD, ("\xf0",)))
+
+	def test_error_on_short_message(self):
+		""" Test that an error is raised on a truncated message. """
+
+		self.assertRaises(peer.PeerError, peer.decode_message, "\x04\x00")
+
+	def test_error_on_unknown_message(self):
+		""" Test that an error is raised on an unknown message id. """
+
+		self.assertRaises(peer.PeerError, peer.decode_message, "\x63")
+
+class Recorder():
+	""" A handler which records everything it is told. """
+
+	def __init__(self):
+		""" Start with nothing recorded. """
+
+		self.events = []
+
+	def handle_peer_handshake(self, connection):
+		""" Record the handshake. """
+
+		self.events.append(("handshake", connection.remote_peer_id))
+
+	def handle_peer_message(self, connection, message_id, fields):
+		""" Record the message. """
+
+		self.events.append((message_id, fields))
+
+	def handle_peer_close(self, connection):
+		""" Record the close. """
+
+		self.events.append(("close",))
+
+class Log_Recorder(logging.Handler):
+	""" A logging handler which records what is logged. """
+
+	def __init__(self):
+		""" Start with nothing recorded. """
+
+		logging.Handler.__init__(self)
+		self.records = []
+
+	def emit(self, record):
+		""" Record the log record. """
+
+		self.records.append(record)
+
+class Peer_Connection(unittest.TestCase):
+	""" Test that two connected PeerConnections talk to each other. """
+
+	def setUp(self):
+		""" Connect two peers over a socket pair. """
+
+		self.map = {}
+		self.a, self.b = socket.socketpair()
+		self.recorder_a = Recorder()
+		self.recorder_b = Recorder()
+		self.peer_a = peer.PeerConnection("i" * 20, "a" * 20, sock = self.a, \
+			handler = self.recorder_a, map = self.map)
+		self.peer_b = peer.PeerConnection("i" * 20, "b" * 20, sock = self.b, \
+			handler = self.recorder_b, map = self.map)
+
+	def test_handshake(self):
+		""" Test that each side gets the other's handshake. """
+
+		peer.loop(self.map, timeout = 0.1, count = 5)
+		self.assertEqual(self.recorder_a.events, [("handshake", "b" * 20)])
+		self.assertEqual(self.recorder_b.events, [("handshake", "a" * 20)])
+
+	def test_messages(self):
+		""" Test that messages arrive framed, and in order. """
+
+		self.peer_a.send_unchoke()
+		self.peer_a.send_keep_alive()
+		self.peer_a.send_piece(3, 0, "x" * 40000)
+		self.peer_a.send_have(3)
+		peer.loop(self.map, timeout = 0.1, count = 10)
+
+		self.assertEqual(self.recorder_b.events, [("handshake", "a" * 20), \
+			(peer.UNCHOKE, ()), (peer.PIECE, (3, 0, "x" * 40000)), \
+			(peer.HAVE, (3,))])
+		self.assertFalse(self.peer_b.peer_choking)
+
+	def test_rate_limit(self):
+		""" Test that a peer is kept within its upload limit, until its
+		bucket has refilled. """
+
+		self.now = 0.0
+		self.peer_a.limits = ratelimit.Limits(upload = 20000, \
+			clock = lambda: self.now)
+		self.peer_a.send_piece(3, 0, "x" * 40000)
+		peer.loop(self.map, timeout = 0.01, count = 5)
+		self.assertFalse(peer.PIECE in \
+			[event[0] for event in self.recorder_b.events])
+
+		# The handshake was sent within the limit too, so the piece takes
+		# two more refills of the bucket.
+		for i in range(2):
+			self.now += 1.0
+			peer.loop(self.map, timeout = 0.01, count = 10)
+		self.assertTrue((peer.PIECE, (3, 0, "x" * 40000)) in \
+			self.recorder_b.events)
+
+	def test_wrong_torrent(self):
+		""" Test that a handshake for another torrent drops the peer. """
+
+		self.peer_b.info_hash = "j" * 20
+		self.log = Log_Recorder()
+		logging.getLogger().addHandler(self.log)
+		try:
+			peer.loop(self.map, timeout = 0.1, count = 5)
+		finally:
+			logging.getLogger().removeHandler(self.log)
+		self.assertTrue(("close",) in self.recorder_b.events)
+
+		# The error is logged, with its traceback.
+		self.assertEqual(len(self.log.records), 1)
+		self.assertEqual(self.log.records[0].levelno, logging.WARNING)
+		self.assertEqual(self.log.records[0].exc_info[0], peer.PeerError)
+
+	def tearDown(self):
+		""" Close both peers. """
+
+		self.peer_a.close()
+		self.peer_b.close()
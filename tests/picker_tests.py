@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# picker_tests.py -- testing choosing pieces
+
+import unittest
+import picker
+
+def bitfield(count, pieces):
+	""" Returns a bitfield of count pieces, with pieces set. """
+
+	temp = bytearray((count + 7) // 8)
+	for n in pieces:
+		temp[n >> 3] |= 0x80 >> (n & 7)
+	return temp
+
+class Piece_Picker(unittest.TestCase):
+	""" Test that the PiecePicker picks pieces correctly. """
+
+	def setUp(self):
+		""" Make a picker for ten pieces, and three peers. """
+
+		self.p = picker.PiecePicker(10)
+		self.a = self.p.peer_bitfield(bitfield(10, range(10)))
+		self.b = self.p.peer_bitfield(bitfield(10, [1, 2, 3]))
+		self.c = self.p.peer_bitfield(bitfield(10, [2, 3]))
+
+	def test_availability(self):
+		""" Test that the pieces of each peer are counted. """
+
+		self.assertEqual(list(self.p.availability), \
+			[1, 2, 3, 3, 1, 1, 1, 1, 1, 1])
+
+	def test_rarest_first(self):
+		""" Test that the rarest piece a peer has is picked. """
+
+		self.assertEqual(self.p.pick(self.b), 1)
+
+	def test_random_ties(self):
+		""" Test that equally rare pieces are picked at random. """
+
+		self.n = set(self.p.pick(self.a) for i in range(100))
+		self.assertTrue(len(self.n) > 1)
+		self.assertTrue(self.n <= set([0, 4, 5, 6, 7, 8, 9]))
+
+	def test_have(self):
+		""" Test that a have message is counted once. """
+
+		self.p.peer_have(self.c, 1)
+		self.p.peer_have(self.c, 1)
+		self.assertEqual(self.p.availability[1], 3)
+		self.assertTrue(1 in self.p.buckets[picker.NORMAL][3])
+
+	def test_have_out_of_range(self):
+		""" Test that an error is raised on a piece we don't have. """
+
+		self.assertRaises(IndexError, self.p.peer_have, self.c, 10)
+
+	def test_wrong_length(self):
+		""" Test that a bitfield of the wrong length is refused. """
+
+		self.assertRaises(ValueError, self.p.peer_bitfield, bitfield(20, []))
+
+	def test_peer_lost(self):
+		""" Test that a peer which has gone is no longer counted. """
+
+		self.p.peer_lost(self.a)
+		self.assertEqual(list(self.p.availability), \
+			[0, 1, 2, 2, 0, 0, 0, 0, 0, 0])
+
+	def test_got_piece(self):
+		""" Test that pieces we have aren't picked. """
+
+		self.p.got_piece(1)
+		self.assertTrue(self.p.pick(self.b) in (2, 3))
+
+	def test_lost_piece(self):
+		""" Test that a piece we lose is picked again. """
+
+		self.p.got_piece(1)
+		self.p.lost_piece(1)
+		self.assertEqual(self.p.pick(self.b), 1)
+
+	def test_skip(self):
+		""" Test that pieces in skip aren't picked. """
+
+		self.assertEqual(self.p.pick(self.c, skip = [2, 3]), None)
+
+	def test_priority(self):
+		""" Test that pieces of higher priority are picked first. """
+
+		self.p.set_priority(3, picker.HIGH)
+		self.assertEqual(self.p.pick(self.a), 3)
+
+	def test_skip_priority(self):
+		""" Test that pieces with priority SKIP aren't picked. """
+
+		self.p.set_priority(1, picker.SKIP)
+		self.assertTrue(self.p.pick(self.b) in (2, 3))
+		self.assertRaises(ValueError, self.p.set_priority, 1, 8)
+
+	def test_sequential(self):
+		""" Test that pieces are picked in order, in sequential mode. """
+
+		self.p.sequential = True
+		self.p.got_piece(0)
+		self.assertEqual(self.p.pick(self.a), 1)
+		self.assertEqual(self.p.pick(self.c), 2)
+		self.p.set_priority(9, picker.HIGH)
+		self.assertEqual(self.p.pick(self.a), 9)
+
+	def test_sequential_priorities(self):
+		""" Test that the first piece of the highest priority a peer has is
+		picked in sequential mode, and the cursor moves past pieces we
+		don't want. """
+
+		self.p.sequential = True
+		for n in range(3):
+			self.p.got_piece(n)
+		self.p.set_priority(3, picker.SKIP)
+		self.p.set_priority(5, picker.HIGH)
+		self.p.set_priority(8, picker.MAX_PRIORITY)
+		self.assertEqual(self.p.pick(self.b), None)
+		self.assertEqual(self.p.cursor, 4)
+		self.assertEqual(self.p.pick(self.a), 8)
+		self.assertEqual(self.p.pick(self.a, skip = [8]), 5)
+		self.p.lost_piece(1)
+		self.assertEqual(self.p.cursor, 1)
+
+	def test_have_bitfield(self):
+		""" Test that pieces we start with aren't picked. """
+
+		self.p = picker.PiecePicker(10, \
+			picker.Bitfield(10, bitfield(10, range(9))))
+		self.a = self.p.peer_bitfield(bitfield(10, range(10)))
+		self.assertEqual(self.p.pick(self.a), 9)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# ratelimit_tests.py -- testing limiting transfer rates
+
+import unittest
+import ratelimit
+
+class Token_Bucket(unittest.TestCase):
+	""" Test that a TokenBucket limits transfers correctly. """
+
+	def setUp(self):
+		""" Make a bucket of 10,000 bytes a second, emptied at time 0. """
+
+		self.n = ratelimit.TokenBucket(10000)
+		self.n.refill(0)
+		self.n.consume(10000)
+
+	def test_refill(self):
+		""" Test that tokens are earned at the rate, up to a second's
+		worth. """
+
+		self.assertEqual(self.n.allowance(0.5), 5000)
+		self.assertEqual(self.n.allowance(5), 10000)
+
+	def test_ready(self):
+		""" Test that a bucket is only ready with enough tokens. """
+
+		self.assertFalse(self.n.ready(0.1))
+		self.assertTrue(self.n.ready(0.5))
+
+	def test_unlimited(self):
+		""" Test that a bucket with no rate never limits. """
+
+		self.n.set_rate(None)
+		self.n.consume(1000000)
+		self.assertEqual(self.n.allowance(0), float("inf"))
+		self.assertTrue(self.n.ready(0))
+
+	def test_parent(self):
+		""" Test that a bucket is limited by its parent, and uses its
+		parent's tokens. """
+
+		self.p = ratelimit.TokenBucket(100000, parent = self.n)
+		self.p.refill(0)
+		self.assertEqual(self.p.allowance(0.5), 5000)
+		self.p.consume(5000)
+		self.assertEqual(self.n.allowance(0.5), 0)
+		self.assertFalse(self.p.ready(0.5))
+
+	def test_clock(self):
+		""" Test that the time is read from the bucket's clock. """
+
+		self.now = 10.0
+		self.p = ratelimit.TokenBucket(10000, clock = lambda: self.now)
+		self.p.consume(10000)
+		self.assertFalse(self.p.ready())
+		self.now += 0.5
+		self.assertEqual(self.p.allowance(), 5000)
+
+class Limits(unittest.TestCase):
+	""" Test that Limits are chained in each direction. """
+
+	def test_chained(self):
+		""" Test that a peer's limits are those of every level. """
+
+		self.n = ratelimit.Limits(download = 50000)
+		self.p = ratelimit.Limits(upload = 20000, parent = \
+			ratelimit.Limits(download = 30000, parent = self.n))
+		self.p.download.refill(0)
+		self.p.upload.refill(0)
+
+		self.assertEqual(self.p.download.allowance(0), 30000)
+		self.assertEqual(self.p.upload.allowance(0), 20000)
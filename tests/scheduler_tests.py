@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# scheduler_tests.py -- testing requesting blocks
+
+import unittest
+import picker
+import scheduler
+
+class Connection():
+	""" A connection which records the requests and cancels sent. """
+
+	def __init__(self):
+		""" Start unchoked, with nothing sent. """
+
+		self.peer_choking = False
+		self.sent = []
+
+	def send_request(self, index, begin, length):
+		""" Record the request. """
+
+		self.sent.append(("request", index, begin, length))
+
+	def send_cancel(self, index, begin, length):
+		""" Record the cancel. """
+
+		self.sent.append(("cancel", index, begin, length))
+
+class Request_Scheduler(unittest.TestCase):
+	""" Test that the RequestScheduler requests blocks correctly. """
+
+	def setUp(self):
+		""" Make a scheduler for two pieces of three blocks, the last
+		piece being short, and a peer which has both. """
+
+		self.length = scheduler.BLOCK_LENGTH * 5 + 100
+		self.picker = picker.PiecePicker(2)
+		self.s = scheduler.RequestScheduler(self.picker, \
+			scheduler.BLOCK_LENGTH * 3, self.length)
+		self.pieces = self.picker.peer_bitfield(bytearray("\xc0"))
+		self.c = Connection()
+		self.s.add_peer(self.c)
+
+	def test_fill(self):
+		""" Test that the pipeline is filled to its depth. """
+
+		self.assertEqual(self.s.fill(self.c, self.pieces, 0), \
+			scheduler.MIN_DEPTH)
+		self.assertEqual(self.s.fill(self.c, self.pieces, 0), 0)
+
+	def test_choked(self):
+		""" Test that nothing is requested from a peer choking us. """
+
+		self.c.peer_choking = True
+		self.assertEqual(self.s.fill(self.c, self.pieces, 0), 0)
+
+	def test_download(self):
+		""" Test that every block is requested once, and the pieces are
+		returned once they are whole. """
+
+		self.n = []
+		self.s.fill(self.c, self.pieces, 0)
+		while self.c.sent:
+			kind, index, begin, length = self.c.sent.pop(0)
+			self.p = self.s.block_received(self.c, index, begin, \
+				"x" * length, 0.1)
+			if self.p:
+				self.n.append((self.p[0], len(self.p[1])))
+				self.picker.got_piece(self.p[0])
+				self.s.piece_finished(self.p[0])
+			self.s.fill(self.c, self.pieces, 0.1)
+
+		self.assertEqual(sorted(self.n), [(0, scheduler.BLOCK_LENGTH * 3), \
+			(1, scheduler.BLOCK_LENGTH * 2 + 100)])
+
+	def test_depth_grows(self):
+		""" Test that the pipeline deepens as blocks arrive. """
+
+		self.s.fill(self.c, self.pieces, 0)
+		kind, index, begin, length = self.c.sent[0]
+		self.s.block_received(self.c, index, begin, "x" * length, 0.1)
+		self.assertTrue(self.s.peers[self.c].depth > scheduler.MIN_DEPTH)
+
+	def test_bandwidth_delay(self):
+		""" Test that the depth covers the rate over the round trip. """
+
+		self.n = self.s.peers[self.c]
+		self.n.rate = 1048576.0
+		self.n.update(scheduler.BLOCK_LENGTH, 0, 0.5)
+		self.assertEqual(self.n.depth, \
+			int(1048576 * (0.5 + scheduler.QUEUE_TIME) / scheduler.BLOCK_LENGTH))
+
+	def test_ignored(self):
+		""" Test that blocks we didn't ask for are ignored. """
+
+		self.assertEqual(self.s.block_received(self.c, 0, 0, "x"), None)
+		self.s.fill(self.c, self.pieces, 0)
+		kind, index, begin, length = self.c.sent[0]
+		self.assertEqual(self.s.block_received(self.c, index, begin + 1, \
+			"x" * length), None)
+
+	def test_choke_drops_requests(self):
+		""" Test that requests dropped by a choke are made again. """
+
+		self.s.fill(self.c, self.pieces, 0)
+		self.n = set(self.c.sent)
+		self.s.choked(self.c)
+		self.c.sent = []
+		self.s.fill(self.c, self.pieces, 0)
+		self.assertEqual(set(self.c.sent), self.n)
+
+	def test_timeout(self):
+		""" Test that requests which time out are cancelled, and made
+		again. """
+
+		self.s.fill(self.c, self.pieces, 0)
+		self.n = self.c.sent
+		self.c.sent = []
+		self.s.tick(scheduler.MAX_TIMEOUT)
+
+		self.assertEqual(self.c.sent, [("cancel",) + r[1:] for r in self.n])
+		self.assertEqual(self.s.peers[self.c].requests, {})
+		self.c.sent = []
+		self.s.fill(self.c, self.pieces, scheduler.MAX_TIMEOUT)
+		self.assertEqual(set(self.c.sent), set(self.n))
+
+	def test_peer_lost(self):
+		""" Test that the requests of a peer which has gone are made to
+		another peer. """
+
+		self.s.fill(self.c, self.pieces, 0)
+		self.n = set(self.c.sent)
+		self.s.remove_peer(self.c)
+		self.c = Connection()
+		self.s.add_peer(self.c)
+		self.s.fill(self.c, self.pieces, 0)
+		self.assertEqual(set(self.c.sent), self.n)
+
+class Endgame(unittest.TestCase):
+	""" Test that the endgame requests blocks again, and cancels them. """
+
+	def setUp(self):
+		""" Make a scheduler for one piece of two blocks, and two peers
+		which have it, the first of which has requested every block. """
+
+		self.picker = picker.PiecePicker(1)
+		self.s = scheduler.RequestScheduler(self.picker, \
+			scheduler.BLOCK_LENGTH * 2, scheduler.BLOCK_LENGTH * 2)
+		self.pieces = self.picker.peer_bitfield(bytearray("\x80"))
+		self.a = Connection()
+		self.b = Connection()
+		self.s.add_peer(self.a)
+		self.s.add_peer(self.b)
+		self.s.fill(self.a, self.pieces, 0)
+
+	def test_not_endgame(self):
+		""" Test that there is no endgame while blocks are unrequested. """
+
+		self.picker = picker.PiecePicker(2)
+		self.s = scheduler.RequestScheduler(self.picker, \
+			scheduler.BLOCK_LENGTH * 2, scheduler.BLOCK_LENGTH * 4)
+		self.pieces = self.picker.peer_bitfield(bytearray("\xc0"))
+		self.s.add_peer(self.a)
+		self.s.fill(self.a, self.pieces, 0)
+		self.assertFalse(self.s.endgame)
+
+	def test_duplicates(self):
+		""" Test that blocks requested from one peer are requested from
+		another. """
+
+		self.s.fill(self.b, self.pieces, 0)
+		self.assertTrue(self.s.endgame)
+		self.assertEqual(set(self.b.sent), set(self.a.sent))
+		self.assertEqual(self.s.stats["duplicate requests"], 2)
+
+	def test_cancel(self):
+		""" Test that a block is cancelled with the other peers once it
+		arrives, and that a block arriving too late is counted. """
+
+		self.s.fill(self.b, self.pieces, 0)
+		self.a.sent = []
+		self.s.block_received(self.b, 0, 0, "x" * scheduler.BLOCK_LENGTH, 0)
+		self.assertEqual(self.a.sent, \
+			[("cancel", 0, 0, scheduler.BLOCK_LENGTH)])
+		self.assertEqual(self.s.stats["cancels"], 1)
+
+		self.s.block_received(self.a, 0, scheduler.BLOCK_LENGTH, \
+			"x" * scheduler.BLOCK_LENGTH, 0)
+		self.s.block_received(self.b, 0, scheduler.BLOCK_LENGTH, \
+			"x" * scheduler.BLOCK_LENGTH, 0)
+		self.assertEqual(self.s.stats["duplicate blocks"], 1)
+		self.assertEqual(self.s.peers[self.b].requests, {})
@@ -3,6 +3,7 @@
 
 import unittest
 import simpledb
+import os
 
 class Database_Tests(unittest.TestCase):
 	""" Test that the Database() class works correctly. """
@@ -53,5 +54,12 @@ class Database_Tests(unittest.TestCase):
 	def test_setdefault_default(self):
 		self.assertEqual(self.db.setdefault("no_key", "def"), "def")
 
+	def test_sync(self):
+		self.p = simpledb.Database("test.db")
+		self.p["key"] = "value"
+		self.p.sync()
+		self.assertEqual(simpledb.Database("test.db")["key"], "value")
+		os.remove("test.db")
+
 	def tearDown(self):
 		self.db = None
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# storage_tests.py -- testing reading and writing torrent data
+
+import unittest
+import storage
+import hashlib
+import os
+import shutil
+from threading import Event, Thread
+
+class Disk_Pool(unittest.TestCase):
+	""" Test that the DiskPool runs jobs, and calls back correctly. """
+
+	def setUp(self):
+		""" Start a pool of two threads. """
+
+		self.p = storage.DiskPool(2)
+		self.n = []
+
+	def test_callbacks(self):
+		""" Test that results, and errors, are called back. """
+
+		self.p.submit(len, ("abc",), lambda r, e: self.n.append((r, e)))
+		self.p.submit(int, ("x",), lambda r, e: self.n.append((r, type(e))))
+		self.p.close()
+
+		self.assertEqual(set(self.n), set([(None, ValueError), (3, None)]))
+
+	def test_not_called_back_early(self):
+		""" Test that callbacks are only made by run_callbacks(). """
+
+		self.p.submit(len, ("abc",), lambda r, e: self.n.append(r))
+		self.assertEqual(self.n, [])
+		self.p.close()
+		self.assertEqual(self.n, [3])
+
+class File_Pool(unittest.TestCase):
+	""" Test that the FilePool keeps files open correctly. """
+
+	def setUp(self):
+		""" Make a pool of two files, and a directory of files for it. """
+
+		self.directory = "test_dir"
+		self.paths = [os.path.join(self.directory, str(i)) for i in range(3)]
+		self.p = storage.FilePool(2)
+
+	def test_made(self):
+		""" Test that files opened for writing are made, along with their
+		directory. """
+
+		self.n = self.p.acquire(self.paths[0], writable = True)
+		self.n.write(memoryview(bytearray("abc")), 2)
+		self.p.release(self.n)
+
+		self.n = self.p.acquire(self.paths[0])
+		self.data = bytearray(5)
+		self.assertEqual(self.n.read_into(memoryview(self.data), 0), 5)
+		self.assertEqual(self.data, bytearray("\x00\x00abc"))
+		self.p.release(self.n)
+
+	def test_least_recently_used(self):
+		""" Test that the least recently used file is closed. """
+
+		for path in self.paths:
+			self.p.release(self.p.acquire(path, writable = True))
+		self.assertEqual(list(self.p.files), self.paths[1:])
+
+	def test_in_use(self):
+		""" Test that files in use aren't closed. """
+
+		self.n = [self.p.acquire(path, writable = True) for path in self.paths]
+		self.assertEqual(len(self.p.files), 3)
+		for file in self.n:
+			self.p.release(file)
+		self.p.release(self.p.acquire(self.paths[0]))
+		self.assertEqual(list(self.p.files), [self.paths[2], self.paths[0]])
+
+	def test_reopened_for_writing(self):
+		""" Test that a file open for reading is opened again to write. """
+
+		self.p.release(self.p.acquire(self.paths[0], writable = True))
+		self.p.close()
+		self.n = self.p.acquire(self.paths[0])
+		self.assertFalse(self.n.writable)
+		self.p.release(self.n)
+		self.assertTrue(self.p.acquire(self.paths[0], writable = True).writable)
+
+	def test_slow_open(self):
+		""" Test that a slow open doesn't hold up other threads, and that
+		of two threads opening a file at once, the one opened last is
+		closed, and the first shared. """
+
+		self.opening = Event()
+		self.go = Event()
+		self.n = []
+		open_file = storage.OpenFile
+
+		def slow_open(path, writable = False):
+			self.opening.set()
+			self.go.wait(5)
+			return open_file(path, writable)
+
+		storage.OpenFile = slow_open
+		try:
+			thread = Thread(target = lambda: self.n.append( \
+				self.p.acquire(self.paths[0], writable = True)))
+			thread.start()
+			self.opening.wait(5)
+			storage.OpenFile = open_file
+
+			self.p.release(self.p.acquire(self.paths[1], writable = True))
+			self.assertEqual(self.n, [])
+			self.m = self.p.acquire(self.paths[0], writable = True)
+		finally:
+			storage.OpenFile = open_file
+			self.go.set()
+		thread.join()
+
+		self.assertTrue(self.n[0] is self.m)
+		self.assertEqual(self.m.users, 2)
+		self.p.release(self.m)
+		self.p.release(self.m)
+
+	def tearDown(self):
+		""" Close the files, and remove the directory. """
+
+		self.p.close()
+		if os.path.exists(self.directory):
+			shutil.rmtree(self.directory)
+
+class Storage(unittest.TestCase):
+	""" Test that Storage reads and writes pieces correctly. """
+
+	def setUp(self):
+		""" Make a storage of two files, with pieces crossing them. """
+
+		self.directory = "test_dir"
+		self.data = "".join(chr(n % 251) for n in range(100000)) * 2
+		self.files = [(os.path.join(self.directory, "a.txt"), 100000), \
+			(os.path.join(self.directory, "sub", "b.txt"), 100000)]
+		self.s = storage.Storage(self.files, 32768, \
+			pool = storage.DiskPool(1), cache_pieces = 4, read_ahead = 2)
+		self.n = []
+
+	def write_pieces(self):
+		""" Write every piece, and wait for them to be written. """
+
+		for i in range(7):
+			self.p = self.data[i * 32768:i * 32768 + 32768]
+			self.s.write_piece(i, bytearray(self.p), \
+				hashlib.sha1(self.p).digest(), \
+				lambda good, error: self.n.append((good, error)))
+		self.s.close()
+
+	def test_spans(self):
+		""" Test that a piece crossing two files is split between them. """
+
+		self.assertEqual(list(self.s.spans(98304, 32768)), \
+			[(self.files[0][0], 98304, 1696), (self.files[1][0], 0, 31072)])
+
+	def test_write_pieces(self):
+		""" Test that pieces are written, making the missing files. """
+
+		self.write_pieces()
+		self.assertEqual(self.n, [(True, None)] * 7)
+		with open(self.files[1][0], "rb") as self.file:
+			self.assertEqual(self.file.read(), self.data[100000:])
+
+	def test_bad_piece(self):
+		""" Test that a piece which doesn't match its hash isn't written. """
+
+		self.s.write_piece(0, bytearray(32768), hashlib.sha1("").digest(), \
+			lambda good, error: self.n.append((good, error)))
+		self.s.close()
+		self.assertEqual(self.n, [(False, None)])
+		self.assertFalse(os.path.exists(self.files[0][0]))
+
+	def test_read_block(self):
+		""" Test that blocks are read, reading ahead into the cache. """
+
+		self.write_pieces()
+		self.s = storage.Storage(self.files, 32768, \
+			pool = storage.DiskPool(1), cache_pieces = 4, read_ahead = 2)
+		self.s.read_block(3, 1000, 16384, \
+			lambda block, error: self.n.append(block))
+		self.s.close()
+
+		self.assertEqual(self.n[-1], self.data[99304:115688])
+		self.assertEqual(sorted(self.s.cache), [3, 4])
+
+	def test_cache_hit(self):
+		""" Test that cached blocks are called back at once. """
+
+		self.write_pieces()
+		self.n = []
+		self.s.read_block(6, 0, 100, lambda block, error: self.n.append(block))
+		self.assertEqual(self.n, [self.data[196608:196708]])
+
+	def test_lru(self):
+		""" Test that the least recently used pieces leave the cache. """
+
+		self.write_pieces()
+		self.assertEqual(list(self.s.cache), [3, 4, 5, 6])
+
+	def test_read_error(self):
+		""" Test that errors reading are called back. """
+
+		self.s.read_block(0, 0, 100, lambda block, error: \
+			self.n.append((block, isinstance(error, EnvironmentError))))
+		self.s.close()
+		self.assertEqual(self.n, [(None, True)])
+
+	def test_allocate_sparse(self):
+		""" Test that files are made their full length, keeping what is
+		already in them. """
+
+		self.write_pieces()
+		with open(self.files[1][0], "r+b") as self.file:
+			self.file.truncate(50000)
+		self.s = storage.Storage(self.files, 32768, \
+			pool = storage.DiskPool(1))
+		self.s.allocate(storage.SPARSE)
+		self.s.close()
+
+		with open(self.files[1][0], "rb") as self.file:
+			self.assertEqual(self.file.read(), self.data[100000:150000] + \
+				"\x00" * 50000)
+
+	def test_allocate_full(self):
+		""" Test that missing files are allocated in full. """
+
+		self.s.preallocate(storage.FULL, \
+			lambda result, error: self.n.append(error))
+		self.s.close()
+
+		self.assertEqual(self.n, [None])
+		self.assertEqual([os.path.getsize(path) for path, length \
+			in self.files], [100000, 100000])
+
+	def tearDown(self):
+		""" Close the files, and remove the directory. """
+
+		self.s.close()
+		if os.path.exists(self.directory):
+			shutil.rmtree(self.directory)
@@ -6,6 +6,9 @@ import torrent
 import bencode
 import hashlib
 import os
+import peer
+import shutil
+import socket
 import util
 
 class Make_Info_Dict(unittest.TestCase):
@@ -38,12 +41,297 @@ class Make_Info_Dict(unittest.TestCase):
 			self.md5 = hashlib.md5(self.file.read()).hexdigest()
 		self.assertEqual(self.md5, self.d["md5sum"])
 
+	def test_pieces(self):
+		""" Test that the pieces of a file longer than one piece are
+		hashed correctly. """
+
+		self.contents = "".join(chr(n % 251) for n in range(1200000))
+		with open(self.filename, "wb") as self.file:
+			self.file.write(self.contents)
+		self.d = torrent.make_info_dict(self.filename)
+
+		self.n = self.d["piece length"]
+		self.pieces = [hashlib.sha1(self.contents[i:i + self.n]).digest() \
+			for i in range(0, len(self.contents), self.n)]
+		self.assertEqual("".join(self.pieces), self.d["pieces"])
+		self.assertEqual(len(self.contents), self.d["length"])
+
+	def test_piece_length(self):
+		""" Test that a given piece length is used. """
+
+		self.d = torrent.make_info_dict(self.filename, piece_length = 65536)
+		self.assertEqual(65536, self.d["piece length"])
+
+	def test_error_on_bad_piece_length(self):
+		""" Test that an error is raised on a piece length which isn't a
+		power of two. """
+
+		self.assertRaises(ValueError, torrent.make_info_dict, \
+			self.filename, piece_length = 100000)
+
+	def test_no_md5(self):
+		""" Test that the md5sum can be left out. """
+
+		self.d = torrent.make_info_dict(self.filename, md5sum = False)
+		self.assertFalse("md5sum" in self.d)
+
 	def tearDown(self):
 		""" Remove the file. """
 
 		os.remove(self.filename)
 		self.d = None
 
+class Choose_Piece_Length(unittest.TestCase):
+	""" Test that choose_piece_length() works correctly. """
+
+	def test_small(self):
+		""" Test that a small file gets the smallest piece length. """
+
+		self.assertEqual(torrent.choose_piece_length(10), \
+			torrent.MIN_PIECE_LENGTH)
+
+	def test_target(self):
+		""" Test that the piece length gives at most the target number of
+		pieces. """
+
+		self.n = torrent.choose_piece_length(2 ** 30)
+		self.assertEqual(self.n, 2 ** 19)
+		self.assertTrue(2 ** 30 / self.n <= torrent.TARGET_PIECES)
+
+	def test_large(self):
+		""" Test that a huge file gets at most the largest piece length. """
+
+		self.assertEqual(torrent.choose_piece_length(2 ** 50), \
+			torrent.MAX_PIECE_LENGTH)
+
+	def test_power_of_two(self):
+		""" Test that the piece length is always a power of two. """
+
+		self.n = torrent.choose_piece_length(3 * 10 ** 9)
+		self.assertEqual(self.n & (self.n - 1), 0)
+
+class Piece_Length_Policy(unittest.TestCase):
+	""" Test that a PieceLengthPolicy chooses and records piece lengths. """
+
+	def test_choose(self):
+		""" Test that the policy's bounds and target are used. """
+
+		self.n = torrent.PieceLengthPolicy(target = 1024, \
+			min_length = 65536, max_length = 2 ** 20)
+		self.assertEqual(self.n.choose(10), 65536)
+		self.assertEqual(self.n.choose(2 ** 30), 2 ** 20)
+		self.assertEqual(self.n.piece_length, 2 ** 20)
+
+	def test_given(self):
+		""" Test that a given piece length is used, and recorded. """
+
+		self.n = torrent.PieceLengthPolicy()
+		self.assertEqual(self.n.choose(2 ** 30, 16384), 16384)
+		self.assertEqual(self.n.piece_length, 16384)
+
+	def test_invalid(self):
+		""" Test that bounds which aren't powers of two, or are the wrong
+		way round, are refused. """
+
+		self.assertRaises(ValueError, torrent.PieceLengthPolicy, \
+			min_length = 50000)
+		self.assertRaises(ValueError, torrent.PieceLengthPolicy, \
+			min_length = 2 ** 20, max_length = 2 ** 16)
+
+class Make_Multi_File_Info_Dict(unittest.TestCase):
+	""" Test that make_info_dict() works correctly on a directory. """
+
+	def setUp(self):
+		""" Write a little directory of files, and turn it into an info
+		dict. """
+
+		self.directory = "test_dir"
+		self.contents = {("b.txt",) : "Second file." * 50000,
+						 ("a", "a.txt") : "First file.",
+						 ("c", "empty.txt") : ""}
+		for path, contents in sorted(self.contents.items()):
+			if len(path) > 1:
+				os.makedirs(os.path.join(self.directory, *path[:-1]))
+			with open(os.path.join(self.directory, *path), "wb") as self.file:
+				self.file.write(contents)
+		self.d = torrent.make_info_dict(self.directory)
+
+	def test_name(self):
+		""" Test that the name is the name of the directory. """
+
+		self.assertEqual(self.directory, self.d["name"])
+
+	def test_files(self):
+		""" Test that the files list has every file, in order. """
+
+		self.assertEqual([(f["path"], f["length"]) for f in self.d["files"]], \
+			[(["a", "a.txt"], 11), (["b.txt"], 600000), (["c", "empty.txt"], 0)])
+
+	def test_pieces(self):
+		""" Test that the pieces are hashed across the file boundaries. """
+
+		self.data = "".join(self.contents[tuple(f["path"])] \
+			for f in self.d["files"])
+		self.n = self.d["piece length"]
+		self.pieces = [hashlib.sha1(self.data[i:i + self.n]).digest() \
+			for i in range(0, len(self.data), self.n)]
+		self.assertEqual("".join(self.pieces), self.d["pieces"])
+
+	def test_md5(self):
+		""" Test that each file has its own md5 hash. """
+
+		self.assertEqual(hashlib.md5("First file.").hexdigest(), \
+			self.d["files"][0]["md5sum"])
+
+	def test_mmap(self):
+		""" Test that hashing from memory maps gives the same dict. """
+
+		self.assertEqual(torrent.make_info_dict(self.directory, \
+			use_mmap = True), self.d)
+		self.assertEqual(torrent.make_info_dict(self.directory, workers = 3, \
+			use_mmap = True, piece_length = 16384), \
+			torrent.make_info_dict(self.directory, piece_length = 16384))
+
+	def tearDown(self):
+		""" Remove the directory. """
+
+		shutil.rmtree(self.directory)
+		self.d = None
+
+class Verify(unittest.TestCase):
+	""" Test that verify() works correctly. """
+
+	def setUp(self):
+		""" Write a little directory of files, and make a torrent of it. """
+
+		self.directory = "test_dir"
+		os.makedirs(os.path.join(self.directory, "sub"))
+		self.files = [os.path.join(self.directory, "a.txt"), \
+			os.path.join(self.directory, "sub", "b.txt")]
+		for path in self.files:
+			with open(path, "wb") as self.file:
+				self.file.write("".join(chr(n % 251) for n in range(100000)))
+		self.t = {"info" : torrent.make_info_dict(self.directory, \
+			piece_length = 32768)}
+
+	def test_valid(self):
+		""" Test that every piece of unchanged data is valid. """
+
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory)
+		self.assertEqual(self.bitfield, bytearray("\xfe"))
+		self.assertEqual(self.stats["valid"], 7)
+		self.assertEqual(self.stats["bytes"], 200000)
+
+	def test_parallel(self):
+		""" Test that verifying on several threads gives the same result. """
+
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory, \
+			workers = 4)
+		self.assertEqual(self.bitfield, bytearray("\xfe"))
+
+	def test_changed(self):
+		""" Test that a changed piece is invalid. """
+
+		with open(self.files[1], "r+b") as self.file:
+			self.file.seek(70000)
+			self.file.write("X")
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory)
+		self.assertEqual(self.bitfield, bytearray("\xfa"))
+
+	def test_missing(self):
+		""" Test that the pieces of a missing file are invalid, and the
+		pieces after it still line up. """
+
+		os.remove(self.files[0])
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory)
+		self.assertEqual(self.bitfield, bytearray("\x0e"))
+
+	def test_mmap(self):
+		""" Test that verifying from memory maps gives the same results,
+		for changed and missing files, and for only some pieces. """
+
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory, \
+			use_mmap = True)
+		self.assertEqual(self.bitfield, bytearray("\xfe"))
+		self.assertEqual(self.stats["bytes"], 200000)
+
+		with open(self.files[1], "r+b") as self.file:
+			self.file.seek(70000)
+			self.file.write("X")
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory, \
+			workers = 4, use_mmap = True)
+		self.assertEqual(self.bitfield, bytearray("\xfa"))
+
+		os.remove(self.files[0])
+		self.bitfield, self.stats = torrent.verify(self.t, self.directory, \
+			only = [2, 3, 6], use_mmap = True)
+		self.assertEqual(self.bitfield, bytearray("\x02"))
+
+	def tearDown(self):
+		""" Remove the directory. """
+
+		shutil.rmtree(self.directory)
+		self.t = None
+
+class Resume(unittest.TestCase):
+	""" Test that resume() only checks the pieces of changed files. """
+
+	def setUp(self):
+		""" Write a little directory of files, make a torrent of it, and
+		a resume record. """
+
+		self.directory = "test_dir"
+		os.makedirs(os.path.join(self.directory, "sub"))
+		self.files = [os.path.join(self.directory, "a.txt"), \
+			os.path.join(self.directory, "sub", "b.txt")]
+		for path in self.files:
+			with open(path, "wb") as self.file:
+				self.file.write("".join(chr(n % 251) for n in range(100000)))
+		self.t = {"info" : torrent.make_info_dict(self.directory, \
+			piece_length = 32768)}
+
+		self.bitfield = torrent.verify(self.t, self.directory)[0]
+		self.states = torrent.file_states(torrent.torrent_files( \
+			self.t["info"], self.directory))
+		self.record = torrent.make_resume_record(self.bitfield, \
+			self.states, None, [])
+
+	def test_unchanged(self):
+		""" Test that the recorded bitfield is used for unchanged files. """
+
+		self.record["bitfield"] = "\x00"
+		self.assertEqual(torrent.resume(self.t, self.directory, \
+			self.record), bytearray("\x00"))
+
+	def test_changed(self):
+		""" Test that the pieces of a changed file are checked again. """
+
+		self.record["files"][1] = (0, 0)
+		with open(self.files[1], "r+b") as self.file:
+			self.file.seek(70000)
+			self.file.write("X")
+		self.assertEqual(torrent.resume(self.t, self.directory, \
+			self.record), bytearray("\xfa"))
+
+	def test_no_record(self):
+		""" Test that every piece is checked without a record. """
+
+		self.assertEqual(torrent.resume(self.t, self.directory, None), \
+			bytearray("\xfe"))
+
+	def test_changed_pieces(self):
+		""" Test that the pieces overlapping a changed file are found. """
+
+		self.files = torrent.torrent_files(self.t["info"], self.directory)
+		self.assertEqual(torrent.changed_pieces(self.files, 32768, \
+			self.states, [self.states[0], None]), [3, 4, 5, 6])
+
+	def tearDown(self):
+		""" Remove the directory. """
+
+		shutil.rmtree(self.directory)
+		self.t = None
+
 class Make_Torrent_File(unittest.TestCase):
 	""" Test that make_torrent_file() works correctly. """
 
@@ -100,6 +388,16 @@ class Make_Torrent_File(unittest.TestCase):
 		self.info = torrent.make_info_dict(self.filename)
 		self.assertEqual(self.info, self.t["info"])
 
+	def test_policy(self):
+		""" Test that the piece length is chosen by the policy given, and
+		reported through it. """
+
+		self.n = torrent.PieceLengthPolicy(min_length = 65536)
+		self.t = bencode.decode(torrent.make_torrent_file \
+			(file = self.filename, tracker = self.tracker, policy = self.n))
+		self.assertEqual(self.n.piece_length, 65536)
+		self.assertEqual(self.t["info"]["piece length"], 65536)
+
 	def test_error_on_no_file(self):
 		""" Test that an error is raised when no file is given. """
 
@@ -141,6 +439,22 @@ class Write_Torrent_File(unittest.TestCase):
 
 		self.assertTrue(os.path.isfile(self.torrent))
 
+	def test_piece_length(self):
+		""" Test that the piece length used is returned. """
+
+		self.n = torrent.write_torrent_file(torrent = self.torrent, \
+			file = self.filename, tracker = self.tracker, \
+			piece_length = 65536)
+		self.assertEqual(self.n, 65536)
+
+	def test_policy(self):
+		""" Test that the piece length chosen by a policy is returned. """
+
+		self.n = torrent.write_torrent_file(torrent = self.torrent, \
+			file = self.filename, tracker = self.tracker, \
+			policy = torrent.PieceLengthPolicy(min_length = 2 ** 20))
+		self.assertEqual(self.n, 2 ** 20)
+
 	def test_error_on_no_torrent(self):
 		""" Test that an error occurs when no torrent is given. """
 
@@ -264,6 +578,18 @@ class Decode_Binary_Peers(unittest.TestCase):
 		self.assertEqual(self.p, [('100.100.100.100', 1000), \
 			('100.100.100.100', 1000)])
 
+	def test_bytearray(self):
+		""" Test that a bytearray peer list is decoded. """
+
+		self.p = torrent.decode_binary_peers(bytearray("dddd\x03\xe8"))
+		self.assertEqual(self.p, [("100.100.100.100", 1000)])
+
+	def test_memoryview(self):
+		""" Test that a memoryview peer list is decoded. """
+
+		self.p = torrent.decode_binary_peers(memoryview("dddd\x03\xe8"))
+		self.assertEqual(self.p, [("100.100.100.100", 1000)])
+
 class Get_Peers(unittest.TestCase):
 	""" Test that get_peers() dispatches correctly. """
 
@@ -304,31 +630,177 @@ class Generate_Handshake(unittest.TestCase):
 	def test_length_protocol(self):
 		""" Test that the length of the protocol is correct. """
 
-		self.assertEqual("19", self.h[0:2])
+		self.assertEqual("\x13", self.h[0])
 
 	def test_protocol_id(self):
 		""" Test the protocol id is correct. """
 
-		self.assertEqual("BitTorrent protocol", self.h[2:21])
+		self.assertEqual("BitTorrent protocol", self.h[1:20])
 
 	def test_reserved(self):
 		""" Test that the reserved bytes are correct. """
 
-		self.assertEqual("00000000", self.h[21:29])
+		self.assertEqual("\x00" * 8, self.h[20:28])
 
 	def test_info_hash(self):
 		""" Test that the info hash is correct. """
 
 		self.assertEqual(self.info_hash, \
-			self.h[29:29+len(self.info_hash)])
+			self.h[28:28+len(self.info_hash)])
 
 	def test_peer_id(self):
 		""" Test that the peer id is correct. """
 
-		self.assertEqual(self.peer_id, self.h[29+len(self.info_hash): \
-			29+len(self.info_hash)+len(self.peer_id)])
+		self.assertEqual(self.peer_id, self.h[28+len(self.info_hash): \
+			28+len(self.info_hash)+len(self.peer_id)])
 
 	def tearDown(self):
 		""" Remove the handshake. """
 
-		self.h = None
\ No newline at end of file
+		self.h = None
+
+class Recorder():
+	""" A peer handler which records the messages it is sent. """
+
+	def __init__(self):
+		""" Start with nothing recorded. """
+
+		self.events = []
+
+	def handle_peer_handshake(self, connection):
+		""" Record the handshake. """
+
+		self.events.append(("handshake",))
+
+	def handle_peer_message(self, connection, message_id, fields):
+		""" Record the message. """
+
+		self.events.append((message_id, fields))
+
+	def handle_peer_close(self, connection):
+		""" Record the close. """
+
+		self.events.append(("close",))
+
+class Torrent_Peers(unittest.TestCase):
+	""" Test that a Torrent talks to the peers which connect to it. """
+
+	def setUp(self):
+		""" Make a torrent of a file of three pieces. """
+
+		self.filename = "test.bin"
+		self.torrent = "testing.torrent"
+		self.data = "".join(chr(n % 251) for n in range(80000))
+		with open(self.filename, "wb") as self.file:
+			self.file.write(self.data)
+		torrent.write_torrent_file(torrent = self.torrent, \
+			file = self.filename, tracker = "http://tracker.com", \
+			piece_length = 32768)
+
+		self.t = torrent.Torrent(self.torrent, data_path = self.filename)
+		self.map = {}
+		self.recorder = Recorder()
+		self.remote = None
+
+	def connect(self):
+		""" Connect a peer, which records what it is sent, to the torrent
+		over a socket pair. """
+
+		self.a, self.b = socket.socketpair()
+		self.connection = peer.PeerConnection(self.t.info_hash, \
+			self.t.peer_id, sock = self.a, handler = self.t, map = self.map)
+		self.remote = peer.PeerConnection(self.t.info_hash, "r" * 20, \
+			sock = self.b, handler = self.recorder, map = self.map)
+		peer.loop(self.map, timeout = 0.1, count = 5)
+
+	def pump(self, done):
+		""" Run the peer loop, and the torrent's disk callbacks, until
+		done() is true, or for about a second at most. """
+
+		for i in range(20):
+			if done():
+				return
+			peer.loop(self.map, timeout = 0.05, count = 1)
+			if self.t.storage is not None:
+				self.t.storage.run_callbacks()
+
+	def test_bitfield(self):
+		""" Test that a peer is sent the pieces we have once connected. """
+
+		for n in range(3):
+			self.t.picker.got_piece(n)
+		self.connect()
+		self.assertEqual(self.recorder.events, [("handshake",), \
+			(peer.BITFIELD, ("\xe0",))])
+
+	def test_no_bitfield(self):
+		""" Test that a peer isn't sent a bitfield when we have nothing. """
+
+		self.connect()
+		self.assertEqual(self.recorder.events, [("handshake",)])
+
+	def test_seeding(self):
+		""" Test that an interested peer is unchoked, and uploaded to, with
+		the upload counted for ranking it, and that it is choked once it
+		is no longer interested. """
+
+		self.t.open_data()
+		self.connect()
+
+		self.remote.send_interested()
+		self.pump(lambda: not self.remote.peer_choking)
+		self.assertFalse(self.remote.peer_choking)
+
+		self.p = (peer.PIECE, (1, 0, self.data[32768:49152]))
+		self.remote.send_request(1, 0, 16384)
+		self.pump(lambda: self.p in self.recorder.events)
+		self.assertTrue(self.p in self.recorder.events)
+		self.assertEqual(self.t.choker.peers[self.connection].uploaded, 16384)
+
+		self.remote.send_not_interested()
+		self.pump(lambda: self.remote.peer_choking)
+		self.assertTrue(self.remote.peer_choking)
+		self.assertEqual(self.t.choker.unchoked, set())
+
+	def test_complete_data(self):
+		""" Test that data on disk is checked on starting, with no resume
+		database, so that none of it is asked for again. """
+
+		self.t.open_data()
+		self.assertEqual(list(self.t.picker.have), [0, 1, 2])
+		self.connect()
+
+		self.remote.send_bitfield(bytearray("\xe0"))
+		self.remote.send_unchoke()
+		self.pump(lambda: not self.connection.peer_choking)
+		peer.loop(self.map, timeout = 0.01, count = 5)
+		self.assertFalse(set([peer.INTERESTED, peer.REQUEST]) & \
+			set(event[0] for event in self.recorder.events))
+
+	def test_missing_data(self):
+		""" Test that missing data is asked for. """
+
+		os.remove(self.filename)
+		self.t.open_data()
+		self.connect()
+
+		self.remote.send_bitfield(bytearray("\xe0"))
+		self.remote.send_unchoke()
+		self.pump(lambda: peer.REQUEST in \
+			[event[0] for event in self.recorder.events])
+		self.assertTrue((peer.INTERESTED, ()) in self.recorder.events)
+		self.assertTrue(peer.REQUEST in \
+			[event[0] for event in self.recorder.events])
+
+	def tearDown(self):
+		""" Drop the peer, and remove the torrent and the file. """
+
+		if self.remote is not None:
+			self.remote.close()
+			self.connection.close()
+		if self.t.storage is not None:
+			self.t.storage.close()
+		os.remove(self.torrent)
+		if os.path.exists(self.filename):
+			os.remove(self.filename)
+		self.t = None
@@ -3,6 +3,7 @@
 
 import unittest
 import util
+from io import BytesIO
 
 class Collapse(unittest.TestCase):
 	""" Check the function collapse() works correctly. """
@@ -37,4 +38,65 @@ class Slice(unittest.TestCase):
 		""" Test that a string too long works fine. """
 
 		self.n = util.slice("abcd", 6)
-		self.assertEqual(self.n, ["abcd"])
\ No newline at end of file
+		self.assertEqual(self.n, ["abcd"])
+
+class To_String(unittest.TestCase):
+	""" Check the function to_string() works correctly. """
+
+	def test_string(self):
+		""" Test that a string is returned as it is. """
+
+		self.s = "abc"
+		self.assertTrue(util.to_string(self.s) is self.s)
+
+	def test_bytearray(self):
+		""" Test that a bytearray is turned into a string. """
+
+		self.assertEqual(util.to_string(bytearray("abc")), "abc")
+
+	def test_memoryview(self):
+		""" Test that a memoryview is turned into a string. """
+
+		self.assertEqual(util.to_string(memoryview("abc")), "abc")
+
+class Chunks(unittest.TestCase):
+	""" Check the function chunks() works correctly. """
+
+	def test_simple(self):
+		""" Test that a string is cut into chunks, with stragglers. """
+
+		self.n = [c.tobytes() for c in util.chunks("abcde", 2)]
+		self.assertEqual(self.n, ["ab", "cd", "e"])
+
+	def test_views(self):
+		""" Test that the chunks are views of the data. """
+
+		self.data = bytearray("abcd")
+		self.n = list(util.chunks(self.data, 2))
+		self.data[0] = "z"
+		self.assertEqual(self.n[0].tobytes(), "zb")
+
+	def test_empty(self):
+		""" Test that empty data gives no chunks. """
+
+		self.assertEqual(list(util.chunks("", 2)), [])
+
+class Read_Chunks(unittest.TestCase):
+	""" Check the function read_chunks() works correctly. """
+
+	def test_simple(self):
+		""" Test that a stream is read in chunks, with stragglers. """
+
+		self.n = [c.tobytes() for c in util.read_chunks(BytesIO("abcde"), 2)]
+		self.assertEqual(self.n, ["ab", "cd", "e"])
+
+	def test_exact(self):
+		""" Test that a stream of a whole number of chunks is read. """
+
+		self.n = [c.tobytes() for c in util.read_chunks(BytesIO("abcd"), 2)]
+		self.assertEqual(self.n, ["ab", "cd"])
+
+	def test_empty(self):
+		""" Test that an empty stream gives no chunks. """
+
+		self.assertEqual(list(util.read_chunks(BytesIO(""), 2)), [])
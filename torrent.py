@@ -2,45 +2,211 @@
 # Torrent file related utilities
 
 from hashlib import md5, sha1
+import os
 from random import choice
-import socket
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from threading import Thread
 from time import sleep, time
 import types
 from urllib import urlencode, urlopen
-from util import collapse, slice
 
-from bencode import decode, encode
+from bencode import decode, decode_lazy, decode_stream, encode, encode_to
+from bitfield import Bitfield
+from choker import Choker
+from dialer import Dialer
+from hasher import hash_file, hash_mapped_files, hash_pieces, hash_pieces_at, \
+	MultiFileReader
+from peer import BITFIELD, CANCEL, CHOKE, generate_handshake, HAVE, \
+	INTERESTED, loop, NOT_INTERESTED, PIECE, REQUEST, UNCHOKE
+from picker import PiecePicker
+from ratelimit import Limits
+from scheduler import BLOCK_LENGTH, RequestScheduler
+from simpledb import Database
+from storage import MAX_OPEN_FILES, SPARSE, Storage
 
 CLIENT_NAME = "pytorrent"
 CLIENT_ID = "PY"
 CLIENT_VERSION = "0001"
 
-def make_info_dict(file):
-	""" Returns the info dictionary for a torrent file. """
-
-	with open(file) as f:
-		contents = f.read()
-
-	piece_length = 524288	# TODO: This should change dependent on file size
+# Limits on the tracker responses we are willing to decode
+MAX_RESPONSE_LENGTH = 4194304
+MAX_RESPONSE_DEPTH = 16
+MAX_RESPONSE_INT_DIGITS = 20
+
+# Piece length policy. Piece lengths are powers of two, between the
+# bounds, chosen to give at most the target number of pieces.
+MIN_PIECE_LENGTH = 32768
+MAX_PIECE_LENGTH = 16777216
+TARGET_PIECES = 2048
+
+def choose_piece_length(length, target = TARGET_PIECES, \
+	min_length = MIN_PIECE_LENGTH, max_length = MAX_PIECE_LENGTH):
+	""" Returns the smallest power of two piece length, between min_length
+	and max_length, that cuts length bytes into at most target pieces. """
+
+	piece_length = min_length
+	while piece_length < max_length and length > piece_length * target:
+		piece_length *= 2
+
+	return piece_length
+
+class PieceLengthPolicy():
+	""" How the piece length of a new torrent is chosen, when it isn't
+	given, as in choose_piece_length(). Once a torrent has been made with
+	it, piece_length is the piece length the torrent was given. """
+
+	def __init__(self, target = TARGET_PIECES, \
+		min_length = MIN_PIECE_LENGTH, max_length = MAX_PIECE_LENGTH):
+		""" Take the target number of pieces, and the bounds of the piece
+		length, which must be powers of two. """
+
+		check_piece_length(min_length)
+		check_piece_length(max_length)
+		if target <= 0 or min_length > max_length:
+			raise ValueError("Invalid piece length policy.")
+
+		self.target = target
+		self.min_length = min_length
+		self.max_length = max_length
+		self.piece_length = None
+
+	def choose(self, length, piece_length = None):
+		""" Returns the piece length for length bytes, which is
+		piece_length if it is given, and records it. """
+
+		if piece_length is None:
+			piece_length = choose_piece_length(length, self.target, \
+				self.min_length, self.max_length)
+		self.piece_length = piece_length
+
+		return piece_length
+
+def check_piece_length(piece_length):
+	""" Raises an error if piece_length isn't a positive power of two. """
+
+	if piece_length <= 0 or piece_length & (piece_length - 1):
+		raise ValueError("Piece length must be a power of two, not %r." \
+			% piece_length)
+
+def list_files(directory):
+	""" Returns the path of every file under directory, relative to it,
+	as a list of path components, in sorted order. """
+
+	temp = []
+	for root, dirs, files in os.walk(directory):
+		relative = os.path.relpath(root, directory)
+		parts = [] if relative == os.curdir else relative.split(os.sep)
+		for name in files:
+			temp.append(parts + [name])
+
+	return sorted(temp)
+
+def make_info_dict(file, md5sum = True, workers = 1, use_mmap = False, \
+	piece_length = None, hash_cache = None, policy = None):
+	""" Returns the info dictionary for a torrent file. The file is hashed
+	a piece at a time, on workers threads, so only a few pieces are ever
+	held in memory. If use_mmap is true, the file is hashed straight from
+	a memory map of it where possible. If file is a directory, every file
+	under it goes in a multi-file info dictionary, hashed as one stream,
+	from memory maps of the files if use_mmap is true.
+	If piece_length isn't given, it is chosen from the total length, by
+	policy, a PieceLengthPolicy, if given, which records the length used.
+	If a hasher.HashCache is given, only pieces not in it are hashed. """
+
+	if os.path.isdir(file):
+		paths = list_files(file)
+		length = sum(os.path.getsize(os.path.join(file, *path)) \
+			for path in paths)
+	else:
+		length = os.path.getsize(file)
+
+	if policy is None:
+		policy = PieceLengthPolicy()
+	piece_length = policy.choose(length, piece_length)
+	check_piece_length(piece_length)
 
 	info = {}
 
 	info["piece length"] = piece_length
-	info["length"] = len(contents)
+
+	if os.path.isdir(file):
+		info["name"] = os.path.basename(os.path.abspath(file))
+		info["files"], pieces = make_files_list(file, paths, piece_length, \
+			md5sum, workers, hash_cache, use_mmap)
+		info["pieces"] = "".join(pieces)
+		return info
+
 	info["name"] = file
-	info["md5sum"] = md5(contents).hexdigest()
 
-	# Generate the pieces
-	pieces = slice(contents, piece_length)
-	pieces = [ sha1(p).digest() for p in pieces ]
-	info["pieces"] = collapse(pieces)
+	if hash_cache is not None:
+		pieces, lengths = hash_cache.hash_files([file], piece_length, \
+			workers, md5sum)
+		info["length"] = lengths[0]
+		if md5sum:
+			info["md5sum"] = hash_cache.md5(file)
+		info["pieces"] = "".join(pieces)
+		return info
+
+	# Generate the pieces, and the md5sum in the same pass
+	md5_hash = md5() if md5sum else None
+	pieces, length = hash_file(file, piece_length, workers, md5_hash, \
+		use_mmap)
+
+	info["length"] = length
+	if md5sum:
+		info["md5sum"] = md5_hash.hexdigest()
+	info["pieces"] = "".join(pieces)
 
 	return info
 
-def make_torrent_file(file = None, tracker = None, comment = None):
-	""" Returns the bencoded contents of a torrent file. """
+def make_files_list(directory, paths, piece_length, md5sum = True, \
+	workers = 1, hash_cache = None, use_mmap = False):
+	""" Returns the files list of a multi-file info dictionary, for the
+	paths of files under directory, and the piece hashes of them all. """
+
+	full_paths = [os.path.join(directory, *path) for path in paths]
+
+	if hash_cache is not None:
+		pieces, lengths = hash_cache.hash_files(full_paths, piece_length, \
+			workers, md5sum)
+		md5sums = [hash_cache.md5(path) for path in full_paths] \
+			if md5sum else None
+	elif use_mmap:
+		md5_hashes = [md5() for path in paths] if md5sum else None
+
+		# Hash the files as one stream of views of their memory maps
+		lengths = [os.path.getsize(path) for path in full_paths]
+		pieces, length = hash_mapped_files(full_paths, lengths, \
+			piece_length, workers, md5_hashes = md5_hashes)
+
+		md5sums = [h.hexdigest() for h in md5_hashes] if md5sum else None
+	else:
+		md5_hashes = [md5() for path in paths] if md5sum else None
+
+		# Hash the files as one stream, noting the length of each as we go
+		reader = MultiFileReader(full_paths, md5_hashes)
+		try:
+			pieces, length = hash_pieces(reader, piece_length, workers)
+		finally:
+			reader.close()
+
+		lengths = reader.lengths
+		md5sums = [h.hexdigest() for h in md5_hashes] if md5sum else None
+
+	files = []
+	for n, path in enumerate(paths):
+		f = {}
+		f["length"] = lengths[n]
+		f["path"] = path
+		if md5sum:
+			f["md5sum"] = md5sums[n]
+		files.append(f)
+
+	return files, pieces
+
+def make_torrent_dict(file = None, tracker = None, comment = None, \
+	workers = 1, piece_length = None, hash_cache = None, policy = None):
+	""" Returns the unencoded contents of a torrent file. """
 
 	if not file:
 		raise TypeError("make_torrent_file requires at least one file, non given.")
@@ -63,29 +229,195 @@ def make_torrent_file(file = None, tracker = None, comment = None):
 	if comment:
 		torrent["comment"] = comment
 
-	torrent["info"] = make_info_dict(file)
+	torrent["info"] = make_info_dict(file, workers = workers, \
+		piece_length = piece_length, hash_cache = hash_cache, \
+		policy = policy)
+
+	return torrent
+
+def make_torrent_file(file = None, tracker = None, comment = None, \
+	workers = 1, piece_length = None, hash_cache = None, policy = None):
+	""" Returns the bencoded contents of a torrent file. The pieces are
+	hashed on workers threads, and are piece_length long, or chosen from
+	the length of the file if that isn't given, by policy if it is given.
+	The length used is left in policy.piece_length. Hashes are reused
+	from hash_cache, if it is given. """
 
-	return encode(torrent)
+	return encode(make_torrent_dict(file = file, tracker = tracker, \
+		comment = comment, workers = workers, piece_length = piece_length, \
+		hash_cache = hash_cache, policy = policy))
 
 def write_torrent_file(torrent = None, file = None, tracker = None, \
-	comment = None):
+	comment = None, workers = 1, piece_length = None, hash_cache = None, \
+	policy = None):
 	""" Largely the same as make_torrent_file(), except write the file
-	to the file named in torrent. """
+	to the file named in torrent. Returns the piece length used. """
 
 	if not torrent:
 		raise TypeError("write_torrent_file() requires a torrent filename to write to.")
 
-	data = make_torrent_file(file = file, tracker = tracker, \
-		comment = comment)
-	with open(torrent, "w") as torrent_file:
-		torrent_file.write(data)
+	data = make_torrent_dict(file = file, tracker = tracker, \
+		comment = comment, workers = workers, piece_length = piece_length, \
+		hash_cache = hash_cache, policy = policy)
+	# Stream the encoding straight into the file.
+	with open(torrent, "wb") as torrent_file:
+		encode_to(data, torrent_file)
 
-def read_torrent_file(torrent_file):
-	""" Given a .torrent file, returns its decoded contents. """
+	return data["info"]["piece length"]
 
-	with open(torrent_file) as file:
+def read_torrent_file(torrent_file, lazy = False):
+	""" Given a .torrent file, returns its decoded contents. If lazy is
+	true, the contents are decoded as they are accessed. """
+
+	with open(torrent_file, "rb") as file:
+		if lazy:
+			return decode_lazy(file.read())
 		return decode(file.read())
 
+def torrent_files(info, data_path):
+	""" Given an info dictionary, and the path of the torrent's data, as
+	given to make_info_dict(), returns the path and length of each file
+	in the torrent, in order. """
+
+	if "files" in info:
+		return [(os.path.join(data_path, *f["path"]), f["length"]) \
+			for f in info["files"]]
+
+	return [(data_path, info["length"])]
+
+def verify(torrent, data_path, workers = 1, only = None, use_mmap = False):
+	""" Checks the data at data_path, as given to make_info_dict(), against
+	the piece hashes of torrent, which may be a Torrent, or the decoded
+	contents of a torrent file. Returns a bitfield of the valid pieces,
+	as in the bitfield message, and a dictionary of throughput stats.
+	Pieces are hashed on workers threads. If only is given, only the
+	pieces with those indices are checked. If use_mmap is true, the files
+	are hashed straight from memory maps of them where possible. """
+
+	if isinstance(torrent, Torrent):
+		torrent = torrent.data
+	info = torrent["info"]
+	hashes = info["pieces"]
+	count = len(hashes) // 20
+	piece_length = info["piece length"]
+
+	files = torrent_files(info, data_path)
+	paths = [path for path, length in files]
+	lengths = [length for path, length in files]
+
+	start = time()
+	indices = range(count) if only is None else sorted(only)
+
+	# Missing and short files are read as zeros, so pieces still line up
+	if use_mmap:
+		digests, length = hash_mapped_files(paths, lengths, piece_length, \
+			workers, indices)
+	else:
+		reader = MultiFileReader(paths, expected = lengths)
+		try:
+			if only is None:
+				digests, length = hash_pieces(reader, piece_length, workers)
+			else:
+				digests, length = hash_pieces_at(reader, indices, \
+					piece_length, sum(lengths), workers)
+		finally:
+			reader.close()
+
+	bitfield = Bitfield(count)
+	valid = 0
+	for n, digest in zip(indices, digests):
+		if digest == hashes[n * 20:n * 20 + 20]:
+			bitfield[n] = True
+			valid += 1
+
+	elapsed = time() - start
+
+	stats = {}
+	stats["pieces"] = len(digests)
+	stats["valid"] = valid
+	stats["bytes"] = length
+	stats["seconds"] = elapsed
+	stats["rate"] = length / elapsed if elapsed else 0.0
+
+	return bitfield, stats
+
+# Fast resume. When a Torrent stops, it saves a resume record of which
+# pieces were valid, the size and modification time of each file, and
+# what the tracker last told it. When it starts again, only the pieces
+# of files which have changed since need to be checked again.
+
+def file_states(files):
+	""" Given the path and length of each file, returns the size and
+	modification time of each, or None if it is missing. """
+
+	temp = []
+	for path, length in files:
+		try:
+			st = os.stat(path)
+			temp.append((st.st_size, st.st_mtime))
+		except EnvironmentError:
+			temp.append(None)
+
+	return temp
+
+def changed_pieces(files, piece_length, old_states, new_states):
+	""" Returns the indices of every piece overlapping a file whose state
+	has changed. """
+
+	temp = set()
+	offset = 0
+	for (path, length), old, new in zip(files, old_states, new_states):
+		if old != new and length:
+			first = offset // piece_length
+			last = (offset + length - 1) // piece_length
+			temp.update(range(first, last + 1))
+		offset += length
+
+	return sorted(temp)
+
+def make_resume_record(bitfield, states, tracker_response, peers):
+	""" Returns a resume record, to be saved in the resume database. """
+
+	record = {}
+	record["bitfield"] = str(bitfield)
+	record["files"] = states
+	record["tracker response"] = tracker_response
+	record["peers"] = peers
+
+	return record
+
+def resume(torrent, data_path, record, workers = 1, use_mmap = False):
+	""" Given a resume record, returns a bitfield of the valid pieces of
+	torrent, checking again only the pieces of changed files. With no
+	record, or one that doesn't match the torrent, every piece is checked.
+	See verify() for use_mmap. """
+
+	if isinstance(torrent, Torrent):
+		torrent = torrent.data
+	info = torrent["info"]
+	count = len(info["pieces"]) // 20
+
+	files = torrent_files(info, data_path)
+	states = file_states(files)
+
+	if not record or len(record["files"]) != len(files) or \
+		len(record["bitfield"]) != (count + 7) // 8:
+		return verify(torrent, data_path, workers, use_mmap = use_mmap)[0]
+
+	changed = changed_pieces(files, info["piece length"], record["files"], \
+		states)
+
+	# Forget the changed pieces, then add back those that are still valid
+	bitfield = Bitfield(count, record["bitfield"])
+	for n in changed:
+		bitfield[n] = False
+
+	if changed:
+		bitfield |= verify(torrent, data_path, workers, only = changed, \
+			use_mmap = use_mmap)[0]
+
+	return bitfield
+
 def generate_peer_id():
 	""" Returns a 20-byte peer id. """
 
@@ -111,10 +443,12 @@ def make_tracker_request(info, peer_id, tracker_url):
 			"compact" : 1}
 	payload = urlencode(payload)
 
-	# Send the request
-	response = urlopen(tracker_url + "?" + payload).read()
+	# Send the request, and decode the response as it arrives
+	response = urlopen(tracker_url + "?" + payload)
 
-	return decode(response)
+	return decode_stream(response, max_depth = MAX_RESPONSE_DEPTH, \
+		max_length = MAX_RESPONSE_LENGTH, \
+		max_int_digits = MAX_RESPONSE_INT_DIGITS)
 
 def decode_expanded_peers(peers):
 	""" Return a list of IPs and ports, given an expanded list of peers,
@@ -126,13 +460,18 @@ def decode_binary_peers(peers):
 	""" Return a list of IPs and ports, given a binary list of peers,
 	from a tracker response. """
 
-	peers = slice(peers, 6)	# Cut the response at the end of every peer
-	return [(socket.inet_ntoa(p[:4]), decode_port(p[4:])) for p in peers]
+	# Unpack each peer in place, rather than cutting the response up.
+	temp = []
+	for i in range(0, len(peers) - len(peers) % 6, 6):
+		a, b, c, d, port = unpack_from(">BBBBH", peers, i)
+		temp.append(("%d.%d.%d.%d" % (a, b, c, d), port))
+
+	return temp
 
 def get_peers(peers):
 	""" Dispatches peer list to decode binary or expanded peer list. """
 
-	if type(peers) == str:
+	if type(peers) in (str, bytearray, memoryview):
 		return decode_binary_peers(peers)
 	elif type(peers) == list:
 		return decode_expanded_peers(peers)
@@ -142,37 +481,128 @@ def decode_port(port):
 
 	return unpack(">H", port)[0]
 
-def generate_handshake(info_hash, peer_id):
-	""" Returns a handshake. """
-
-	protocol_id = "BitTorrent protocol"
-	len_id = str(len(protocol_id))
-	reserved = "00000000"
-
-	return len_id + protocol_id + reserved + info_hash + peer_id
-
-def send_recv_handshake(handshake, host, port):
-	""" Sends a handshake, returns the data we get back. """
-
-	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	s.connect((host, port))
-	s.send(handshake)
-
-	data = s.recv(len(handshake))
-	s.close()
-
-	return data
-
 class Torrent():
-	def __init__(self, torrent_file):
+	def __init__(self, torrent_file, data_path = None, resume_db = None, \
+		workers = 1, allocation = SPARSE, max_open = MAX_OPEN_FILES, \
+		limits = None, peer_download_rate = None, peer_upload_rate = None):
+		""" Read the torrent file. If data_path and resume_db are given,
+		the valid pieces of the data are found from the resume database
+		on starting, and saved back to it on stopping. On starting, the
+		files are allocated as allocation, SPARSE or FULL, or not at all
+		if it is None, and at most max_open of them are kept open.
+
+		The torrent's transfers are kept within limits, a ratelimit.Limits
+		whose parent may be shared with other torrents, and each peer's
+		within peer_download_rate and peer_upload_rate, in bytes a
+		second. By default there is no limit. """
+
 		self.running = False
 
-		self.data = read_torrent_file(torrent_file)
+		self.data = read_torrent_file(torrent_file, lazy = True)
 
-		self.info_hash = sha1(encode(self.data["info"])).digest()
+		# Hash the info dict exactly as it is in the file.
+		self.info_hash = sha1(self.data.raw("info")).digest()
 		self.peer_id = generate_peer_id()
 		self.handshake = generate_handshake(self.info_hash, self.peer_id)
 
+		self.data_path = data_path
+		self.workers = workers
+		self.allocation = allocation
+		self.max_open = max_open
+		self.limits = limits if limits is not None else Limits()
+		self.peer_download_rate = peer_download_rate
+		self.peer_upload_rate = peer_upload_rate
+		self.resume_db = Database(resume_db) if resume_db else None
+
+		self.bitfield = None
+		self.tracker_response = None
+		self.peers = []
+
+		# Our peer connections, driven by the peer loop.
+		self.connections = {}
+		self.dialer = Dialer(self.info_hash, self.peer_id, handler = self, \
+			map = self.connections, make_limits = self.peer_limits)
+
+		# The pieces each connected peer has, and which to download next.
+		info = self.data["info"]
+		self.peer_pieces = {}
+		self.picker = PiecePicker(len(info["pieces"]) // 20)
+
+		# The blocks we have requested from each peer.
+		if "files" in info:
+			length = sum(f["length"] for f in info["files"])
+		else:
+			length = info["length"]
+		self.scheduler = RequestScheduler(self.picker, info["piece length"], \
+			length)
+
+		# Which peers we upload to.
+		self.choker = Choker()
+
+		# Our data, once running, and the blocks being read for each peer.
+		self.storage = None
+		self.allocation_error = None
+		self.uploads = {}
+
+	def verify(self, data_path, workers = 1, use_mmap = False):
+		""" Check the data at data_path against our piece hashes. See
+		verify() for what is returned, and use_mmap. """
+
+		return verify(self, data_path, workers, use_mmap = use_mmap)
+
+	def load_resume(self):
+		""" Find the valid pieces of our data, using the resume record if
+		there is one, and restore the last tracker response. """
+
+		record = self.resume_db.setdefault(self.info_hash, None)
+		self.bitfield = resume(self, self.data_path, record, self.workers)
+
+		if record:
+			self.tracker_response = record["tracker response"]
+			self.peers = record["peers"]
+
+	def check_data(self):
+		""" Find the valid pieces of whatever of our data is on disk
+		already, when there is no resume database to go on. """
+
+		files = torrent_files(self.data["info"], self.data_path)
+		if any(os.path.exists(path) for path, length in files):
+			self.bitfield = verify(self, self.data_path, self.workers)[0]
+		else:
+			self.bitfield = self.picker.new_bitfield()
+
+	def open_data(self):
+		""" Find the pieces of our data we have, from the resume database,
+		or by checking the data itself, and open it for the peer loop. """
+
+		if self.data_path:
+			if self.resume_db is not None:
+				self.load_resume()
+			else:
+				self.check_data()
+			for n in self.bitfield:
+				self.picker.got_piece(n)
+
+		# The picker keeps our bitfield up to date from now on.
+		self.bitfield = self.picker.have
+
+		if self.data_path:
+			info = self.data["info"]
+			self.storage = Storage(torrent_files(info, self.data_path), \
+				info["piece length"], have = self.picker.have, \
+				max_open = self.max_open)
+			if self.allocation:
+				self.storage.preallocate(self.allocation, self.allocated)
+
+	def save_resume(self):
+		""" Save a resume record of our valid pieces, the state of our
+		files, and the last tracker response, and write it out to disk. """
+
+		files = torrent_files(self.data["info"], self.data_path)
+		self.resume_db[self.info_hash] = make_resume_record(self.bitfield, \
+			file_states(files), self.tracker_response, self.peers)
+		self.resume_db.sync()
+
 	def perform_tracker_request(self, url, info_hash, peer_id):
 		""" Make a tracker request to url, every interval seconds, using
 		the info_hash and peer_id, and decode the peers on a good response. """
@@ -184,16 +614,190 @@ class Torrent():
 				self.peers = get_peers(self.tracker_response["peers"])
 			sleep(self.tracker_response["interval"])
 
+	def perform_peer_loop(self):
+		""" Dial the peers the tracker gives us, and drive our connections
+		to them, until stopped. """
+
+		while self.running:
+			self.dialer.add_peers(self.peers)
+			self.dialer.tick()
+
+			# Requests which timed out are made again, to any peer.
+			self.scheduler.tick()
+			for connection in list(self.peer_pieces):
+				self.request_blocks(connection)
+
+			# Peers we choke have their outstanding requests dropped.
+			if self.storage is not None:
+				seeding = not self.picker.count_wanted()
+				for connection in self.choker.tick(seeding):
+					self.uploads.pop(connection, set()).clear()
+
+			# Finished disk work is dealt with promptly, between loops.
+			if self.storage is not None:
+				self.storage.run_callbacks()
+
+			if self.connections:
+				loop(self.connections, timeout = 0.1, count = 1)
+			else:
+				sleep(0.1)	# Nothing to wait on yet.
+
+		if self.storage is not None:
+			self.storage.close()
+		self.dialer.close()
+
+	def peer_limits(self):
+		""" Returns the rate limits of a new peer connection, within those
+		of the torrent. """
+
+		return Limits(self.peer_download_rate, self.peer_upload_rate, \
+			parent = self.limits)
+
+	def handle_peer_handshake(self, connection):
+		""" A peer has connected. Until it tells us otherwise, it has
+		no pieces. Connections we didn't dial are kept within our rate
+		limits from now on. We tell it the pieces we have, if any. """
+
+		if connection.limits is None:
+			connection.limits = self.peer_limits()
+		self.peer_pieces[connection] = self.picker.new_bitfield()
+		self.scheduler.add_peer(connection)
+		self.choker.add_peer(connection)
+
+		if self.picker.have.any():
+			connection.send_bitfield(self.picker.have)
+
+	def handle_peer_message(self, connection, message_id, fields):
+		""" Count the pieces each peer has, download the pieces we want
+		from peers which unchoke us, and upload to peers we unchoke. """
+
+		if message_id == BITFIELD:
+			# A bitfield of the wrong length raises, dropping the peer.
+			pieces = self.picker.peer_bitfield(fields[0])
+			self.picker.peer_lost(self.peer_pieces[connection])
+			self.peer_pieces[connection] = pieces
+			self.update_interest(connection)
+		elif message_id == HAVE:
+			self.picker.peer_have(self.peer_pieces[connection], fields[0])
+			self.update_interest(connection)
+		elif message_id == CHOKE:
+			self.scheduler.choked(connection)
+		elif message_id == UNCHOKE:
+			self.request_blocks(connection)
+		elif message_id == INTERESTED and self.storage is not None:
+			self.choker.interested(connection)
+		elif message_id == NOT_INTERESTED:
+			# Its slot goes to another peer, and its requests are dropped.
+			if self.choker.not_interested(connection):
+				self.uploads.pop(connection, set()).clear()
+		elif message_id == PIECE:
+			self.choker.downloaded(connection, len(fields[2]))
+			piece = self.scheduler.block_received(connection, *fields)
+			if piece is not None:
+				self.piece_downloaded(*piece)
+			self.request_blocks(connection)
+		elif message_id == REQUEST:
+			self.upload_block(connection, *fields)
+		elif message_id == CANCEL:
+			self.uploads.get(connection, set()).discard(fields)
+
+	def handle_peer_close(self, connection):
+		""" A peer has gone, so stop counting its pieces, and request
+		the blocks it owed us from other peers. """
+
+		self.scheduler.remove_peer(connection)
+		self.choker.remove_peer(connection)
+		self.picker.peer_lost(self.peer_pieces.pop(connection))
+		self.uploads.pop(connection, None)
+
+	def update_interest(self, connection):
+		""" Tell a peer whether it has any pieces we want. """
+
+		if not self.data_path:
+			return
+
+		wanted = self.picker.pick(self.peer_pieces[connection]) is not None
+		if wanted and not connection.am_interested:
+			connection.send_interested()
+		elif not wanted and connection.am_interested:
+			connection.send_not_interested()
+
+	def request_blocks(self, connection):
+		""" Fill a peer's pipeline of requests. """
+
+		if self.data_path and connection.am_interested:
+			pieces = self.peer_pieces[connection]
+			if not self.scheduler.fill(connection, pieces) and \
+				not self.scheduler.peers[connection].requests:
+				self.update_interest(connection)
+
+	def piece_downloaded(self, index, data):
+		""" Check a downloaded piece against its hash, and write it out if
+		it is good, on a disk thread. """
+
+		def written(good, error):
+			self.piece_written(index, good and not error)
+
+		digest = self.data["info"]["pieces"][index * 20:index * 20 + 20]
+		self.storage.write_piece(index, data, digest, written)
+
+	def piece_written(self, index, good):
+		""" If a downloaded piece was good, and written, tell our peers we
+		have it. Otherwise, it is picked again. """
+
+		self.scheduler.piece_finished(index)
+		if not good:
+			return
+
+		self.picker.got_piece(index)
+		for connection in self.peer_pieces:
+			connection.send_have(index)
+
+	def allocated(self, result, error):
+		""" Keep any error allocating our files. Pieces which can't be
+		written for it will fail to be written, and be picked again. """
+
+		self.allocation_error = error
+
+	def upload_block(self, connection, index, begin, length):
+		""" Read a block a peer has requested, and send it, unless the
+		request has been cancelled by then. Requests while we are choking
+		the peer, or for pieces we don't have, are ignored. """
+
+		if self.storage is None or connection.am_choking or \
+			index >= self.picker.count or \
+			not self.picker.have[index] or \
+			length > BLOCK_LENGTH * 8 or \
+			begin + length > self.scheduler.piece_size(index):
+			return
+
+		request = (index, begin, length)
+		uploads = self.uploads.setdefault(connection, set())
+		uploads.add(request)
+
+		def read(block, error):
+			if request in uploads:
+				uploads.discard(request)
+				if block is not None and not connection.closed:
+					connection.send_piece(index, begin, block)
+					self.choker.uploaded(connection, len(block))
+
+		self.storage.read_block(index, begin, length, read)
+
 	def run(self):
 		""" Start the torrent running. """
 
 		if not self.running:
 			self.running = True
+			self.open_data()
 
 			self.tracker_loop = Thread(target = self.perform_tracker_request, \
 				args = (self.data["announce"], self.info_hash, self.peer_id))
 			self.tracker_loop.start()
 
+			self.peer_loop = Thread(target = self.perform_peer_loop)
+			self.peer_loop.start()
+
 	def stop(self):
 		""" Stop the torrent from running. """
 
@@ -201,4 +805,8 @@ class Torrent():
 			self.running = False
 
 			self.tracker_loop.join()
+			self.peer_loop.join()
+
+			if self.resume_db is not None and self.data_path:
+				self.save_resume()
 
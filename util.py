@@ -23,4 +23,54 @@ def slice(string, n):
 	except IndexError:
 		pass
 
-	return temp
\ No newline at end of file
+	return temp
+
+def to_string(data):
+	""" Given a string, bytearray or memoryview, returns its contents as a
+	string. Strings are returned as they are, without copying. """
+
+	if type(data) == str:
+		return data
+	elif type(data) == memoryview:
+		return data.tobytes()
+	return str(data)
+
+def chunks(data, n):
+	""" Given a string, bytearray or memoryview, and a number n, yields
+	memoryviews of each size n chunk of it, without copying. The last
+	chunk may be shorter. """
+
+	view = memoryview(data)
+	for i in range(0, len(view), n):
+		yield view[i:i + n]
+
+def read_into(stream, view):
+	""" Given a file-like object, and a memoryview, fills the view from the
+	stream, carrying on past short reads. Returns the number of bytes
+	read, which is only less than the size of the view at the end of the
+	stream. """
+
+	size = 0
+	while size < len(view):
+		read = stream.readinto(view[size:])
+		if not read:
+			break
+		size += read
+
+	return size
+
+def read_chunks(stream, n):
+	""" Given a file-like object, and a number n, yields memoryviews of
+	each size n chunk read from it. The last chunk may be shorter. The
+	same buffer is reused for every chunk, so each must be finished with
+	before the next is asked for. """
+
+	view = memoryview(bytearray(n))
+
+	while True:
+		size = read_into(stream, view)
+		if size == 0:
+			return
+		yield view[:size]
+		if size < n:
+			return